@@ -50,6 +50,14 @@ const Dashboard = () => {
   }, []);
 
   const handleLogout = useCallback(() => {
+    const storedToken = localStorage.getItem('token');
+    if (storedToken) {
+      // Revokes the token on the server; the local state is cleared either way
+      fetch('http://localhost:5000/auth/logout', {
+        method: 'POST',
+        headers: { Authorization: `Bearer ${storedToken}` },
+      }).catch(() => {});
+    }
     setIsLoggedIn(false);
     setUser(null);
     setToken(null);
@@ -64,23 +72,26 @@ const Dashboard = () => {
   const fetchSymptoms = useCallback(
     async (userId, currentToken) => {
       try {
-        const response = await fetch(
-          `http://localhost:5000/users/${userId}/symptoms`,
-          {
+        // The list is paginated, so follow the "next" links until the last page
+        const allSymptoms = [];
+        let url = `http://localhost:5000/users/${userId}/symptoms`;
+        while (url) {
+          const response = await fetch(url, {
             method: 'GET',
             headers: {
               Authorization: `Bearer ${currentToken}`,
               'Content-Type': 'application/json',
             },
+          });
+          if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(errorData.message || 'Failed to fetch symptoms');
           }
-        );
-        if (response.ok) {
           const data = await response.json();
-          setSymptoms(data);
-        } else {
-          const errorData = await response.json();
-          throw new Error(errorData.message || 'Failed to fetch symptoms');
+          allSymptoms.push(...data.symptoms);
+          url = data.links.next;
         }
+        setSymptoms(allSymptoms);
       } catch (error) {
         console.error('Error fetching symptoms:', error);
         setError('Failed to fetch symptoms');
@@ -112,6 +123,40 @@ const Dashboard = () => {
     }
   }, [isLoggedIn, user, token, fetchSymptoms, fetchPatterns]);
 
+  // Changes made elsewhere (another tab or device) are pushed by the server instead of polled for
+  useEffect(() => {
+    if (!isLoggedIn || !user || !token) return undefined;
+
+    const source = new EventSource(
+      `http://localhost:5000/users/${user.id}/symptoms/events?jwt=${encodeURIComponent(token)}`
+    );
+    const upsert = (event) => {
+      const symptom = JSON.parse(event.data);
+      setSymptoms((current) =>
+        current.some((s) => s.id === symptom.id)
+          ? current.map((s) => (s.id === symptom.id ? symptom : s))
+          : [...current, symptom]
+      );
+      fetchPatterns();
+    };
+    const remove = (event) => {
+      const { id } = JSON.parse(event.data);
+      setSymptoms((current) => current.filter((s) => s.id !== id));
+      fetchPatterns();
+    };
+    // The server could not tell what was missed, so load the list again
+    const resync = () => {
+      fetchSymptoms(user.id, token);
+      fetchPatterns();
+    };
+    source.addEventListener('symptom.created', upsert);
+    source.addEventListener('symptom.updated', upsert);
+    source.addEventListener('symptom.deleted', remove);
+    source.addEventListener('resync', resync);
+
+    return () => source.close();
+  }, [isLoggedIn, user, token, fetchSymptoms, fetchPatterns]);
+
 
 
 
@@ -212,7 +257,10 @@ const Dashboard = () => {
       );
 
       if (response.ok) {
-        fetchSymptoms(user.id, token);
+        const created = await response.json();
+        setSymptoms((current) =>
+          current.some((s) => s.id === created.id) ? current : [...current, created]
+        );
         fetchPatterns();
         setNewSymptomData({ label: '', description: '' }); // Clear the inputs
       } else {
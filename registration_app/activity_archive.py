@@ -0,0 +1,318 @@
+"""Retention and archival for the activity_logs table.
+
+activity_logs only keeps the last ACTIVITY_LOG_HOT_DAYS days. Compaction
+moves older entries into archive files and deletes them from the table.
+Archives are partitioned by month. Each compaction run writes one file per
+month it archives, under ACTIVITY_LOG_ARCHIVE_DIR:
+
+    2024-01/activity_logs-2024-01-20240501T030000-3f2a9c1e.ndjson.gz
+
+A file holds the month's entries as NDJSON, one gzip member per user, in
+the order /activity_logs pages through them (newest first). The
+activity_log_archives and activity_log_archive_members tables record each
+file and each member's byte range. Reading one user's archived entries
+therefore decompresses only that user's members, and only as far as the
+page reaches. Concatenated members are still one valid gzip file, so
+"zcat" reads a whole archive.
+
+Archives older than ACTIVITY_LOG_ARCHIVE_RETENTION_DAYS are deleted, files
+and all; null keeps them forever.
+
+Compaction runs in a background thread every
+ACTIVITY_LOG_COMPACTION_INTERVAL seconds, and as "flask
+compact-activity-logs". A lock file next to the archives keeps two
+processes from compacting at once.
+"""
+import gzip
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select
+
+from models import db, ActivityLog, ActivityLogArchive, ActivityLogArchiveMember
+import queries
+
+try:
+    import fcntl
+except ImportError:  # Windows; compaction is then only exclusive within the process
+    fcntl = None
+
+# An archived entry, with the attributes of an activity_logs row
+ArchivedLog = namedtuple('ArchivedLog', ('id', 'user_id', 'action', 'endpoint', 'method', 'ip_address',
+                                         'timestamp', 'status_code'))
+
+# Rows fetched from the database cursor at a time while archiving
+ARCHIVE_BATCH_SIZE = 5000
+
+COMPRESS_LEVEL = 6
+
+
+def _month_start(timestamp):
+    return datetime(timestamp.year, timestamp.month, 1)
+
+
+def _next_month(start):
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def _sort_key(entry):
+    # Entries without a timestamp sort last, as they do in the table
+    return (entry.timestamp or datetime.min, entry.id)
+
+
+def newest_first(*sources):
+    """Merges iterables of activity log rows that are each newest first into one, newest first."""
+    return heapq.merge(*sources, key=_sort_key, reverse=True)
+
+
+class ActivityLogArchiver:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._compacting = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._counters = {'compactions': 0, 'archived': 0, 'archives_written': 0, 'purged': 0, 'failed': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ACTIVITY_LOG_HOT_DAYS', 90)
+        app.config.setdefault('ACTIVITY_LOG_ARCHIVE_RETENTION_DAYS', None)
+        app.config.setdefault('ACTIVITY_LOG_COMPACTION_INTERVAL', 3600)  # Seconds
+        app.config.setdefault('ACTIVITY_LOG_ARCHIVE_DIR', os.path.join(app.instance_path, 'activity_archive'))
+
+        self.app = app
+        app.extensions['activity_log_archiver'] = self
+        if app.config['ACTIVITY_LOG_COMPACTION_INTERVAL']:
+            app.before_request(self._ensure_worker)
+
+    def compact(self, now=None):
+        """Archives the entries older than the hot window, then deletes expired archives.
+
+        Returns {'archived': entries, 'archives_written': files, 'purged': entries},
+        or None if another process is compacting.
+        """
+        now = now or datetime.utcnow()
+        with self._exclusive() as acquired:
+            if not acquired:
+                return None
+            result = {'archived': 0, 'archives_written': 0, 'purged': 0}
+            try:
+                hot_days = self.app.config['ACTIVITY_LOG_HOT_DAYS']
+                if hot_days is not None:
+                    cutoff = now - timedelta(days=hot_days)
+                    while True:
+                        oldest = db.session.scalar(
+                            select(func.min(ActivityLog.timestamp)).where(ActivityLog.timestamp < cutoff))
+                        db.session.remove()
+                        if oldest is None:
+                            break
+                        start = _month_start(oldest)
+                        archived = self._archive(start, min(_next_month(start), cutoff))
+                        if not archived:
+                            break  # Only entries logged into the range after it was read; next time
+                        result['archived'] += archived
+                        result['archives_written'] += 1
+
+                retention_days = self.app.config['ACTIVITY_LOG_ARCHIVE_RETENTION_DAYS']
+                if retention_days is not None:
+                    result['purged'] = self._purge(now - timedelta(days=retention_days))
+            except Exception:
+                self._count('failed')
+                raise
+            finally:
+                with self._lock:
+                    self._counters['compactions'] += 1
+                    for name, value in result.items():
+                        self._counters[name] += value
+            return result
+
+    def user_logs(self, user_id, after=None, since=None):
+        """The user's archived entries as ArchivedLog tuples, newest first, read lazily.
+
+        after is the (timestamp, id) of the last entry already seen. With since,
+        archives holding nothing of the user from that timestamp on are skipped.
+        """
+        members = deque(queries.activity_log_archive_members(user_id, after, since).all())
+        after_key = (after[0], after[1]) if after is not None else None
+
+        # Members of different archives can overlap in time, e.g. when entries spilled by the
+        # writer arrive late. A member is opened once the entries ahead of it are no newer than
+        # its newest one, so a page only decompresses the members it reaches.
+        heap = []
+        sequence = itertools.count()
+
+        def push(entries):
+            for entry in entries:
+                heapq.heappush(heap, (_heap_key(entry), next(sequence), entry, entries))
+                return
+
+        while heap or members:
+            while members and (not heap or members[0].max_timestamp >= heap[0][2].timestamp):
+                push(self._read_member(members.popleft(), after_key))
+            if not heap:
+                return
+            _, _, entry, entries = heapq.heappop(heap)
+            yield entry
+            push(entries)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _archive(self, start, end):
+        """Moves the entries from start up to end, all in start's month, into a new archive. Returns how many."""
+        month = start.strftime('%Y-%m')
+        relative_path = (f'{month}/activity_logs-{month}-{datetime.utcnow():%Y%m%dT%H%M%S}-'
+                         f'{uuid.uuid4().hex[:8]}.ndjson.gz')
+        path = os.path.join(self.app.config['ACTIVITY_LOG_ARCHIVE_DIR'], relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        in_range = (ActivityLog.timestamp >= start, ActivityLog.timestamp < end)
+        query = (select(*(getattr(ActivityLog, column) for column in ArchivedLog._fields))
+                 .where(*in_range)
+                 .order_by(ActivityLog.user_id, ActivityLog.timestamp.desc(), ActivityLog.id.desc()))
+        members = []
+        newest_id = 0
+        with db.engine.connect() as connection, open(path + '.tmp', 'wb') as archive_file:
+            rows = connection.execution_options(yield_per=ARCHIVE_BATCH_SIZE).execute(query)
+            for user_id, user_rows in itertools.groupby(rows, key=lambda row: row.user_id):
+                user_rows = list(user_rows)
+                lines = []
+                for row in user_rows:
+                    lines.append(json.dumps(dict(row._mapping, timestamp=row.timestamp.isoformat()),
+                                            separators=(',', ':')))
+                    newest_id = max(newest_id, row.id)
+                data = gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'), COMPRESS_LEVEL, mtime=0)
+                members.append({
+                    'user_id': user_id,
+                    'offset': archive_file.tell(),
+                    'length': len(data),
+                    'row_count': len(user_rows),
+                    'min_timestamp': user_rows[-1].timestamp,
+                    'max_timestamp': user_rows[0].timestamp,
+                })
+                archive_file.write(data)
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+        os.replace(path + '.tmp', path)
+
+        row_count = sum(member['row_count'] for member in members)
+        try:
+            with db.engine.begin() as connection:
+                if members:
+                    archive_id = connection.execute(insert(ActivityLogArchive).values(
+                        month=month, path=relative_path, row_count=row_count,
+                        min_timestamp=min(member['min_timestamp'] for member in members),
+                        max_timestamp=max(member['max_timestamp'] for member in members),
+                        created_at=datetime.utcnow())).inserted_primary_key[0]
+                    connection.execute(insert(ActivityLogArchiveMember),
+                                       [dict(member, archive_id=archive_id) for member in members])
+                # Up to the newest id archived, so entries logged into the range meanwhile stay
+                connection.execute(delete(ActivityLog).where(*in_range, ActivityLog.id <= newest_id))
+        except Exception:
+            os.remove(path)
+            raise
+        if not members:
+            os.remove(path)
+        return row_count
+
+    def _purge(self, before):
+        """Deletes the archives whose newest entry is older than before. Returns the entries they held."""
+        with db.engine.begin() as connection:
+            expired = connection.execute(
+                select(ActivityLogArchive.id, ActivityLogArchive.path, ActivityLogArchive.row_count)
+                .where(ActivityLogArchive.max_timestamp < before)).all()
+            if not expired:
+                return 0
+            ids = [archive.id for archive in expired]
+            connection.execute(delete(ActivityLogArchiveMember).where(ActivityLogArchiveMember.archive_id.in_(ids)))
+            connection.execute(delete(ActivityLogArchive).where(ActivityLogArchive.id.in_(ids)))
+        for archive in expired:
+            path = os.path.join(self.app.config['ACTIVITY_LOG_ARCHIVE_DIR'], archive.path)
+            try:
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))  # Only succeeds once the month has no archives left
+            except OSError:
+                pass
+        return sum(archive.row_count for archive in expired)
+
+    def _read_member(self, member, after_key):
+        path = os.path.join(self.app.config['ACTIVITY_LOG_ARCHIVE_DIR'], member.path)
+        with open(path, 'rb') as archive_file:
+            archive_file.seek(member.offset)
+            data = archive_file.read(member.length)
+        for line in gzip.decompress(data).decode('utf-8').splitlines():
+            values = json.loads(line)
+            values['timestamp'] = datetime.fromisoformat(values['timestamp'])
+            entry = ArchivedLog(**values)
+            if after_key is None or _sort_key(entry) < after_key:
+                yield entry
+
+    @contextmanager
+    def _exclusive(self):
+        if not self._compacting.acquire(blocking=False):
+            yield False
+            return
+        try:
+            if fcntl is None:
+                yield True
+                return
+            directory = self.app.config['ACTIVITY_LOG_ARCHIVE_DIR']
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, '.compaction.lock'), 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+                yield True
+        finally:
+            self._compacting.release()
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _ensure_worker(self):
+        # Started on the first request, and again in forked processes, whose
+        # copy of the parent's thread does not run
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid():
+                    self._stopping.clear()
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='activity-log-compactor', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        interval = self.app.config['ACTIVITY_LOG_COMPACTION_INTERVAL']
+        while not self._stopping.wait(interval):
+            started = time.monotonic()
+            try:
+                with self.app.app_context():
+                    result = self.compact()
+                if result and (result['archived'] or result['purged']):
+                    self.app.logger.info(
+                        f"Archived {result['archived']} activity log entries in {result['archives_written']} files "
+                        f"and purged {result['purged']} in {time.monotonic() - started:.1f}s")
+            except Exception as e:
+                self.app.logger.error(f"Failed to compact activity logs: {str(e)}")
+
+
+def _heap_key(entry):
+    # heapq pops the smallest, so newest first means the negated (timestamp, id)
+    return (-((entry.timestamp - datetime.min) // timedelta(microseconds=1)), -entry.id)
+
+
+activity_archiver = ActivityLogArchiver()
@@ -0,0 +1,229 @@
+"""Background writer for ActivityLog entries.
+
+Request handlers hand their entries to a bounded in-memory queue and return
+right away. A worker thread drains the queue and bulk-inserts the entries
+in batches, on its own connection, once a batch is full or the flush
+interval has passed. When the queue is full the configured overflow policy
+decides what happens:
+
+    block        wait up to ACTIVITY_LOG_BLOCK_TIMEOUT seconds for room, then drop
+    drop_oldest  discard the oldest queued entry to make room
+    spill        append the entry to a local NDJSON file, replayed once the queue is idle
+"""
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from models import db, ActivityLog
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'spill')
+
+
+class ActivityLogWriter:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._counters = {'queued': 0, 'written': 0, 'dropped': 0, 'spilled': 0, 'failed': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ACTIVITY_LOG_ASYNC', True)
+        app.config.setdefault('ACTIVITY_LOG_QUEUE_SIZE', 10000)
+        app.config.setdefault('ACTIVITY_LOG_BATCH_SIZE', 500)
+        app.config.setdefault('ACTIVITY_LOG_FLUSH_INTERVAL', 0.5)  # Seconds
+        app.config.setdefault('ACTIVITY_LOG_OVERFLOW', 'drop_oldest')
+        app.config.setdefault('ACTIVITY_LOG_BLOCK_TIMEOUT', 1.0)  # Seconds
+        app.config.setdefault('ACTIVITY_LOG_SPILL_PATH', os.path.join(app.instance_path, 'activity_log_spill.ndjson'))
+        if app.config['ACTIVITY_LOG_OVERFLOW'] not in OVERFLOW_POLICIES:
+            raise ValueError(f"ACTIVITY_LOG_OVERFLOW must be one of {', '.join(OVERFLOW_POLICIES)}")
+
+        self.app = app
+        app.extensions['activity_log_writer'] = self
+        atexit.register(self.shutdown)
+
+    def enqueue(self, entry):
+        """Queues a dict of ActivityLog column values for writing."""
+        if not self.app.config['ACTIVITY_LOG_ASYNC']:
+            self._write([entry])
+            return
+
+        log_queue = self._ensure_worker()
+        self._count('queued')
+        try:
+            log_queue.put_nowait(entry)
+            return
+        except queue.Full:
+            pass
+
+        policy = self.app.config['ACTIVITY_LOG_OVERFLOW']
+        if policy == 'block':
+            try:
+                log_queue.put(entry, timeout=self.app.config['ACTIVITY_LOG_BLOCK_TIMEOUT'])
+            except queue.Full:
+                self._count('dropped')
+        elif policy == 'drop_oldest':
+            while True:
+                try:
+                    log_queue.get_nowait()
+                    log_queue.task_done()
+                    self._count('dropped')
+                except queue.Empty:
+                    pass
+                try:
+                    log_queue.put_nowait(entry)
+                    break
+                except queue.Full:
+                    continue
+        else:
+            self._spill([entry])
+
+    def flush(self):
+        """Blocks until every queued entry has been written or dropped."""
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def shutdown(self, timeout=5.0):
+        """Stops the worker and writes whatever is still queued."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        remaining = []
+        while True:
+            try:
+                remaining.append(self._queue.get_nowait())
+                self._queue.task_done()
+            except queue.Empty:
+                break
+        if remaining:
+            self._write(remaining)
+        self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['pending'] = self._queue.qsize() if self._queue is not None else 0
+        return stats
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _ensure_worker(self):
+        # The worker is started lazily, again in forked processes, whose copy of
+        # the parent's thread does not run, and again if it has died
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                    if self._queue is None or self._pid != os.getpid():
+                        self._queue = queue.Queue(maxsize=self.app.config['ACTIVITY_LOG_QUEUE_SIZE'])
+                    self._stopping.clear()
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='activity-log-writer', daemon=True)
+                    self._thread.start()
+        return self._queue
+
+    def _run(self):
+        log_queue = self._queue
+        batch_size = self.app.config['ACTIVITY_LOG_BATCH_SIZE']
+        interval = self.app.config['ACTIVITY_LOG_FLUSH_INTERVAL']
+
+        while True:
+            try:
+                batch = [log_queue.get(timeout=interval)]
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                try:
+                    self._replay_spill()
+                except Exception as e:
+                    self.app.logger.error(f"Failed to replay spilled activity log entries: {str(e)}")
+                continue
+
+            deadline = time.monotonic() + interval
+            while len(batch) < batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(log_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    log_queue.task_done()
+
+    def _write(self, entries):
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as connection:
+                    connection.execute(insert(ActivityLog), entries)
+            self._count('written', len(entries))
+            return True
+        except Exception as e:
+            self._count('failed', len(entries))
+            self.app.logger.error(f"Failed to write {len(entries)} activity log entries: {str(e)}")
+            return False
+
+    def _spill(self, entries):
+        path = self.app.config['ACTIVITY_LOG_SPILL_PATH']
+        try:
+            with self._spill_lock:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'a', encoding='utf-8') as spill_file:
+                    for entry in entries:
+                        line = dict(entry, timestamp=entry['timestamp'].isoformat())
+                        spill_file.write(json.dumps(line) + '\n')
+            self._count('spilled', len(entries))
+        except OSError as e:
+            self._count('dropped', len(entries))
+            self.app.logger.error(f"Failed to spill activity log entries: {str(e)}")
+
+    def _replay_spill(self):
+        path = self.app.config['ACTIVITY_LOG_SPILL_PATH']
+        replay_path = path + '.replaying'
+        if self.app.config['ACTIVITY_LOG_OVERFLOW'] != 'spill':
+            return
+
+        # Move the file aside so entries spilled meanwhile go to a fresh one
+        with self._spill_lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(path):
+                    return
+                os.replace(path, replay_path)
+
+        entries = []
+        with open(replay_path, encoding='utf-8') as spill_file:
+            for line in spill_file:
+                if line.strip():
+                    entry = json.loads(line)
+                    entry['timestamp'] = datetime.fromisoformat(entry['timestamp'])
+                    entries.append(entry)
+
+        batch_size = self.app.config['ACTIVITY_LOG_BATCH_SIZE']
+        for start in range(0, len(entries), batch_size):
+            if not self._write(entries[start:start + batch_size]):
+                # Keep what is left for the next idle period
+                with open(replay_path, 'w', encoding='utf-8') as spill_file:
+                    for entry in entries[start:]:
+                        spill_file.write(json.dumps(dict(entry, timestamp=entry['timestamp'].isoformat())) + '\n')
+                return
+        os.remove(replay_path)
+
+
+activity_writer = ActivityLogWriter()
@@ -0,0 +1,266 @@
+"""Symptom counts over time, served from daily rollup tables.
+
+Three tables count symptoms per day and label, each split by one user
+attribute: location, age band or gender. The write handlers keep them up to
+date in the same transaction as the change, like the pattern index:
+
+    record_symptom()    a symptom was added (delta=1) or removed (delta=-1)
+    snapshot() and
+    apply_difference()  for changes to many symptoms at once, or to the
+                        user's age, gender or location
+
+rebuild() recomputes the tables from the symptoms table. It runs as a
+migration on databases that predate the tables, as "flask rebuild-rollups",
+and after seeding.
+
+counts() answers the /analytics/symptoms queries. A range of years is read
+as a few thousand rollup rows rather than every symptom. Weeks (starting on
+Monday) and months are grouped from the daily rows in SQL.
+"""
+from collections import Counter
+from datetime import date, datetime
+
+from sqlalchemy import Date, cast, delete, func, insert, select
+
+from models import db, Symptom, User, SymptomDailyLocationCount, SymptomDailyAgeBandCount, SymptomDailyGenderCount
+
+UNKNOWN = 'unknown'
+AGE_BAND_WIDTH = 10
+OLDEST_AGE_BAND = 90  # Ages from here on share the band "90+"
+
+PERIODS = ('day', 'week', 'month')
+DIMENSIONS = ('label', 'location', 'age_band', 'gender')
+
+# Each rollup and the user attribute it is split by
+ROLLUPS = (
+    (SymptomDailyLocationCount, 'location'),
+    (SymptomDailyAgeBandCount, 'age_band'),
+    (SymptomDailyGenderCount, 'gender'),
+)
+
+# Rows per INSERT during a rebuild
+REBUILD_CHUNK_SIZE = 5000
+
+
+class AnalyticsError(ValueError):
+    """Raised for query parameters the rollups can not answer."""
+
+
+def age_band(age):
+    if age is None:
+        return UNKNOWN
+    if age >= OLDEST_AGE_BAND:
+        return f'{OLDEST_AGE_BAND}+'
+    start = age // AGE_BAND_WIDTH * AGE_BAND_WIDTH
+    return f'{start}-{start + AGE_BAND_WIDTH - 1}'
+
+
+def _key(day, label, location, age, gender):
+    """The finest grain the rollups are built from; each rollup keeps day, label and one attribute."""
+    return (_as_date(day), label, location or UNKNOWN, age_band(age), gender or UNKNOWN)
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    # SQLite returns date() as text
+    return value if isinstance(value, date) else date.fromisoformat(str(value)[:10])
+
+
+def _upsert_statement(table):
+    """INSERT of (day, label, attribute, count) rows that adds count to the existing row instead."""
+    dialect = db.session.get_bind(mapper=table.__mapper__).dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise RuntimeError(f'Rollup upsert is not supported on {dialect}')
+
+    statement = insert(table.__table__)
+    return statement.on_conflict_do_update(
+        index_elements=[column.name for column in table.__table__.primary_key],
+        set_={'count': table.__table__.c['count'] + statement.excluded['count']}
+    )
+
+
+def _apply(deltas):
+    """Adds a Counter of key -> change to the rollups, with one upsert and at most one delete per table."""
+    for table, attribute in ROLLUPS:
+        position = DIMENSIONS.index(attribute) + 1
+        projected = Counter()
+        for key, delta in deltas.items():
+            projected[(key[0], key[1], key[position])] += delta
+        rows = [{'day': day, 'label': label, attribute: value, 'count': delta}
+                for (day, label, value), delta in projected.items() if delta]
+        if not rows:
+            continue
+        db.session.execute(_upsert_statement(table), rows)
+        # Rows counted down to zero go; the days decremented bound the delete to a few index ranges
+        decremented = {row['day'] for row in rows if row['count'] < 0}
+        if decremented:
+            columns = table.__table__.c
+            db.session.execute(delete(table).where(columns.day.in_(decremented), columns['count'] <= 0))
+
+
+def record_symptom(user, label, timestamp, delta=1):
+    """Counts one symptom of the user in (delta=1) or out (delta=-1).
+
+    Must be called inside the transaction that adds or removes the symptom.
+    """
+    if timestamp is None:
+        return
+    _apply({_key(timestamp, label, user.location, user.age, user.gender): delta})
+
+
+def snapshot(user_id):
+    """What the user's symptoms add to the rollups, as a Counter of keys.
+
+    Take one before and one after changing several of the user's symptoms
+    or their age, gender or location, and pass both to apply_difference().
+    """
+    user = db.session.get(User, user_id)
+    if user is None:
+        return Counter()
+    rows = db.session.execute(
+        select(func.date(Symptom.timestamp), Symptom.label, func.count())
+        .where(Symptom.userid == user_id, Symptom.timestamp.is_not(None))
+        .group_by(func.date(Symptom.timestamp), Symptom.label)
+    )
+    return Counter({_key(day, label, user.location, user.age, user.gender): count for day, label, count in rows})
+
+
+def apply_difference(before, after):
+    deltas = Counter(after)
+    deltas.subtract(before)
+    _apply(deltas)
+
+
+def forget_user(user_id):
+    """Takes a user's symptoms out of the rollups, e.g. before the user is deleted."""
+    apply_difference(snapshot(user_id), Counter())
+
+
+def clear(executor=None):
+    executor = executor or db.session
+    for table, _ in ROLLUPS:
+        executor.execute(delete(table))
+
+
+def rebuild(executor=None):
+    """Recomputes every rollup with one grouped query over the symptoms.
+
+    executor is the session (the default) or a connection; the caller
+    commits. Returns the number of symptoms counted.
+    """
+    executor = executor or db.session
+    clear(executor)
+    day = func.date(Symptom.timestamp)
+    rows = executor.execute(
+        select(day, Symptom.label, User.location, User.age, User.gender, func.count())
+        .join(User, User.id == Symptom.userid)
+        .where(Symptom.timestamp.is_not(None))
+        .group_by(day, Symptom.label, User.location, User.age, User.gender)
+    )
+
+    totals = {table: Counter() for table, _ in ROLLUPS}
+    symptom_count = 0
+    for row_day, label, location, age, gender, count in rows:
+        key = _key(row_day, label, location, age, gender)
+        for table, attribute in ROLLUPS:
+            totals[table][(key[0], key[1], key[DIMENSIONS.index(attribute) + 1])] += count
+        symptom_count += count
+
+    for table, attribute in ROLLUPS:
+        values = [{'day': day, 'label': label, attribute: value, 'count': count}
+                  for (day, label, value), count in totals[table].items()]
+        for start in range(0, len(values), REBUILD_CHUNK_SIZE):
+            executor.execute(insert(table), values[start:start + REBUILD_CHUNK_SIZE])
+    return symptom_count
+
+
+def _period(column, period):
+    if period == 'day':
+        return column
+    dialect = db.session.get_bind(mapper=SymptomDailyLocationCount.__mapper__).dialect.name
+    if dialect == 'sqlite':
+        if period == 'week':
+            return func.date(column, 'weekday 0', '-6 days')  # The Monday on or before the day
+        return func.strftime('%Y-%m-01', column)
+    return cast(func.date_trunc(period, column), Date)
+
+
+def parse_date(value, name):
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise AnalyticsError(f'{name} must be a date like 2024-01-31')
+
+
+def parse_group_by(value):
+    """Splits group_by into (period or None, [dimensions])."""
+    period = None
+    dimensions = []
+    for name in (value or '').split(','):
+        name = name.strip()
+        if not name:
+            continue
+        if name in PERIODS:
+            if period is not None:
+                raise AnalyticsError('group_by can hold only one of day, week, month')
+            period = name
+        elif name in DIMENSIONS:
+            if name not in dimensions:
+                dimensions.append(name)
+        else:
+            raise AnalyticsError(f"Unknown group_by '{name}', expected any of {', '.join(PERIODS + DIMENSIONS)}")
+    return period, dimensions
+
+
+def _rollup_for(attributes):
+    attributes = set(attributes) - {'label'}
+    if len(attributes) > 1:
+        raise AnalyticsError(f"{' and '.join(sorted(attributes))} can not be combined in one query")
+    if not attributes:
+        return SymptomDailyGenderCount  # The smallest of the three
+    attribute = attributes.pop()
+    return next(table for table, table_attribute in ROLLUPS if table_attribute == attribute)
+
+
+def counts(start=None, end=None, period=None, dimensions=(), filters=None, limit=None):
+    """Symptom counts from start to end (both inclusive), grouped by period and dimensions.
+
+    filters maps dimensions to the one value to count, e.g. {'location': 'Oslo'}.
+    Returns a list of dicts, or raises AnalyticsError if there would be more than limit.
+    """
+    filters = filters or {}
+    table = _rollup_for(list(dimensions) + list(filters))
+    columns = table.__table__.c
+
+    group_columns = []
+    if period is not None:
+        group_columns.append(_period(columns.day, period).label(period))
+    group_columns.extend(columns[dimension] for dimension in dimensions)
+
+    query = select(*group_columns, func.coalesce(func.sum(columns['count']), 0).label('count'))
+    if start is not None:
+        query = query.where(columns.day >= start)
+    if end is not None:
+        query = query.where(columns.day <= end)
+    for dimension, value in filters.items():
+        query = query.where(columns[dimension] == value)
+    if group_columns:
+        query = query.group_by(*group_columns).order_by(*group_columns)
+    if limit is not None:
+        query = query.limit(limit + 1)
+
+    rows = db.session.execute(query).all()
+    if limit is not None and len(rows) > limit:
+        raise AnalyticsError(f'More than {limit} rows; narrow the range or group by a longer period')
+    keys = [column.name for column in group_columns] + ['count']
+    if period is None:
+        return [dict(zip(keys, row)) for row in rows]
+    # Dates come back as date objects or, from SQLite's date functions, ISO text; both print as ISO
+    return [dict(zip(keys, (str(row[0]),) + tuple(row[1:]))) for row in rows]
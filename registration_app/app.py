@@ -1,71 +1,126 @@
-from flask import Flask, jsonify, request, url_for
+from flask import Flask, Response, g, jsonify, request
 from flask_restful import Api
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token
 from flask_sqlalchemy import SQLAlchemy
-from models import db, User, Symptom, ActivityLog
+from models import db, User, Symptom
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import timedelta, datetime
-from collections import Counter
-import random
+from datetime import datetime
+import itertools
+import json
+import math
+import time
+import click
+import patterns
+import analytics
+import pattern_mining
+import pagination
+import streaming
+import serializers
+from serializers import USER_FIELDS, SYMPTOM_FIELDS, ACTIVITY_LOG_FIELDS
+from activity_log import activity_writer
+import activity_archive
+from activity_archive import activity_archiver
+import cache
+from cache import resource_cache
+import versioning
+import symptom_batch
+import queries
+import migrations
+import query_plans
+import db_profile
+import seeding
+from credentials import credentials, CredentialsBusy
+from rate_limit import login_rate_limits
+from events import symptom_events, StreamLimitReached
+from metrics import request_metrics, PROMETHEUS_CONTENT_TYPE
+from auth import token_auth
+from response_encoding import response_encoding
 
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True, expose_headers=['ETag'])
 
-app.config['SECRET_KEY'] = 'your-secret-key'  # Change this to a secure key
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///data.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['JWT_SECRET_KEY'] = 'jwt-secret-key'  # Change this to a secure key
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
+# Defaults live in config.py; see there for how to override them per deployment
+app.config.from_object('config.Config')
+app.config.from_envvar('REGISTRATION_APP_SETTINGS', silent=True)
+app.config.from_prefixed_env()
 
+db_profile.configure(app)
 db.init_app(app)
+db_profile.attach(app, db)
+request_metrics.init_app(app)
+request_metrics.attach(db)
 with app.app_context():
-    db.create_all()
+    migrations.upgrade()
+    patterns.ensure_built()
+
+activity_writer.init_app(app)
+activity_archiver.init_app(app)
+resource_cache.init_app(app)
+credentials.init_app(app)
+login_rate_limits.init_app(app)
+symptom_events.init_app(app)
+token_auth.init_app(app)
+response_encoding.init_app(app)
 
 jwt = JWTManager(app)
 api = Api(app)
 
 
+def load_user_record(user_id):
+    """Returns the user's columns as a dict through the resource cache and its ETag, or (None, None)."""
+    def load():
+        user = User.query.get(user_id)
+        return serializers.record(user, USER_FIELDS) if user else None
+    return versioning.load(cache.user_key(user_id), load, (versioning.user_scope(user_id),))
 
-# Route to retrieve all users
+def load_symptom_record(user_id, symptom_id):
+    """Returns the symptom's columns as a dict through the resource cache and its ETag, or (None, None)."""
+    def load():
+        symptom = Symptom.query.filter_by(userid=user_id, id=symptom_id).first()
+        return serializers.record(symptom, SYMPTOM_FIELDS) if symptom else None
+    return versioning.load(cache.symptom_key(user_id, symptom_id), load, (versioning.user_scope(user_id),),
+                           tags=(cache.symptom_records_tag(user_id),))
+
+# Route to retrieve all users, one page at a time
 @app.route('/get_users', methods=['GET'])
 def get_users():
-    users = User.query.all()
-    user_list = []
-    for user in users:
-        user_dict = {
-            "id": user.id,
-            "username": user.username,
-            "age": user.age,
-            "gender": user.gender,
-            "location": user.location,
-            "links": {
-                "self": url_for('get_user', user_id=user.id, _external=True),
-                "symptoms": url_for('get_user_symptoms', user_id=user.id, _external=True)
-            }
-        }
-        user_list.append(user_dict)
-    return jsonify(user_list)
+    try:
+        limit = pagination.page_size()
+        fields = pagination.requested_fields(USER_FIELDS, always=('id',))
+        after = pagination.decode_cursor(request.args.get('cursor'), int)
+    except pagination.PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+
+    query = queries.users_page(fields, after[0] if after else None)
+
+    # Streams run to the end of the table unless a limit is given explicitly
+    if streaming.wants_stream():
+        if 'limit' in request.args:
+            query = query.limit(limit)
+        if serializers.minimal_links():
+            return streaming.ndjson_response(query, lambda user: serializers.record(user, fields))
+        templates = serializers.link_templates.get()
+        return streaming.ndjson_response(
+            query, lambda user: serializers.serialize_user(user, fields, templates=templates))
+
+    users = query.limit(limit + 1).all()
+    next_cursor = pagination.encode_cursor(users[limit - 1].id) if len(users) > limit else None
+    return jsonify({
+        'users': serializers.serialize_users(users[:limit], fields),
+        'links': pagination.page_links('get_users', next_cursor)
+    })
 
 @app.route('/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
-    user = User.query.get(user_id)
+    etag = versioning.etag_for(versioning.user_scope(user_id))
+    not_modified = versioning.not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    user, etag = load_user_record(user_id)
     if not user:
         return jsonify({'message': 'User not found'}), 404
-    user_dict = {
-        "id": user.id,
-        "username": user.username,
-        "age": user.age,
-        "gender": user.gender,
-        "location": user.location,
-        "links": {
-            "self": url_for('get_user', user_id=user.id, _external=True),
-            "symptoms": url_for('get_user_symptoms', user_id=user.id, _external=True),
-            "update": url_for('update_user', user_id=user.id, _external=True),
-            "delete": url_for('delete_user', user_id=user.id, _external=True)
-        }
-    }
-    return jsonify(user_dict)
+    return versioning.tagged(jsonify(serializers.with_user_links(user, detail=True)), etag)
 
 @app.route('/auth/login', methods=['POST'])
 def login():
@@ -76,31 +131,41 @@ def login():
 
         if not username or not password:
             return jsonify({'message': 'Missing username or password'}), 400
+        if not isinstance(username, str) or not isinstance(password, str):
+            return jsonify({'message': 'Username and password must be strings'}), 400
+
+        # Floods are turned away here, before any lookup or hashing
+        retry_after = login_rate_limits.check(request.remote_addr, username)
+        if retry_after:
+            return jsonify({'message': 'Too many login attempts, try again later'}), 429, \
+                {'Retry-After': str(math.ceil(retry_after))}
 
-        user = User.query.filter_by(username=username).first()
+        account = credentials.lookup(username)
 
-        if user and check_password_hash(user.password, password):
-            access_token = create_access_token(identity=user.id)
+        if account and credentials.verify(account['password'], password):
+            if credentials.needs_rehash(account['password']):
+                credentials.upgrade(account, password)
+            access_token = create_access_token(identity=account['id'])
             return jsonify({
                 'token': access_token,
-                'user': {
-                    'id': user.id,
-                    'username': user.username,
-                    'age': user.age,
-                    'gender': user.gender,
-                    'location': user.location,
-                    'links': {
-                        'self': url_for('get_user', user_id=user.id, _external=True),
-                        'symptoms': url_for('get_user_symptoms', user_id=user.id, _external=True)
-                    }
-                }
+                'user': serializers.with_user_links({field: account[field] for field in USER_FIELDS})
             }), 200
 
         return jsonify({'message': 'Invalid username or password'}), 401
 
+    except CredentialsBusy as e:
+        return jsonify({'message': str(e)}), 503, {'Retry-After': '1'}
     except Exception as e:
         return jsonify({'message': str(e)}), 500
 
+# Revokes the token the request was made with, see auth.py
+@app.route('/auth/logout', methods=['POST'])
+@token_auth.required()
+def logout():
+    token_auth.revoke(g.principal)
+    log_user_activity("Logout", 200)
+    return jsonify({'message': 'Logged out successfully'}), 200
+
 @app.route('/auth/register', methods=['POST'])
 def register():
     try:
@@ -111,7 +176,7 @@ def register():
             return jsonify({'message': 'Username already exists'}), 400
 
         # Create new user with hashed password
-        hashed_password = generate_password_hash(data['password'])
+        hashed_password = credentials.hash_password(data['password'])
         new_user = User(
             username=data['username'],
             password=hashed_password,
@@ -122,6 +187,7 @@ def register():
 
         db.session.add(new_user)
         db.session.commit()
+        credentials.forget(new_user.username)  # Drops a cached "no such user"
 
         # Create access token
         access_token = create_access_token(identity=new_user.id)
@@ -129,19 +195,12 @@ def register():
         return jsonify({
             'message': 'User created successfully',
             'token': access_token,
-            'user': {
-                'id': new_user.id,
-                'username': new_user.username,
-                'age': new_user.age,
-                'gender': new_user.gender,
-                'location': new_user.location,
-                'links': {
-                    'self': url_for('get_user', user_id=new_user.id, _external=True),
-                    'symptoms': url_for('get_user_symptoms', user_id=new_user.id, _external=True)
-                }
-            }
+            'user': serializers.serialize_user(new_user)
         }), 201
 
+    except CredentialsBusy as e:
+        db.session.rollback()
+        return jsonify({'message': str(e)}), 503, {'Retry-After': '1'}
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': str(e)}), 500
@@ -177,74 +236,126 @@ def add_symptom(user_id):
 
     try:
         db.session.add(new_symptom)
+        patterns.refresh_user(user_id)  # Flushes, which sets the timestamp
+        analytics.record_symptom(user, new_symptom.label, new_symptom.timestamp)
+        versioning.bump(versioning.user_scope(user_id))
         db.session.commit()
+        resource_cache.invalidate_tags(cache.symptom_pages_tag(user_id))
         log_user_activity("Add Symptom", 201)
 
-        symptom_dict = {
-            'id': new_symptom.id,
-            'label': new_symptom.label,
-            'description': new_symptom.description,
-            'timestamp': new_symptom.timestamp.isoformat(),
-            'links': {
-                'self': url_for('get_symptom', user_id=user_id, symptom_id=new_symptom.id, _external=True),
-                'user': url_for('get_user', user_id=user_id, _external=True),
-                'update': url_for('update_symptom', user_id=user_id, symptom_id=new_symptom.id, _external=True),
-                'delete': url_for('delete_symptom', user_id=user_id, symptom_id=new_symptom.id, _external=True)
-            }
-        }
-
+        symptom_dict = serializers.serialize_symptom(new_symptom, user_id)
+        symptom_events.publish(user_id, 'symptom.created', symptom_dict)
         return jsonify(symptom_dict), 201
     except Exception as e:
         return jsonify({'message': str(e)}), 400
 
+# POST: Add or update many symptoms for a user in one transaction
+@app.route('/users/<int:user_id>/symptoms:batch', methods=['POST'])
+def add_symptoms_batch(user_id):
+    user = User.query.get(user_id)
+    if not user:
+        return jsonify({'message': 'User not found'}), 404
+
+    try:
+        items = symptom_batch.parse_items(request)
+    except symptom_batch.BatchError as e:
+        return jsonify({'message': str(e)}), 400
+    if len(items) > app.config['SYMPTOM_BATCH_MAX_ITEMS']:
+        return jsonify({'message': f"A batch can hold at most {app.config['SYMPTOM_BATCH_MAX_ITEMS']} symptoms"}), 413
+
+    try:
+        rollups_before = analytics.snapshot(user_id)
+        results = symptom_batch.upsert(user_id, items)
+        patterns.refresh_user(user_id)
+        analytics.apply_difference(rollups_before, analytics.snapshot(user_id))
+        versioning.bump(versioning.user_scope(user_id))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': str(e)}), 500
+
+    resource_cache.invalidate_tags(cache.symptom_pages_tag(user_id), cache.symptom_records_tag(user_id))
+    symptom_events.publish(user_id, 'resync', {})  # One refetch instead of an event per item
+    log_user_activity("Add Symptoms Batch", 200)
+
+    summary = {status: 0 for status in ('created', 'updated', 'superseded', 'invalid')}
+    for result in results:
+        summary[result['status']] += 1
+    return jsonify({'summary': summary, 'results': results}), 200
+
 # GET: Get all symptoms for a user
 @app.route('/users/<int:user_id>/symptoms', methods=['GET', 'OPTIONS'])
-@jwt_required()
+@token_auth.required()
 def get_user_symptoms(user_id):
-    user = User.query.get(user_id)
+    etag = versioning.etag_for(versioning.user_scope(user_id))
+    not_modified = versioning.not_modified(etag)
+    if not_modified:
+        log_user_activity("Get User Symptoms", 304)
+        return not_modified
+
+    user, _ = load_user_record(user_id)
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
-    symptoms = Symptom.query.filter_by(userid=user_id).all()
-    log_user_activity("Get User Symptoms", 200)
+    try:
+        limit = pagination.page_size()
+        fields = pagination.requested_fields(SYMPTOM_FIELDS, always=('id',))
+        after = pagination.decode_cursor(request.args.get('cursor'), int)
+    except pagination.PaginationError as e:
+        return jsonify({'message': str(e)}), 400
 
-    symptoms_list = []
-    for symptom in symptoms:
-        symptom_dict = {
-            'id': symptom.id,
-            'label': symptom.label,
-            'description': symptom.description,
-            'timestamp': symptom.timestamp.isoformat(),
-            'links': {
-                'self': url_for('get_symptom', user_id=user_id, symptom_id=symptom.id, _external=True),
-                'user': url_for('get_user', user_id=user_id, _external=True),
-                'update': url_for('update_symptom', user_id=user_id, symptom_id=symptom.id, _external=True),
-                'delete': url_for('delete_symptom', user_id=user_id, symptom_id=symptom.id, _external=True)
-            }
+    def load_page():
+        query = queries.user_symptoms_page(user_id, fields, after[0] if after else None)
+        symptoms = query.limit(limit + 1).all()
+        return {
+            'symptoms': [serializers.record(symptom, fields) for symptom in symptoms[:limit]],
+            'next_cursor': pagination.encode_cursor(symptoms[limit - 1].id) if len(symptoms) > limit else None
         }
-        symptoms_list.append(symptom_dict)
 
-    return jsonify(symptoms_list)
+    page, etag = versioning.load(
+        cache.symptom_page_key(user_id, request.args.get('cursor'), limit, fields),
+        load_page, (versioning.user_scope(user_id),), tags=(cache.symptom_pages_tag(user_id),))
+    log_user_activity("Get User Symptoms", 200)
+
+    return versioning.tagged(jsonify({
+        'symptoms': serializers.link_symptoms(page['symptoms'], user_id),
+        'links': pagination.page_links('get_user_symptoms', page['next_cursor'], user_id=user_id)
+    }), etag)
 
 @app.route('/users/<int:user_id>/symptoms/<int:symptom_id>', methods=['GET'])
 def get_symptom(user_id, symptom_id):
-    symptom = Symptom.query.filter_by(userid=user_id, id=symptom_id).first()
+    etag = versioning.etag_for(versioning.user_scope(user_id))
+    not_modified = versioning.not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    symptom, etag = load_symptom_record(user_id, symptom_id)
     if not symptom:
         return jsonify({'message': 'Symptom not found'}), 404
-
-    symptom_dict = {
-        'id': symptom.id,
-        'label': symptom.label,
-        'description': symptom.description,
-        'timestamp': symptom.timestamp.isoformat(),
-        'links': {
-            'self': url_for('get_symptom', user_id=user_id, symptom_id=symptom.id, _external=True),
-            'user': url_for('get_user', user_id=user_id, _external=True),
-            'update': url_for('update_symptom', user_id=user_id, symptom_id=symptom.id, _external=True),
-            'delete': url_for('delete_symptom', user_id=user_id, symptom_id=symptom.id, _external=True)
-        }
+    return versioning.tagged(jsonify(serializers.with_symptom_links(symptom, user_id)), etag)
+
+# GET: Live symptom changes for a user as server-sent events, see events.py
+# EventSource can not set headers, so the token may also be passed as ?jwt=<token>
+@app.route('/users/<int:user_id>/symptoms/events', methods=['GET'])
+@token_auth.required(locations=('headers', 'query_string'))
+def symptom_event_stream(user_id):
+    if g.principal.user_id != user_id:
+        return jsonify({'message': 'Unauthorized access'}), 403
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Keeps nginx from buffering the stream
     }
-    return jsonify(symptom_dict)
+    if request.method == 'HEAD':
+        return Response(mimetype='text/event-stream', headers=headers)  # No body, so no stream is opened
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        events = symptom_events.stream(user_id, last_event_id)
+    except StreamLimitReached as e:
+        return jsonify({'message': str(e)}), 503, {'Retry-After': str(symptom_events.heartbeat_interval)}
+    log_user_activity("Open Symptom Events", 200)
+
+    return Response(events, mimetype='text/event-stream', headers=headers)
 
 # PUT: Update an existing user
 @app.route('/users/<int:user_id>', methods=['PUT'])
@@ -255,29 +366,29 @@ def update_user(user_id):
 
     # Get the data from the request
     data = request.get_json()
+    old_username = user.username
+    # The user's symptoms move to other rollup rows when these change
+    moves_rollups = (data.get('age', user.age), data.get('gender', user.gender),
+                     data.get('location', user.location)) != (user.age, user.gender, user.location)
+    rollups_before = analytics.snapshot(user_id) if moves_rollups else None
     user.username = data.get('username', user.username)
     user.password = data.get('password', user.password)  
     user.age = data.get('age', user.age)
     user.gender = data.get('gender', user.gender)
     user.location = data.get('location', user.location)
+    if moves_rollups:
+        analytics.apply_difference(rollups_before, analytics.snapshot(user_id))
 
+    # Optimistic concurrency: refuse the update if the client's copy is stale
+    precondition_failed = versioning.bump_if_match(versioning.user_scope(user_id))
+    if precondition_failed:
+        return precondition_failed
     db.session.commit()
+    resource_cache.invalidate(cache.user_key(user_id))
+    credentials.forget(old_username, user.username)
     log_user_activity("Update User", 200)
 
-    user_dict = {
-        "id": user.id,
-        "username": user.username,
-        "age": user.age,
-        "gender": user.gender,
-        "location": user.location,
-        "links": {
-            "self": url_for('get_user', user_id=user.id, _external=True),
-            "symptoms": url_for('get_user_symptoms', user_id=user.id, _external=True),
-            "update": url_for('update_user', user_id=user.id, _external=True),
-            "delete": url_for('delete_user', user_id=user.id, _external=True)
-        }
-    }
-
+    user_dict = serializers.serialize_user(user, detail=True)
     return jsonify({'message': 'User updated successfully', 'user': user_dict}), 200
 
 # DELETE: Delete an existing user
@@ -287,209 +398,296 @@ def delete_user(user_id):
     if not user:
         return jsonify({'message': 'User not found'}), 404
 
+    patterns.forget_user(user_id)
+    analytics.forget_user(user_id)
+    precondition_failed = versioning.bump_if_match(versioning.user_scope(user_id))
+    if precondition_failed:
+        return precondition_failed
     db.session.delete(user)
     db.session.commit()
+    resource_cache.invalidate(cache.user_key(user_id))
+    credentials.forget(user.username)
+    resource_cache.invalidate_tags(cache.symptom_pages_tag(user_id), cache.symptom_records_tag(user_id))
     log_user_activity("Delete User", 200)
 
     return jsonify({'message': 'User deleted successfully'}), 200
 
 @app.route('/users/<int:user_id>/symptoms/<int:symptom_id>', methods=['DELETE', 'OPTIONS'])
+@token_auth.required()
 def delete_symptom(user_id, symptom_id):
     if request.method == 'OPTIONS':
         return '', 200  # Allow the OPTIONS request to pass through
 
-    @jwt_required()
-    def inner_delete_symptom():
-        if get_jwt_identity() != user_id:
-            return jsonify({'message': 'Unauthorized access'}), 403
+    if g.principal.user_id != user_id:
+        return jsonify({'message': 'Unauthorized access'}), 403
 
-        symptom = Symptom.query.filter_by(userid=user_id, id=symptom_id).first()
-        if not symptom:
-            log_user_activity("Delete Symptom - Not Found", 404)
-            return jsonify({'message': 'Symptom not found'}), 404
+    symptom = Symptom.query.filter_by(userid=user_id, id=symptom_id).first()
+    if not symptom:
+        log_user_activity("Delete Symptom - Not Found", 404)
+        return jsonify({'message': 'Symptom not found'}), 404
 
-        try:
-            db.session.delete(symptom)
-            db.session.commit()
-       
-            log_user_activity("Delete Symptom", 200)
-            return jsonify({'message': 'Symptom deleted successfully'}), 200
-        except Exception as e:
-            db.session.rollback()
-            return jsonify({'message': str(e)}), 500
+    try:
+        analytics.record_symptom(symptom.user, symptom.label, symptom.timestamp, -1)
+        db.session.delete(symptom)
+        patterns.refresh_user(user_id)
+        precondition_failed = versioning.bump_if_match(versioning.user_scope(user_id))
+        if precondition_failed:
+            return precondition_failed
+        db.session.commit()
+        resource_cache.invalidate(cache.symptom_key(user_id, symptom_id))
+        resource_cache.invalidate_tags(cache.symptom_pages_tag(user_id))
+        symptom_events.publish(user_id, 'symptom.deleted', {'id': symptom_id})
 
-    return inner_delete_symptom()
+        log_user_activity("Delete Symptom", 200)
+        return jsonify({'message': 'Symptom deleted successfully'}), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': str(e)}), 500
 
 @app.route('/users/<int:user_id>/symptoms/<int:symptom_id>', methods=['PUT', 'OPTIONS'])
+@token_auth.required()
 def update_symptom(user_id, symptom_id):
     if request.method == 'OPTIONS':
         return '', 200  # Allow the OPTIONS request to pass through
 
-    @jwt_required()
-    def inner_update_symptom():
-        if get_jwt_identity() != user_id:
-            return jsonify({'message': 'Unauthorized access'}), 403
+    if g.principal.user_id != user_id:
+        return jsonify({'message': 'Unauthorized access'}), 403
 
-        symptom = Symptom.query.filter_by(userid=user_id, id=symptom_id).first()
-        if not symptom:
-            return jsonify({'message': 'Symptom not found'}), 404
+    symptom = Symptom.query.filter_by(userid=user_id, id=symptom_id).first()
+    if not symptom:
+        return jsonify({'message': 'Symptom not found'}), 404
 
-        data = request.get_json()
-        symptom.label = data.get('label', symptom.label)
-        symptom.description = data.get('description', symptom.description)
+    data = request.get_json()
+    old_label = symptom.label
+    symptom.label = data.get('label', symptom.label)
+    symptom.description = data.get('description', symptom.description)
 
-        try:
-            db.session.commit()
-            log_user_activity("Update Symptom", 200)
-
-            symptom_dict = {
-                'id': symptom.id,
-                'label': symptom.label,
-                'description': symptom.description,
-                'timestamp': symptom.timestamp.isoformat(),
-                'links': {
-                    'self': url_for('get_symptom', user_id=user_id, symptom_id=symptom.id, _external=True),
-                    'user': url_for('get_user', user_id=user_id, _external=True),
-                    'update': url_for('update_symptom', user_id=user_id, symptom_id=symptom.id, _external=True),
-                    'delete': url_for('delete_symptom', user_id=user_id, symptom_id=symptom.id, _external=True)
-                }
-            }
-
-            return jsonify({'message': 'Symptom updated successfully', 'symptom': symptom_dict}), 200
-        except Exception as e:
-            db.session.rollback()
-            return jsonify({'message': str(e)}), 500
-
-    return inner_update_symptom()
+    try:
+        if symptom.label != old_label:
+            analytics.record_symptom(symptom.user, old_label, symptom.timestamp, -1)
+            analytics.record_symptom(symptom.user, symptom.label, symptom.timestamp)
+        patterns.refresh_user(user_id)
+        precondition_failed = versioning.bump_if_match(versioning.user_scope(user_id))
+        if precondition_failed:
+            return precondition_failed
+        db.session.commit()
+        resource_cache.invalidate(cache.symptom_key(user_id, symptom_id))
+        resource_cache.invalidate_tags(cache.symptom_pages_tag(user_id))
+        log_user_activity("Update Symptom", 200)
+
+        symptom_dict = serializers.serialize_symptom(symptom, user_id)
+        symptom_events.publish(user_id, 'symptom.updated', symptom_dict)
+        return jsonify({'message': 'Symptom updated successfully', 'symptom': symptom_dict}), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': str(e)}), 500
 
 def log_user_activity(action, status_code):
-    """Logs the user's activity to the ActivityLog table."""
+    """Queues the user's activity for the ActivityLog table, written in batches by activity_writer."""
     try:
-        user_id = get_jwt_identity()  # Get logged-in user ID from JWT
+        user_id = token_auth.current_user_id()  # Set by token_auth on the authenticated routes
         if user_id:
-            new_log = ActivityLog(
-                user_id=user_id,
-                action=action,  
-                endpoint=request.path,  
-                method=request.method,  
-                ip_address=request.remote_addr,  
-                timestamp=datetime.utcnow(),  
-                status_code=status_code  
-            )
-            db.session.add(new_log)
-            db.session.commit()
+            activity_writer.enqueue({
+                'user_id': user_id,
+                'action': action,
+                'endpoint': request.path,
+                'method': request.method,
+                'ip_address': request.remote_addr,
+                'timestamp': datetime.utcnow(),
+                'status_code': status_code
+            })
     except Exception as e:
         # Error handling/logging
-        print(f"Failed to log activity: {str(e)}")
+        app.logger.error(f"Failed to log activity: {str(e)}")
 
 # Shows the activity logs for a specific user
 @app.route('/activity_logs/<int:user_id>', methods=['GET'])
 def get_activity_logs(user_id):
-    """Retrieve activity logs for a specific user without authentication."""
-    logs = ActivityLog.query.filter_by(user_id=user_id).order_by(ActivityLog.timestamp.desc()).all()
+    """Retrieve activity logs for a specific user without authentication, newest first."""
+    try:
+        limit = pagination.page_size()
+        fields = pagination.requested_fields(ACTIVITY_LOG_FIELDS)
+        after = pagination.decode_cursor(request.args.get('cursor'), datetime, int)
+    except pagination.PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+
+    query = queries.activity_logs_page(user_id, fields, after)
 
-    if not logs:
+    # Entries past the hot window are in archive files; both are merged newest first
+    if streaming.wants_stream():
+        def rows():
+            merged = activity_archive.newest_first(
+                query.yield_per(streaming.STREAM_BATCH_SIZE), activity_archiver.user_logs(user_id, after))
+            return itertools.islice(merged, limit) if 'limit' in request.args else merged
+        return streaming.ndjson_response(rows(), lambda log: serializers.record(log, fields))
+
+    logs = query.limit(limit + 1).all()
+    # Archives are read only if they may hold entries for this page
+    since = logs[limit].timestamp if len(logs) > limit else None
+    logs = list(itertools.islice(
+        activity_archive.newest_first(logs, activity_archiver.user_logs(user_id, after, since)), limit + 1))
+
+    if not logs and not after:
         return jsonify({'message': f'No activity logs found for user ID {user_id}'}), 404
 
-    return jsonify([{
-        'action': log.action,
-        'endpoint': log.endpoint,
-        'method': log.method,
-        'ip_address': log.ip_address,
-        'timestamp': log.timestamp.isoformat(),
-        'status_code': log.status_code
-    } for log in logs]), 200
+    next_cursor = None
+    if len(logs) > limit:
+        last = logs[limit - 1]
+        next_cursor = pagination.encode_cursor(last.timestamp.isoformat(), last.id)
+
+    return jsonify({
+        'activity_logs': [serializers.record(log, fields) for log in logs[:limit]],
+        'links': pagination.page_links('get_activity_logs', next_cursor, user_id=user_id)
+    }), 200
+
+# Hit, miss and eviction counters of the resource cache
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(resource_cache.stats()), 200
+
+# Request latency, SQL and cache figures for Prometheus, see metrics.py
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    body = request_metrics.render({
+        'cache': resource_cache.stats(),
+        'activity_log': activity_writer.stats(),
+        'activity_log_archive': activity_archiver.stats(),
+        'auth': token_auth.stats(),
+        'events': {'open_streams': symptom_events.open_streams()},
+    })
+    return Response(body, content_type=PROMETHEUS_CONTENT_TYPE)
+
+# Applies pending schema migrations, e.g. "flask db-upgrade" after deploying a new version
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    applied = migrations.upgrade()
+    print(f"Applied migrations: {', '.join(map(str, applied))}" if applied else "Database is up to date")
+
+# Fails if any route's main query stops using an index, e.g. "flask check-query-plans" in CI
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    problems = query_plans.check()
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(1)
+    print("All route queries use an index")
 
 # Pattern recognition, finds the most common combinations of symptoms
 @app.route('/symptoms/patterns', methods=['GET'])
 def identify_common_symptom_patterns():
-    users = User.query.all()
-    symptom_combinations = []
-
-    for user in users:
-        user_symptoms = Symptom.query.filter_by(userid=user.id).all()
-        symptom_labels = [symptom.label for symptom in user_symptoms]
+    etag = versioning.etag_for(versioning.PATTERNS_SCOPE)
+    not_modified = versioning.not_modified(etag)
+    if not_modified:
+        return not_modified
 
-        if len(symptom_labels) > 1:
-            sorted_labels = tuple(sorted(symptom_labels))
-            symptom_combinations.append(sorted_labels)
-
-    combination_counts = Counter(symptom_combinations)
-    most_common_patterns = combination_counts.most_common(5)
-
-    patterns = []
-    for combo, count in most_common_patterns:
-        patterns.append({
-            'symptoms': list(combo),
-            'count': count
-        })
+    # With any of min_support, max_size or top: frequent combinations, see pattern_mining.py
+    if any(name in request.args for name in ('min_support', 'max_size', 'top')):
+        try:
+            params = pattern_mining.parse_params(request.args)
+            users, found = pattern_mining.miner.mine(**params)
+        except pattern_mining.MiningError as e:
+            return jsonify({'message': str(e)}), 400
+        return versioning.tagged(jsonify({'users': users, **params, 'patterns': found}), etag), 200
+
+    # Served from the pattern index maintained by the symptom write handlers
+    return versioning.tagged(jsonify({'most_common_patterns': patterns.top_patterns(5)}), etag), 200
+
+# Symptom counts over time from the daily rollups, see analytics.py, e.g.
+# /analytics/symptoms?from=2024-01-01&to=2024-12-31&group_by=week,label&location=Oslo
+@app.route('/analytics/symptoms', methods=['GET'])
+def get_symptom_analytics():
+    try:
+        start = analytics.parse_date(request.args.get('from'), 'from')
+        end = analytics.parse_date(request.args.get('to'), 'to')
+        if start and end and start > end:
+            raise analytics.AnalyticsError('from must not be after to')
+        period, dimensions = analytics.parse_group_by(request.args.get('group_by'))
+        filters = {dimension: request.args[dimension] for dimension in analytics.DIMENSIONS
+                   if dimension in request.args}
+        counts = analytics.counts(start, end, period, dimensions, filters, limit=app.config['ANALYTICS_MAX_ROWS'])
+    except analytics.AnalyticsError as e:
+        return jsonify({'message': str(e)}), 400
 
-    return jsonify({'most_common_patterns': patterns}), 200
+    return jsonify({
+        'from': start.isoformat() if start else None,
+        'to': end.isoformat() if end else None,
+        'group_by': ([period] if period else []) + dimensions,
+        'filters': filters,
+        'counts': counts
+    }), 200
+
+# Rebuilds the pattern index from scratch, e.g. "flask rebuild-patterns" after importing data
+@app.cli.command('rebuild-patterns')
+def rebuild_patterns_command():
+    user_count = patterns.rebuild()
+    db.session.commit()
+    print(f"Rebuilt symptom pattern index for {user_count} users")
 
+# Recomputes the /analytics rollups from the symptoms, e.g. after importing data
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    symptom_count = analytics.rebuild()
+    db.session.commit()
+    print(f"Rebuilt symptom rollups from {symptom_count} symptoms")
+
+# Moves activity logs past ACTIVITY_LOG_HOT_DAYS into archive files, as the background compaction does
+@app.cli.command('compact-activity-logs')
+def compact_activity_logs_command():
+    result = activity_archiver.compact()
+    if result is None:
+        print("Another process is compacting the activity logs")
+        raise SystemExit(1)
+    print(f"Archived {result['archived']} activity log entries in {result['archives_written']} files, "
+          f"purged {result['purged']} archived entries")
+
+# Replaces all users and symptoms with generated ones, e.g. /fill_database?users=10000&seed=42
+# Optional: min_symptoms and max_symptoms per user, and a distribution config as JSON (see seeding.py)
 @app.route('/fill_database', methods=['GET'])
 def fill_database():
     try:
-        # Delete previous data to avoid duplicates
-        db.session.query(Symptom).delete()
-        db.session.query(User).delete()
-        db.session.commit()
-
-        # Define some possible usernames, locations, symptoms, and genders
-        male_names = ['Bob', 'Charlie', 'David', 'Frank', 'Hank', 'Jack', 'Leo', 'Oscar', 'Paul', 'Quinn', 'Steve', 'Victor', 'Xander', 'Zack', 'Oliver', 'Liam', 'Noah', 'Lucas', 'Ethan', 'James', 'Benjamin', 'Alexander', 'William', 'Henry', 'Sebastian']
-        female_names = ['Alice', 'Eva', 'Grace', 'Ivy', 'Karen', 'Mona', 'Nina', 'Rachel', 'Tina', 'Uma', 'Wendy', 'Yara', 'Sophia', 'Emma', 'Ava', 'Mia', 'Amelia', 'Isabella', 'Harper', 'Evelyn', 'Abigail', 'Emily', 'Ella', 'Chloe']
-        locations = ['Oslo', 'Bergen', 'Trondheim', 'Stavanger', 'Kristiansand', 'Drammen', 'Tromsø', 'Bodø']
-        genders = ['M', 'F']
-        symptom_labels = [
-            'fever', 'cough', 'headache', 'fatigue', 'sore throat', 'muscle pain', 'nausea', 'shortness of breath',
-            'runny nose', 'loss of taste', 'loss of smell', 'diarrhea'
-        ]
-
-        # Add 100 test users with random attributes
-        users = []
-        for i in range(100):
-            gender = random.choice(genders)
-            if gender == 'M':
-                username = f"{random.choice(male_names)}_{i}"
-            else:
-                username = f"{random.choice(female_names)}_{i}"
-
-            user = User(
-                username=username,
-                password=generate_password_hash('password123'),
-                age=random.randint(18, 65),
-                gender=gender,
-                location=random.choice(locations)
-            )
-            users.append(user)
-
-        # Add users to the database
-        db.session.add_all(users)
-        db.session.commit()
-
-        # Add symptoms for each user
-        symptoms = []
-        for user in users:
-            num_symptoms = random.randint(1, 3)
-            user_symptom_labels = random.sample(symptom_labels, num_symptoms)
-
-            for index, label in enumerate(user_symptom_labels):
-                description = f'{label} experienced by {user.username} on day {index + 1}'
-                symptom = Symptom(
-                    userid=user.id,
-                    label=label,
-                    description=description
-                )
-                symptoms.append(symptom)
-
-        # Add symptoms to the database
-        db.session.add_all(symptoms)
-        db.session.commit()
+        user_count = int(request.args.get('users', 100))
+        rng_seed = int(request.args['seed']) if 'seed' in request.args else None
+        config = seeding.with_symptom_range(
+            json.loads(request.args.get('distribution', '{}')),
+            request.args.get('min_symptoms', type=int), request.args.get('max_symptoms', type=int))
+    except ValueError as e:
+        return jsonify({'message': f'Invalid seeding parameters: {e}'}), 400
+    if not 0 <= user_count <= app.config['FILL_DATABASE_MAX_USERS']:
+        return jsonify({'message': f"users must be between 0 and {app.config['FILL_DATABASE_MAX_USERS']}"}), 400
 
-        return jsonify({'message': 'Database filled with 100 users and sample data successfully!'}), 201
+    try:
+        # Delete previous data to avoid duplicates, in the same transaction as the new data
+        counts = seeding.seed(user_count, config, rng_seed, replace=True)
+        return jsonify({
+            'message': f'Database filled with {user_count} users and sample data successfully!',
+            'counts': counts
+        }), 201
 
+    except seeding.DistributionError as e:
+        return jsonify({'message': f'Invalid seeding parameters: {e}'}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': str(e)}), 500
 
+# Generates users and symptoms for capacity testing, e.g. "flask seed --users 1000000 --seed 42"
+@app.cli.command('seed')
+@click.option('--users', default=100, show_default=True, help='Number of users to generate.')
+@click.option('--min-symptoms', type=int, help='Fewest symptoms per user.')
+@click.option('--max-symptoms', type=int, help='Most symptoms per user.')
+@click.option('--seed', 'rng_seed', type=int, help='Random seed, for the same data on every run.')
+@click.option('--distribution', type=click.File(), help='JSON file with a distribution config, see seeding.py.')
+@click.option('--replace', is_flag=True, help='Delete the existing users, symptoms and activity logs first.')
+def seed_command(users, min_symptoms, max_symptoms, rng_seed, distribution, replace):
+    started = time.perf_counter()
+    try:
+        config = seeding.with_symptom_range(
+            json.load(distribution) if distribution else {}, min_symptoms, max_symptoms)
+        counts = seeding.seed(users, config, rng_seed, replace=replace)
+    except (json.JSONDecodeError, seeding.DistributionError) as e:
+        raise click.BadParameter(str(e), param_hint='--distribution')
+    print(f"Seeded {counts['users']} users, {counts['symptoms']} symptoms and "
+          f"{counts['activity_logs']} activity logs in {time.perf_counter() - started:.1f}s")
+
 if __name__ == '__main__':
     app.run(debug=True)
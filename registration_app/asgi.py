@@ -0,0 +1,66 @@
+"""ASGI entry point for the API.
+
+    pip install a2wsgi uvicorn
+    uvicorn asgi:application --port 5000
+
+Every route is still the Flask view in app.py, with the same JSON
+contract. The ASGI server owns the sockets on an event loop. A request
+reaches a thread from a pool of ASGI_THREADS only once its whole body has
+arrived. A slow client, or an idle keep-alive connection, therefore costs
+a socket and some memory rather than a thread. The WSGI adapter is
+a2wsgi's, which runs the views on a bounded thread pool.
+
+Compare this with the WSGI mode using
+"python benchmark.py --drivers wsgi asgi --slow-clients 500".
+"""
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError as e:
+    raise ImportError('The ASGI mode needs a2wsgi and an ASGI server: pip install a2wsgi uvicorn') from e
+
+from app import app
+
+
+class BufferedWSGIMiddleware:
+    """a2wsgi's WSGIMiddleware on a pool of max_threads threads, entered once the request body has arrived."""
+
+    def __init__(self, wsgi_application, max_threads):
+        self.wsgi = WSGIMiddleware(wsgi_application, workers=max_threads)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            await self.wsgi(scope, receive, send)
+            return
+
+        # a2wsgi reads the body from the view's thread; read it here first so a slow upload holds no thread
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        buffered = [{'type': 'http.request', 'body': b''.join(chunks), 'more_body': False}]
+
+        async def replay():
+            return buffered.pop() if buffered else await receive()
+
+        await self.wsgi(scope, replay, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # The server has stopped taking requests; let the running views finish
+                self.wsgi.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = BufferedWSGIMiddleware(app, app.config['ASGI_THREADS'])
@@ -0,0 +1,210 @@
+"""Token verification for the JWT-protected routes, with a verified-claims cache.
+
+@token_auth.required() takes the place of flask_jwt_extended's
+@jwt_required(). The first request with a token decodes it and checks its
+signature and expiry as flask_jwt_extended would. The verified claims are
+then kept in an LRU of AUTH_CLAIMS_CACHE_SIZE tokens, keyed by the
+token's SHA-256, until the token expires. Later requests with the same
+token cost a hash and two dict lookups. The caller is available to the
+view as g.principal.
+
+Logging out revokes the token's jti. Revoked jtis are stored in the
+revoked_tokens table, and each process keeps them in a dict until the
+token would have expired anyway. Other processes read new revocations
+every AUTH_REVOCATION_REFRESH_INTERVAL seconds.
+
+Failures raise flask_jwt_extended's own exceptions, so clients get the
+same 401 and 422 responses as before.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import g, request
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.config import config as jwt_config
+from flask_jwt_extended.exceptions import InvalidHeaderError, NoAuthorizationError, RevokedTokenError, WrongTokenError
+from jwt import ExpiredSignatureError, get_unverified_header
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from models import db, RevokedToken
+
+LOCATIONS = ('headers', 'query_string')
+
+# The authenticated caller; expires_at is a Unix time, or None for tokens without an expiry
+Principal = namedtuple('Principal', ('user_id', 'jti', 'expires_at', 'claims'))
+
+
+class TokenAuth:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._claims = OrderedDict()  # SHA-256 of the token -> Principal
+        self._revoked = {}  # jti -> Unix time after which the token is rejected anyway
+        self._last_revocation_id = 0
+        self._next_refresh = 0.0
+        self._counters = {'hits': 0, 'misses': 0, 'rejected': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AUTH_CLAIMS_CACHE_SIZE', 10000)
+        app.config.setdefault('AUTH_REVOCATION_REFRESH_INTERVAL', 5)  # Seconds
+
+        self.app = app
+        app.extensions['token_auth'] = self
+
+    def required(self, locations=('headers',)):
+        """Decorator for views that need a valid token, looked for in the given locations."""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method not in jwt_config.exempt_methods:
+                    self.authenticate(locations)
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def authenticate(self, locations=('headers',), optional=False):
+        """Verifies the request's token and sets g.principal. Returns the Principal.
+
+        With optional=True, a request without a token gets None instead of NoAuthorizationError.
+        """
+        token = _find_token(locations)
+        if token is None:
+            if optional:
+                return None
+            if tuple(locations) == ('headers',):
+                raise NoAuthorizationError(f'Missing {jwt_config.header_name} Header')
+            raise NoAuthorizationError(f"Missing JWT in {' or '.join(locations)}")
+
+        self._refresh_revocations()
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            principal = self._claims.get(key)
+            if principal is not None:
+                self._claims.move_to_end(key)
+        if principal is None:
+            self._count('misses')
+            principal = self._verify(key, token)
+        else:
+            self._count('hits')
+            if principal.expires_at is not None and principal.expires_at <= time.time():
+                self._forget(key)
+                self._count('rejected')
+                error = ExpiredSignatureError('Signature has expired')
+                # flask_jwt_extended's error handler reads these, as set by decode_token()
+                error.jwt_header, error.jwt_data = get_unverified_header(token), principal.claims
+                raise error
+        if principal.jti in self._revoked:
+            self._count('rejected')
+            raise RevokedTokenError(get_unverified_header(token), principal.claims)
+        g.principal = principal
+        return principal
+
+    def current_user_id(self):
+        """The id of the request's authenticated caller, or None."""
+        principal = g.get('principal')
+        return principal.user_id if principal is not None else None
+
+    def revoke(self, principal):
+        """Rejects the principal's token from now on, here at once and in other processes within the refresh interval."""
+        expires_at = (datetime.fromtimestamp(principal.expires_at, timezone.utc).replace(tzinfo=None)
+                      if principal.expires_at is not None else None)
+        try:
+            db.session.execute(insert(RevokedToken).values(
+                jti=principal.jti, expires_at=expires_at, revoked_at=datetime.utcnow()))
+            # Revocations of tokens that have expired since are of no use any more
+            db.session.execute(delete(RevokedToken).where(RevokedToken.expires_at < datetime.utcnow()))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # Revoked by another process that has not been refreshed from yet
+        with self._lock:
+            self._revoked[principal.jti] = principal.expires_at
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['cached'] = len(self._claims)
+            stats['revoked'] = len(self._revoked)
+        return stats
+
+    def _verify(self, key, token):
+        try:
+            claims = decode_token(token)
+        except Exception:
+            self._count('rejected')
+            raise
+        if claims.get('type', 'access') != 'access':
+            self._count('rejected')
+            raise WrongTokenError('Only non-refresh tokens are allowed')
+        principal = Principal(claims[jwt_config.identity_claim_key], claims.get('jti'), claims.get('exp'), claims)
+        with self._lock:
+            self._claims[key] = principal
+            while len(self._claims) > self.app.config['AUTH_CLAIMS_CACHE_SIZE']:
+                self._claims.popitem(last=False)
+        return principal
+
+    def _forget(self, key):
+        with self._lock:
+            self._claims.pop(key, None)
+
+    def _refresh_revocations(self):
+        now = time.monotonic()
+        if now < self._next_refresh:
+            return
+        with self._lock:
+            if now < self._next_refresh:
+                return
+            self._next_refresh = now + self.app.config['AUTH_REVOCATION_REFRESH_INTERVAL']
+            last_id = self._last_revocation_id
+        rows = db.session.execute(
+            select(RevokedToken.id, RevokedToken.jti, RevokedToken.expires_at)
+            .where(RevokedToken.id > last_id)
+            .order_by(RevokedToken.id)).all()
+        wall_clock = time.time()
+        with self._lock:
+            for row in rows:
+                expires_at = (row.expires_at.replace(tzinfo=timezone.utc).timestamp()
+                              if row.expires_at is not None else None)
+                self._revoked[row.jti] = expires_at
+                self._last_revocation_id = max(self._last_revocation_id, row.id)
+            # Expired tokens fail on their expiry, so their jtis need not be kept
+            for jti, expires_at in list(self._revoked.items()):
+                if expires_at is not None and expires_at <= wall_clock:
+                    del self._revoked[jti]
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+
+def _find_token(locations):
+    for location in locations:
+        if location not in LOCATIONS:
+            raise ValueError(f"Token locations must be among {', '.join(LOCATIONS)}")
+        if location == 'headers':
+            header = request.headers.get(jwt_config.header_name, '').strip()
+            if not header:
+                continue
+            parts = header.split()
+            if jwt_config.header_type:
+                if len(parts) != 2 or parts[0] != jwt_config.header_type:
+                    raise InvalidHeaderError(f"Bad {jwt_config.header_name} header. "
+                                             f"Expected '{jwt_config.header_name}: {jwt_config.header_type} <JWT>'")
+                return parts[1]
+            if len(parts) != 1:
+                raise InvalidHeaderError(f"Bad {jwt_config.header_name} header. "
+                                         f"Expected '{jwt_config.header_name}: <JWT>'")
+            return parts[0]
+        token = request.args.get(jwt_config.query_string_name)
+        if token:
+            return token
+    return None
+
+
+token_auth = TokenAuth()
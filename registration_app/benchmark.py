@@ -0,0 +1,585 @@
+"""Load test and micro-benchmark for the routes.
+
+Run from this directory, e.g.
+
+    python benchmark.py --users 1000 --requests 500 --concurrency 4 --output before.json
+    python benchmark.py --users 3000000 --routes get_users get_user_symptoms --drivers wsgi
+    python benchmark.py --drivers wsgi asgi --concurrency 32 --slow-clients 500
+    python benchmark.py --compare before.json after.json
+
+Each run seeds a new SQLite database in a temporary directory through the
+bulk path in seeding.py, so the app's own database is never touched. With
+the default 1 to 3 symptoms per user, --users 300 gives about 10^3 rows
+and --users 3000000 about 10^7. The routes are then driven through the
+Flask test client ("client"), a local threaded WSGI server ("wsgi") or
+uvicorn serving asgi.py ("asgi", needs a2wsgi and uvicorn) at the given
+concurrency. The report holds p50/p95/p99 latency, throughput and peak
+RSS for every route and driver. It is written as JSON so two runs, e.g.
+from two commits, can be compared with --compare.
+
+--slow-clients N keeps N extra connections open during the measurement.
+Each has sent a request head but not its body. This shows how the WSGI
+and ASGI modes hold up with many slow or idle clients; the report records
+the server's thread count alongside.
+
+/fill_database is left out because it replaces the seeded data.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+DRIVERS = ('client', 'wsgi', 'asgi')
+SAMPLE_USERS = 200
+BATCH_SIZE = 100
+
+
+def peak_rss_kib():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # macOS reports bytes, Linux KiB
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Fixture:
+    """The seeded data the scenarios draw their requests from."""
+
+    def __init__(self, app, rng):
+        from flask_jwt_extended import create_access_token
+        from models import db, User, Symptom
+
+        self.app = app
+        self.rng = rng
+        self.counter = itertools.count()
+        with app.app_context():
+            user_ids = db.session.scalars(db.select(User.id).order_by(User.id)).all()
+            self.first_user_id, self.last_user_id = user_ids[0], user_ids[-1]
+            sample = rng.sample(user_ids, min(SAMPLE_USERS, len(user_ids)))
+            users = db.session.execute(db.select(User.id, User.username).where(User.id.in_(sample))).all()
+            self.usernames = {user.id: user.username for user in users}
+            self.tokens = {user.id: create_access_token(identity=user.id) for user in users}
+            self.symptom_ids = {}
+            for symptom in db.session.execute(
+                    db.select(Symptom.id, Symptom.userid).where(Symptom.userid.in_(sample))):
+                self.symptom_ids.setdefault(symptom.userid, []).append(symptom.id)
+        self.user_ids = sorted(self.usernames)
+        self.users_with_symptoms = sorted(self.symptom_ids)
+
+    def user(self):
+        return self.rng.choice(self.user_ids)
+
+    def user_with_symptom(self):
+        user_id = self.rng.choice(self.users_with_symptoms)
+        return user_id, self.rng.choice(self.symptom_ids[user_id])
+
+    def auth(self, user_id):
+        return {'Authorization': f'Bearer {self.tokens[user_id]}'}
+
+    def unique(self):
+        return next(self.counter)
+
+    def disposable_users(self, count):
+        """Inserts users only the delete scenarios use, returning their ids."""
+        from models import db, User
+        with self.app.app_context():
+            ids = db.session.scalars(db.insert(User).returning(User.id), [
+                {'username': f'benchmark_disposable_{self.unique()}', 'password': '-'} for _ in range(count)
+            ]).all()
+            db.session.commit()
+        return ids
+
+    def disposable_symptoms(self, count):
+        """Inserts symptoms only the delete scenarios use, returning (user id, symptom id) pairs."""
+        from models import db, Symptom
+        rows = []
+        for _ in range(count):
+            rows.append({'userid': self.user(), 'label': 'fever',
+                         'description': f'benchmark disposable symptom {self.unique()}'})
+        with self.app.app_context():
+            symptoms = db.session.execute(
+                db.insert(Symptom).returning(Symptom.userid, Symptom.id, sort_by_parameter_order=True), rows).all()
+            db.session.commit()
+        return [tuple(symptom) for symptom in symptoms]
+
+
+def _json(method, path, payload, headers=None):
+    return method, path, {'Content-Type': 'application/json', **(headers or {})}, json.dumps(payload).encode()
+
+
+def _get(path, headers=None):
+    return 'GET', path, headers or {}, None
+
+
+def scenarios():
+    """Route name -> function(fixture, count) returning `count` requests as (method, path, headers, body)."""
+    def get_users(fixture, count):
+        from pagination import encode_cursor
+        requests = []
+        for _ in range(count):
+            after = fixture.rng.randint(fixture.first_user_id, fixture.last_user_id)
+            requests.append(_get(f'/get_users?limit=100&cursor={encode_cursor(after)}'))
+        return requests
+
+    def get_users_compact(fixture, count):
+        from pagination import encode_cursor
+        requests = []
+        for _ in range(count):
+            after = fixture.rng.randint(fixture.first_user_id, fixture.last_user_id)
+            requests.append(_get(f'/get_users?limit=100&links=minimal&cursor={encode_cursor(after)}',
+                                 {'Accept-Encoding': 'gzip'}))
+        return requests
+
+    def get_users_stream(fixture, count):
+        return [_get('/get_users?stream=1&limit=1000') for _ in range(count)]
+
+    def get_user(fixture, count):
+        return [_get(f'/users/{fixture.user()}') for _ in range(count)]
+
+    def login(fixture, count):
+        requests = []
+        for _ in range(count):
+            username = fixture.usernames[fixture.user()]
+            requests.append(_json('POST', '/auth/login', {'username': username, 'password': 'password123'}))
+        return requests
+
+    def register(fixture, count):
+        return [_json('POST', '/auth/register', {
+            'username': f'benchmark_user_{fixture.unique()}', 'password': 'password123',
+            'age': 30, 'gender': 'F', 'location': 'Oslo'}) for _ in range(count)]
+
+    def add_user(fixture, count):
+        return [_json('POST', '/create_user', {
+            'username': f'benchmark_user_{fixture.unique()}', 'password': 'password123'}) for _ in range(count)]
+
+    def get_user_symptoms(fixture, count):
+        requests = []
+        for _ in range(count):
+            user_id, _symptom_id = fixture.user_with_symptom()
+            requests.append(_get(f'/users/{user_id}/symptoms', fixture.auth(user_id)))
+        return requests
+
+    def get_user_symptoms_compact(fixture, count):
+        requests = []
+        for _ in range(count):
+            user_id, _symptom_id = fixture.user_with_symptom()
+            requests.append(_get(f'/users/{user_id}/symptoms?links=minimal',
+                                 {**fixture.auth(user_id), 'Accept-Encoding': 'gzip'}))
+        return requests
+
+    def get_symptom(fixture, count):
+        return [_get('/users/{}/symptoms/{}'.format(*fixture.user_with_symptom())) for _ in range(count)]
+
+    def add_symptom(fixture, count):
+        requests = []
+        for _ in range(count):
+            user_id = fixture.user()
+            requests.append(_json('POST', f'/users/{user_id}/symptoms', {
+                'label': 'cough', 'description': f'benchmark symptom {fixture.unique()}'}, fixture.auth(user_id)))
+        return requests
+
+    def add_symptoms_batch(fixture, count):
+        requests = []
+        for _ in range(count):
+            items = [{'label': 'headache', 'description': f'benchmark batch symptom {fixture.unique()}'}
+                     for _ in range(BATCH_SIZE)]
+            requests.append(_json('POST', f'/users/{fixture.user()}/symptoms:batch', items))
+        return requests
+
+    def update_symptom(fixture, count):
+        requests = []
+        for _ in range(count):
+            user_id, symptom_id = fixture.user_with_symptom()
+            requests.append(_json('PUT', f'/users/{user_id}/symptoms/{symptom_id}',
+                                  {'label': fixture.rng.choice(['fever', 'cough'])}, fixture.auth(user_id)))
+        return requests
+
+    def delete_symptom(fixture, count):
+        requests = []
+        for user_id, symptom_id in fixture.disposable_symptoms(count):
+            requests.append(('DELETE', f'/users/{user_id}/symptoms/{symptom_id}', fixture.auth(user_id), None))
+        return requests
+
+    def update_user(fixture, count):
+        return [_json('PUT', f'/users/{fixture.user()}', {'age': fixture.rng.randint(18, 65)})
+                for _ in range(count)]
+
+    def delete_user(fixture, count):
+        return [('DELETE', f'/users/{user_id}', {}, None) for user_id in fixture.disposable_users(count)]
+
+    def get_activity_logs(fixture, count):
+        return [_get(f'/activity_logs/{fixture.user()}?limit=100') for _ in range(count)]
+
+    def identify_common_symptom_patterns(fixture, count):
+        return [_get('/symptoms/patterns') for _ in range(count)]
+
+    def mine_symptom_patterns(fixture, count):
+        return [_get(f'/symptoms/patterns?min_support={fixture.rng.choice(["0.01", "0.05"])}&max_size=3&top=20')
+                for _ in range(count)]
+
+    def get_symptom_analytics(fixture, count):
+        queries = ['group_by=week,label', 'group_by=month,location&label=cough', 'group_by=age_band,label',
+                   'group_by=day&gender=F']
+        return [_get(f'/analytics/symptoms?{fixture.rng.choice(queries)}') for _ in range(count)]
+
+    def get_cache_stats(fixture, count):
+        return [_get('/cache/stats') for _ in range(count)]
+
+    def get_metrics(fixture, count):
+        return [_get('/metrics') for _ in range(count)]
+
+    # Reads run before the writes that change what they read
+    return {
+        'get_users': get_users,
+        'get_users (compact)': get_users_compact,
+        'get_users (stream)': get_users_stream,
+        'get_user': get_user,
+        'get_user_symptoms': get_user_symptoms,
+        'get_user_symptoms (compact)': get_user_symptoms_compact,
+        'get_symptom': get_symptom,
+        'get_activity_logs': get_activity_logs,
+        'identify_common_symptom_patterns': identify_common_symptom_patterns,
+        'identify_common_symptom_patterns (mining)': mine_symptom_patterns,
+        'get_symptom_analytics': get_symptom_analytics,
+        'get_cache_stats': get_cache_stats,
+        'get_metrics': get_metrics,
+        'login': login,
+        'register': register,
+        'add_user': add_user,
+        'add_symptom': add_symptom,
+        'add_symptoms_batch': add_symptoms_batch,
+        'update_symptom': update_symptom,
+        'update_user': update_user,
+        'delete_symptom': delete_symptom,
+        'delete_user': delete_user,
+    }
+
+
+class ClientDriver:
+    """Calls the app in-process through the Flask test client, one client per thread."""
+    name = 'client'
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def send(self, method, path, headers, body):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, headers=headers, data=body)
+        response.get_data()  # Drains streamed responses
+        return response.status_code
+
+
+class WsgiDriver:
+    """Sends real HTTP requests to the app served by a local threaded werkzeug server."""
+    name = 'wsgi'
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+        self.server = None
+        self.port = None
+
+    def __enter__(self):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietRequestHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server('127.0.0.1', 0, self.app, threaded=True, request_handler=QuietRequestHandler)
+        self.port = self.server.port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send(self, method, path, headers, body):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            raise
+        return response.status
+
+
+class AsgiDriver(WsgiDriver):
+    """Sends real HTTP requests to the app served through asgi.py by uvicorn."""
+    name = 'asgi'
+
+    def __enter__(self):
+        import uvicorn
+        from asgi import BufferedWSGIMiddleware
+
+        application = BufferedWSGIMiddleware(self.app, self.app.config['ASGI_THREADS'])
+        self.server = uvicorn.Server(uvicorn.Config(
+            application, host='127.0.0.1', port=0, log_level='warning', lifespan='on', backlog=4096))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        self.port = self.server.servers[0].sockets[0].getsockname()[1]
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+DRIVER_CLASSES = (ClientDriver, WsgiDriver, AsgiDriver)
+
+
+class SlowClients:
+    """Connections that have sent a request head and then stall before the body."""
+
+    def __init__(self, port, count):
+        self.port = port
+        self.count = count
+        self.sockets = []
+
+    def __enter__(self):
+        head = (f'POST /auth/login HTTP/1.1\r\nHost: 127.0.0.1:{self.port}\r\n'
+                'Content-Type: application/json\r\nContent-Length: 1000\r\n\r\n{').encode()
+        for _ in range(self.count):
+            connection = socket.create_connection(('127.0.0.1', self.port))
+            connection.sendall(head)
+            self.sockets.append(connection)
+        time.sleep(0.2)  # Lets the server pick them up
+        return self
+
+    def __exit__(self, *exc_info):
+        for connection in self.sockets:
+            connection.close()
+        self.sockets = []
+
+
+def measure(driver, requests, concurrency):
+    """Sends the requests with `concurrency` threads and returns the latency and status summary."""
+    latencies = []
+    statuses = {}
+    failures = []
+    lock = threading.Lock()
+
+    def send(request):
+        started = time.perf_counter()
+        try:
+            status = driver.send(*request)
+        except Exception as e:
+            with lock:
+                failures.append(repr(e))
+            return
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, requests))
+    wall_time = time.perf_counter() - started
+
+    latencies.sort()
+    errors = len(failures) + sum(count for status, count in statuses.items() if status >= 400)
+    result = {
+        'requests': len(requests),
+        'errors': errors,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'wall_time_s': round(wall_time, 4),
+        'throughput_rps': round(len(requests) / wall_time, 2) if wall_time else None,
+    }
+    for name, percent in (('p50', 50), ('p95', 95), ('p99', 99)):
+        value = percentile(latencies, percent)
+        result[f'{name}_ms'] = round(value * 1000, 3) if value is not None else None
+    result['mean_ms'] = round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None
+    result['peak_rss_kib'] = peak_rss_kib()
+    if failures:
+        result['failures'] = failures[:5]
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    # The settings must be in place before app.py is imported, since importing it sets up the database
+    workdir = tempfile.mkdtemp(prefix='registration_app_benchmark_')
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'benchmark.db')
+    os.environ['FLASK_CACHE_BACKEND'] = args.cache
+    if not args.rate_limits:
+        # Every request comes from the same address, so the login limits would only measure themselves
+        os.environ['FLASK_LOGIN_RATE_LIMIT_PER_IP'] = 'null'
+        os.environ['FLASK_LOGIN_RATE_LIMIT_PER_USER'] = 'null'
+    os.environ['FLASK_ACTIVITY_LOG_SPILL_PATH'] = os.path.join(workdir, 'activity_log_spill.ndjson')
+
+    from app import app
+    from activity_log import activity_writer
+    from cache import resource_cache
+    import seeding
+
+    started = time.perf_counter()
+    with app.app_context():
+        counts = seeding.seed(args.users, {
+            'symptoms_per_user': args.symptoms_per_user,
+            'activity_logs_per_user': args.activity_logs_per_user,
+            'history_days': args.history_days,
+        }, rng_seed=args.seed)
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': app.config['SQLALCHEMY_DATABASE_URI'],
+            'arguments': vars(args),
+        },
+        'seed': {**counts, 'seconds': round(time.perf_counter() - started, 3), 'peak_rss_kib': peak_rss_kib()},
+        'routes': {},
+    }
+
+    rng = random.Random(args.seed)
+    fixture = Fixture(app, rng)
+    available = scenarios()
+    for route in args.routes or available:
+        build = available[route]
+        for driver_class in DRIVER_CLASSES:
+            if driver_class.name not in args.drivers:
+                continue
+            with driver_class(app) as driver:
+                measure(driver, build(fixture, args.warmup), args.concurrency)
+                if args.slow_clients and driver.name != 'client':
+                    with SlowClients(driver.port, args.slow_clients):
+                        result = measure(driver, build(fixture, args.requests), args.concurrency)
+                        result['threads'] = threading.active_count()
+                else:
+                    result = measure(driver, build(fixture, args.requests), args.concurrency)
+                    result['threads'] = threading.active_count()
+            report['routes'].setdefault(route, {})[driver_class.name] = result
+            print(f"{route:<36} {driver_class.name:<7} p50 {result['p50_ms']} ms  p95 {result['p95_ms']} ms  "
+                  f"p99 {result['p99_ms']} ms  {result['throughput_rps']} req/s  errors {result['errors']}",
+                  file=sys.stderr)
+
+    activity_writer.flush()
+    report['activity_log_writer'] = activity_writer.stats()
+    report['cache'] = resource_cache.stats()
+    report['peak_rss_kib'] = peak_rss_kib()
+    return report
+
+
+def compare(baseline_path, candidate_path, threshold):
+    """Prints the change per route and driver; returns 1 if any p95 got worse by more than threshold percent."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+
+    regressed = False
+    print(f"{'route':<36} {'driver':<7} {'p50':>9} {'p95':>9} {'p99':>9} {'throughput':>11}")
+    for route, drivers in candidate['routes'].items():
+        for driver, result in drivers.items():
+            before = baseline['routes'].get(route, {}).get(driver)
+            if not before:
+                continue
+            changes = []
+            for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps'):
+                if before[key] and result[key] is not None:
+                    changes.append((result[key] - before[key]) / before[key] * 100)
+                else:
+                    changes.append(None)
+            if changes[1] is not None and changes[1] > threshold:
+                regressed = True
+            print(f'{route:<36} {driver:<7} ' + ' '.join(
+                f'{change:>+8.1f}%' if change is not None else f"{'-':>9}" for change in changes[:3])
+                + (f'{changes[3]:>+10.1f}%' if changes[3] is not None else f"{'-':>11}"))
+    return 1 if regressed else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Seed a temporary database and benchmark every route.')
+    parser.add_argument('--users', type=int, default=1000, help='Users to seed (default: 1000)')
+    parser.add_argument('--symptoms-per-user', type=int, nargs=2, default=[1, 3], metavar=('MIN', 'MAX'),
+                        help='Range of symptoms per seeded user (default: 1 3)')
+    parser.add_argument('--activity-logs-per-user', type=int, default=5,
+                        help='Activity log entries per seeded user (default: 5)')
+    parser.add_argument('--history-days', type=int, default=730,
+                        help='Days over which symptom timestamps are spread, for the analytics routes (default: 730)')
+    parser.add_argument('--requests', type=int, default=200, help='Measured requests per route and driver')
+    parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests sent first')
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent client threads')
+    parser.add_argument('--drivers', nargs='+', choices=DRIVERS, default=['client', 'wsgi'],
+                        help='How requests reach the app (default: client wsgi; asgi needs a2wsgi and uvicorn)')
+    parser.add_argument('--slow-clients', type=int, default=0,
+                        help='Stalled connections held open against the wsgi and asgi servers while measuring')
+    parser.add_argument('--routes', nargs='+', choices=list(scenarios()), metavar='ROUTE',
+                        help='Routes to benchmark (default: all)')
+    parser.add_argument('--cache', choices=('memory', 'redis', 'null'), default='memory',
+                        help='CACHE_BACKEND to run with (default: memory)')
+    parser.add_argument('--rate-limits', action='store_true', help='Keep the login rate limits on')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the data and the requests')
+    parser.add_argument('--output', help='Write the JSON report here instead of to stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'),
+                        help='Compare two reports instead of running')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='With --compare, exit with 1 if a p95 got worse by more than this percent')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        return compare(*args.compare, args.threshold)
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
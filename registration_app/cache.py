@@ -0,0 +1,286 @@
+"""Read-through cache for user and symptom resources.
+
+Handlers load records through resource_cache.get_or_load() and the write
+handlers drop exactly the keys and tags they affect. Two backends are
+available, chosen with CACHE_BACKEND:
+
+    memory  in-process LRU with a TTL per entry (the default)
+    redis   any Redis-compatible server at CACHE_REDIS_URL, shared by all workers
+    null    caching disabled
+
+Only JSON-compatible values are cached, so both backends behave the same.
+
+Every invalidation advances the backend's generation. get_or_load() reads
+it before calling the loader and only stores the result if it has not
+moved, so a load that raced a write cannot put the old record back after
+the write's invalidation.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_entries=10000, default_ttl=300):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._tags = {}  # tag -> set of keys
+        self._key_tags = {}  # key -> tags
+        self._generation = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def generation(self):
+        return self._generation
+
+    def set(self, key, value, ttl=None, tags=(), generation=None):
+        expires_at = time.monotonic() + (ttl or self.default_ttl)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at)
+            if tags:
+                self._key_tags[key] = tags
+                for tag in tags:
+                    self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+
+    def delete_tags(self, *tags):
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._tags.clear()
+            self._key_tags.clear()
+
+    def stats(self):
+        return {'entries': len(self._entries), 'evictions': self.evictions, 'expirations': self.expirations}
+
+    def _remove(self, key):
+        del self._entries[key]
+        for tag in self._key_tags.pop(key, ()):
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisCache:
+    def __init__(self, url, prefix='registration_app:', default_ttl=300):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('CACHE_BACKEND "redis" needs the redis package (pip install redis)')
+        self._client = redis.Redis.from_url(url)
+        self._watch_error = redis.WatchError
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+
+    def get(self, key):
+        raw = self._client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def generation(self):
+        return int(self._client.get(self._generation_key()) or 0)
+
+    def set(self, key, value, ttl=None, tags=(), generation=None):
+        ttl = ttl or self.default_ttl
+        with self._client.pipeline() as pipe:
+            try:
+                if generation is not None:
+                    # Invalidations in any worker between the check and the write abort it
+                    pipe.watch(self._generation_key())
+                    if int(pipe.get(self._generation_key()) or 0) != generation:
+                        return False
+                    pipe.multi()
+                pipe.set(self.prefix + key, json.dumps(value), ex=ttl)
+                for tag in tags:
+                    tag_key = self.prefix + 'tag:' + tag
+                    pipe.sadd(tag_key, key)
+                    pipe.expire(tag_key, ttl)
+                pipe.execute()
+            except self._watch_error:
+                return False
+        return True
+
+    def delete(self, *keys):
+        if keys:
+            self._client.incr(self._generation_key())
+            self._client.delete(*[self.prefix + key for key in keys])
+
+    def delete_tags(self, *tags):
+        self._client.incr(self._generation_key())
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = [key.decode() for key in self._client.smembers(tag_key)]
+            self._client.delete(tag_key, *[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self._client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self._client.delete(*keys)
+
+    def stats(self):
+        info = self._client.info('stats')
+        return {'evictions': info.get('evicted_keys', 0), 'expirations': info.get('expired_keys', 0)}
+
+    def _generation_key(self):
+        return self.prefix + 'generation'
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def generation(self):
+        return 0
+
+    def set(self, key, value, ttl=None, tags=(), generation=None):
+        return True
+
+    def delete(self, *keys):
+        pass
+
+    def delete_tags(self, *tags):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class ResourceCache:
+    def __init__(self, app=None):
+        self.backend = NullCache()
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'invalidations': 0, 'stale_loads': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'memory')
+        app.config.setdefault('CACHE_MAX_ENTRIES', 10000)
+        app.config.setdefault('CACHE_DEFAULT_TTL', 300)  # Seconds
+        app.config.setdefault('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+        app.config.setdefault('CACHE_KEY_PREFIX', 'registration_app:')
+
+        backend = app.config['CACHE_BACKEND']
+        if backend == 'memory':
+            self.backend = LRUCache(app.config['CACHE_MAX_ENTRIES'], app.config['CACHE_DEFAULT_TTL'])
+        elif backend == 'redis':
+            self.backend = RedisCache(
+                app.config['CACHE_REDIS_URL'], app.config['CACHE_KEY_PREFIX'], app.config['CACHE_DEFAULT_TTL'])
+        elif backend == 'null':
+            self.backend = NullCache()
+        else:
+            raise ValueError('CACHE_BACKEND must be one of memory, redis, null')
+        app.extensions['resource_cache'] = self
+
+    def get_or_load(self, key, loader, tags=(), ttl=None):
+        """Returns the cached value for key, calling loader() on a miss.
+
+        A loader result of None (e.g. a missing row) is not cached, and
+        neither is one loaded while something was invalidated, since it may
+        predate that write. ttl can also be a function of the loaded value.
+        """
+        value = self.backend.get(key)
+        if value is not None:
+            self._count('hits')
+            return value
+        self._count('misses')
+        generation = self.backend.generation()
+        value = loader()
+        if value is not None:
+            if callable(ttl):
+                ttl = ttl(value)
+            if not self.backend.set(key, value, ttl=ttl, tags=tuple(tags), generation=generation):
+                self._count('stale_loads')
+        return value
+
+    def invalidate(self, *keys):
+        self._count('invalidations', len(keys))
+        self.backend.delete(*keys)
+
+    def invalidate_tags(self, *tags):
+        self._count('invalidations', len(tags))
+        self.backend.delete_tags(*tags)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats.update(self.backend.stats())
+        return stats
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+
+resource_cache = ResourceCache()
+
+
+# Cache keys and tags for the resources, in one place so readers and writers agree
+def user_key(user_id):
+    return f'user:{user_id}'
+
+
+def login_key(username):
+    return f'login:{username}'
+
+
+def symptom_key(user_id, symptom_id):
+    return f'symptom:{user_id}:{symptom_id}'
+
+
+def symptom_page_key(user_id, cursor, limit, fields):
+    return f"symptoms:{user_id}:{cursor or ''}:{limit}:{','.join(fields)}"
+
+
+def symptom_pages_tag(user_id):
+    return f'symptom-pages:{user_id}'
+
+
+def symptom_records_tag(user_id):
+    return f'symptom-records:{user_id}'
@@ -0,0 +1,162 @@
+"""Password hashing and the account lookups behind /auth/login.
+
+The KDF is deliberately slow, so hashing and verification run on a small
+process pool instead of the request thread. The waiting request thread
+does not hold the GIL, and logins can use more than one core. At most
+PASSWORD_VERIFY_MAX_PENDING jobs may be queued or running at once. Beyond
+that, CredentialsBusy is raised and the route answers 503, instead of the
+backlog growing without limit. Set PASSWORD_VERIFY_WORKERS to 0 to hash on
+the request thread.
+
+New hashes use PASSWORD_HASH_METHOD and PASSWORD_HASH_SALT_LENGTH. When
+these change, existing hashes are upgraded on the user's next successful
+login.
+
+lookup() reads the login record for a username through a cache of up to
+LOGIN_CACHE_MAX_ENTRIES records. The record holds the password hash, so
+this cache is always in-process and never written to the shared
+CACHE_BACKEND. Unknown usernames are cached too, for a shorter time. The
+handlers that change a username or password call forget(), which reaches
+this process only; other workers may accept an old password for up to
+LOGIN_CACHE_TTL seconds.
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from sqlalchemy import update
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from models import db, User
+from cache import LRUCache
+import cache
+
+LOGIN_RECORD_FIELDS = ('id', 'username', 'password', 'age', 'gender', 'location')
+
+
+class CredentialsBusy(Exception):
+    """Too many hashing jobs are pending; the client should retry later."""
+
+
+class Credentials:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._slots = None
+        self._method_prefixes = {}
+        self._records = LRUCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+        app.config.setdefault('PASSWORD_HASH_SALT_LENGTH', 16)
+        app.config.setdefault('PASSWORD_VERIFY_WORKERS', 2)
+        app.config.setdefault('PASSWORD_VERIFY_MAX_PENDING', 32)
+        app.config.setdefault('PASSWORD_VERIFY_TIMEOUT', 10)  # Seconds
+        app.config.setdefault('LOGIN_CACHE_TTL', 30)  # Seconds
+        app.config.setdefault('LOGIN_CACHE_NEGATIVE_TTL', 5)  # Seconds
+        app.config.setdefault('LOGIN_CACHE_MAX_ENTRIES', 10000)
+
+        self.app = app
+        self._records = LRUCache(app.config['LOGIN_CACHE_MAX_ENTRIES'], app.config['LOGIN_CACHE_TTL'])
+        self._slots = threading.BoundedSemaphore(app.config['PASSWORD_VERIFY_MAX_PENDING'])
+        app.extensions['credentials'] = self
+        atexit.register(self.shutdown)
+
+    def hash_password(self, password):
+        return self._run(generate_password_hash, password,
+                         self.app.config['PASSWORD_HASH_METHOD'], self.app.config['PASSWORD_HASH_SALT_LENGTH'])
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if the hash was made with other parameters than the configured ones."""
+        method, _, rest = password_hash.partition('$')
+        salt = rest.partition('$')[0]
+        return method != self._method_prefix() or len(salt) != self.app.config['PASSWORD_HASH_SALT_LENGTH']
+
+    def upgrade(self, login_record, password):
+        """Stores a hash with the current parameters for a user whose password was just verified."""
+        try:
+            new_hash = self.hash_password(password)
+        except CredentialsBusy:
+            return  # Tried again on the next login
+        # Only replaces the hash that was verified, in case the password changed in the meantime
+        db.session.execute(
+            update(User)
+            .where(User.id == login_record['id'], User.password == login_record['password'])
+            .values(password=new_hash)
+        )
+        db.session.commit()
+        self.forget(login_record['username'])
+
+    def lookup(self, username):
+        """Returns the user's login record as a dict, or None if there is no such user."""
+        key = cache.login_key(username)
+        record = self._records.get(key)
+        if record is None:
+            generation = self._records.generation()
+            user = User.query.filter_by(username=username).first()
+            record = {field: getattr(user, field) for field in LOGIN_RECORD_FIELDS} if user else {}
+            ttl = self.app.config['LOGIN_CACHE_TTL' if record else 'LOGIN_CACHE_NEGATIVE_TTL']
+            self._records.set(key, record, ttl=ttl, generation=generation)
+        return record or None
+
+    def forget(self, *usernames):
+        self._records.delete(*[cache.login_key(username) for username in usernames if username])
+
+    def clear(self):
+        """Forgets every cached login record, e.g. after the users were replaced."""
+        self._records.clear()
+
+    def shutdown(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown(wait=True, cancel_futures=True)
+        self._pool = None
+
+    def _method_prefix(self):
+        # "scrypt" is stored as "scrypt:32768:8:1"; hashing once shows how the configured method is written
+        method = self.app.config['PASSWORD_HASH_METHOD']
+        prefix = self._method_prefixes.get(method)
+        if prefix is None:
+            prefix = generate_password_hash('', method, 1).partition('$')[0]
+            self._method_prefixes[method] = prefix
+        return prefix
+
+    def _run(self, function, *args):
+        if not self.app.config['PASSWORD_VERIFY_WORKERS']:
+            return function(*args)
+        if not self._slots.acquire(blocking=False):
+            raise CredentialsBusy('Too many logins in progress, try again shortly')
+        try:
+            future = self._ensure_pool().submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.app.config['PASSWORD_VERIFY_TIMEOUT'])
+        except TimeoutError:
+            future.cancel()
+            raise CredentialsBusy('Password check timed out, try again shortly')
+
+    def _ensure_pool(self):
+        # Started lazily, and again in forked processes, which can not use the parent's pool.
+        # Spawned workers do not inherit the app's threads, locks or database connections.
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.app.config['PASSWORD_VERIFY_WORKERS'],
+                        mp_context=multiprocessing.get_context('spawn'))
+                    self._pid = os.getpid()
+        return self._pool
+
+
+credentials = Credentials()
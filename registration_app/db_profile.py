@@ -0,0 +1,114 @@
+"""Database engine profile, driven entirely by app.config.
+
+configure(app) runs before db.init_app(app) and turns the DATABASE_* and
+SQLITE_* settings into Flask-SQLAlchemy engine options:
+
+- For SQLite, the SQLITE_PRAGMAS are applied to every new connection (WAL
+  journal, synchronous=NORMAL, busy_timeout, mmap_size, cache_size).
+- The DATABASE_POOL settings apply to every engine that uses a connection
+  pool, which includes PostgreSQL when SQLALCHEMY_DATABASE_URI points there.
+- GET and HEAD requests read through a separate "replica" engine. That is
+  DATABASE_READ_REPLICA_URI when it is set. For a SQLite file it is
+  otherwise a read-only pool on the same file, because WAL lets readers run
+  alongside the writer.
+"""
+from flask import has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+REPLICA_BIND = 'replica'
+READ_METHODS = ('GET', 'HEAD')
+
+
+def _is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+def _is_memory_sqlite(uri):
+    database = make_url(uri).database
+    return not database or database == ':memory:' or 'mode=memory' in str(uri)
+
+
+def _pool_options(app, uri):
+    # In-memory SQLite uses a single shared connection, not a pool
+    if _is_sqlite(uri) and _is_memory_sqlite(uri):
+        return {}
+    return dict(app.config['DATABASE_POOL'])
+
+
+def configure(app):
+    app.config.setdefault('DATABASE_READ_REPLICA_URI', None)
+    app.config.setdefault('SQLITE_READ_ONLY_POOL', True)
+    app.config.setdefault('SQLITE_PRAGMAS', {})
+    app.config.setdefault('DATABASE_POOL', {})
+
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    engine_options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    for key, value in _pool_options(app, uri).items():
+        engine_options.setdefault(key, value)
+
+    replica_uri = app.config['DATABASE_READ_REPLICA_URI']
+    if replica_uri is None and _is_sqlite(uri) and not _is_memory_sqlite(uri) and app.config['SQLITE_READ_ONLY_POOL']:
+        replica_uri = uri
+    if replica_uri is not None:
+        binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+        binds.setdefault(REPLICA_BIND, {'url': replica_uri, **_pool_options(app, replica_uri)})
+
+
+def attach(app, db):
+    """Installs the connect-time pragmas on the app's engines. Runs after db.init_app(app)."""
+    with app.app_context():
+        engines = db.engines
+    pragmas = app.config['SQLITE_PRAGMAS']
+    for key, engine in engines.items():
+        if engine.dialect.name != 'sqlite':
+            continue
+        engine_pragmas = dict(pragmas)
+        if key == REPLICA_BIND:
+            engine_pragmas['query_only'] = 'ON'
+        event.listen(engine, 'connect', _pragma_setter(engine_pragmas))
+
+
+def _pragma_setter(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+    return set_pragmas
+
+
+class RoutingSession(Session):
+    """Sends reads made while serving GET and HEAD requests to the replica engine.
+
+    Anything else goes to the primary: writes, flushes, work outside a
+    request, and any read in a session that has already written, so a
+    request always sees its own changes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self._reads_from_replica(clause):
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                return replica
+        if clause is not None and not getattr(clause, 'is_select', False):
+            self.info['wrote'] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _reads_from_replica(self, clause):
+        return (
+            clause is not None
+            and getattr(clause, 'is_select', False)
+            and not self._flushing
+            and not self.info.get('wrote')
+            and has_request_context()
+            and request.method in READ_METHODS
+        )
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _mark_written(session, flush_context, instances):
+    session.info['wrote'] = True
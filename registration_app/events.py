@@ -0,0 +1,328 @@
+"""Live symptom updates, pushed to dashboards as server-sent events.
+
+The symptom write handlers publish an event on the user's channel after
+they commit:
+
+    symptom.created  data is the symptom, as the REST routes return it
+    symptom.updated  data is the symptom
+    symptom.deleted  data is {"id": ...}
+    resync           data is {}; the client should fetch the list again
+
+/users/<id>/symptoms/events streams them. Every event has an id. A client
+that reconnects with Last-Event-ID gets what it missed from a history of
+the last EVENTS_HISTORY_SIZE events per user. A resync is sent instead if
+that history no longer reaches back far enough.
+
+Two backends are available, chosen with EVENTS_BACKEND:
+
+    memory  in-process fan-out; only streams served by the same process see an event
+    redis   a Redis stream per user at EVENTS_REDIS_URL, shared by all workers
+
+Each open stream buffers up to EVENTS_QUEUE_SIZE events. Publishers never
+wait for a slow client. A stream that falls further behind has its buffer
+replaced by a single resync. Streams send a comment line every
+EVENTS_HEARTBEAT_INTERVAL seconds, so proxies keep the connection open and
+closed connections are noticed. At most EVENTS_MAX_STREAMS streams are
+open per process.
+"""
+import json
+import queue
+import threading
+import uuid
+from collections import OrderedDict, deque
+
+RESYNC = 'resync'
+
+# Channels kept in memory; the least recently used ones without subscribers are dropped beyond this
+MAX_CHANNELS = 10000
+
+
+class StreamLimitReached(Exception):
+    pass
+
+
+def format_event(event_id, event, data):
+    """One event in the text/event-stream format."""
+    lines = [f'event: {event}', f'data: {json.dumps(data, separators=(",", ":"))}']
+    if event_id is not None:
+        lines.insert(0, f'id: {event_id}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class _Subscription:
+    """A bounded buffer of (event id, event, data) tuples for one open stream."""
+
+    def __init__(self, size, on_close):
+        self._queue = queue.Queue(maxsize=size)
+        self._on_close = on_close
+
+    def offer(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # Too far behind to catch up event by event
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._queue.put_nowait((None, RESYNC, {}))
+
+    def get(self, timeout):
+        """Returns the buffered events, waiting up to timeout seconds for one; [] if none came."""
+        try:
+            items = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def close(self):
+        self._on_close(self)
+
+
+class _Channel:
+    def __init__(self, history_size):
+        self.sequence = 0
+        self.history = deque(maxlen=history_size)  # (sequence, event, data)
+        self.subscribers = set()
+
+
+class MemoryBroker:
+    def __init__(self, history_size=100, queue_size=100):
+        self.history_size = history_size
+        self.queue_size = queue_size
+        # Ids are "<epoch>-<sequence>"; an id from before a restart has another epoch and gets a resync
+        self._epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._channels = OrderedDict()
+
+    def publish(self, channel_name, event, data):
+        with self._lock:
+            channel = self._channel(channel_name)
+            channel.sequence += 1
+            channel.history.append((channel.sequence, event, data))
+            item = (f'{self._epoch}-{channel.sequence}', event, data)
+            for subscription in channel.subscribers:
+                subscription.offer(item)
+
+    def subscribe(self, channel_name, last_event_id=None):
+        with self._lock:
+            channel = self._channel(channel_name)
+            subscription = _Subscription(self.queue_size, lambda s: self._unsubscribe(channel, s))
+            if last_event_id:
+                for item in self._missed(channel, last_event_id):
+                    subscription.offer(item)
+            channel.subscribers.add(subscription)
+        return subscription
+
+    def _missed(self, channel, last_event_id):
+        epoch, _, sequence = last_event_id.partition('-')
+        if epoch != self._epoch or not sequence.isdigit() or int(sequence) > channel.sequence:
+            return [(None, RESYNC, {})]
+        sequence = int(sequence)
+        oldest = channel.history[0][0] if channel.history else channel.sequence + 1
+        if sequence < oldest - 1:
+            return [(None, RESYNC, {})]
+        return [(f'{self._epoch}-{seq}', event, data) for seq, event, data in channel.history if seq > sequence]
+
+    def _unsubscribe(self, channel, subscription):
+        with self._lock:
+            channel.subscribers.discard(subscription)
+
+    def _channel(self, channel_name):
+        channel = self._channels.get(channel_name)
+        if channel is None:
+            channel = self._channels[channel_name] = _Channel(self.history_size)
+            if len(self._channels) > MAX_CHANNELS:
+                for name, old in list(self._channels.items()):
+                    if not old.subscribers and name != channel_name:
+                        del self._channels[name]
+                        break
+        self._channels.move_to_end(channel_name)
+        return channel
+
+
+class _RedisSubscription:
+    def __init__(self, client, key, last_id, resync):
+        self._client = client
+        self._key = key
+        self._last_id = last_id
+        self._pending = [(None, RESYNC, {})] if resync else []
+
+    def get(self, timeout):
+        if self._pending:
+            items, self._pending = self._pending, []
+            return items
+        response = self._client.xread({self._key: self._last_id}, block=int(timeout * 1000), count=100)
+        if not response:
+            return []
+        entries = response[0][1]
+        items = []
+        if _trimmed_since(self._client, self._key, self._last_id):
+            items.append((None, RESYNC, {}))
+        for entry_id, fields in entries:
+            items.append((entry_id, fields['event'], json.loads(fields['data'])))
+        self._last_id = entries[-1][0]
+        return items
+
+    def close(self):
+        pass
+
+
+def _stream_id(entry_id):
+    milliseconds, _, sequence = entry_id.partition('-')
+    return int(milliseconds), int(sequence or 0)
+
+
+def _trimmed_since(client, key, last_id):
+    """True if entries after last_id may have been trimmed from the stream before they were read."""
+    if last_id == '0-0':
+        return False
+    oldest = client.xrange(key, count=1)
+    return bool(oldest) and _stream_id(oldest[0][0]) > _stream_id(last_id)
+
+
+class RedisBroker:
+    def __init__(self, url, prefix='registration_app:', history_size=100):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('EVENTS_BACKEND "redis" needs the redis package (pip install redis)')
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.history_size = history_size
+
+    def publish(self, channel_name, event, data):
+        self._client.xadd(self._key(channel_name), {'event': event, 'data': json.dumps(data)},
+                          maxlen=self.history_size, approximate=True)
+
+    def subscribe(self, channel_name, last_event_id=None):
+        key = self._key(channel_name)
+        newest = self._client.xrevrange(key, count=1)
+        newest_id = newest[0][0] if newest else '0-0'
+        if not last_event_id:
+            return _RedisSubscription(self._client, key, newest_id, resync=False)
+        try:
+            unknown = _stream_id(last_event_id) > _stream_id(newest_id)
+        except ValueError:
+            unknown = True
+        if unknown or _trimmed_since(self._client, key, last_event_id):
+            return _RedisSubscription(self._client, key, newest_id, resync=True)
+        return _RedisSubscription(self._client, key, last_event_id, resync=False)
+
+    def _key(self, channel_name):
+        return f'{self.prefix}events:{channel_name}'
+
+
+class SymptomEvents:
+    def __init__(self, app=None):
+        self.app = None
+        self.broker = MemoryBroker()
+        self.heartbeat_interval = 15
+        self.max_streams = 48
+        self._lock = threading.Lock()
+        self._open_streams = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('EVENTS_BACKEND', 'memory')
+        app.config.setdefault('EVENTS_REDIS_URL', 'redis://localhost:6379/0')
+        app.config.setdefault('EVENTS_KEY_PREFIX', 'registration_app:')
+        app.config.setdefault('EVENTS_HISTORY_SIZE', 100)
+        app.config.setdefault('EVENTS_QUEUE_SIZE', 100)
+        app.config.setdefault('EVENTS_HEARTBEAT_INTERVAL', 15)  # Seconds
+        app.config.setdefault('EVENTS_MAX_STREAMS', 48)  # Below the server's view threads, see config.py
+
+        backend = app.config['EVENTS_BACKEND']
+        if backend == 'memory':
+            self.broker = MemoryBroker(app.config['EVENTS_HISTORY_SIZE'], app.config['EVENTS_QUEUE_SIZE'])
+        elif backend == 'redis':
+            self.broker = RedisBroker(
+                app.config['EVENTS_REDIS_URL'], app.config['EVENTS_KEY_PREFIX'], app.config['EVENTS_HISTORY_SIZE'])
+        else:
+            raise ValueError('EVENTS_BACKEND must be one of memory, redis')
+        self.heartbeat_interval = app.config['EVENTS_HEARTBEAT_INTERVAL']
+        self.max_streams = app.config['EVENTS_MAX_STREAMS']
+        self.app = app
+        app.extensions['symptom_events'] = self
+
+    def publish(self, user_id, event, data):
+        """Publishes an event on the user's channel. Call it after the change is committed."""
+        try:
+            self.broker.publish(user_channel(user_id), event, data)
+        except Exception as e:
+            # The change itself is committed; open streams pick it up on their next resync
+            self.app.logger.error(f"Failed to publish {event} for user {user_id}: {str(e)}")
+
+    def stream(self, user_id, last_event_id=None):
+        """Returns an iterable of text/event-stream chunks for the user's channel.
+
+        The stream counts as open until the iterable is closed, which the WSGI
+        server does even for a response whose body is never read.
+        Raises StreamLimitReached if EVENTS_MAX_STREAMS streams are open already.
+        """
+        with self._lock:
+            if self._open_streams >= self.max_streams:
+                raise StreamLimitReached('Too many open event streams, try again later')
+            self._open_streams += 1
+        try:
+            subscription = self.broker.subscribe(user_channel(user_id), last_event_id)
+        except Exception:
+            self._stream_closed()
+            raise
+        return _EventStream(self, subscription)
+
+    def open_streams(self):
+        with self._lock:
+            return self._open_streams
+
+    def _stream_closed(self):
+        with self._lock:
+            self._open_streams -= 1
+
+
+class _EventStream:
+    """The chunks of one open stream; close() releases it, whether or not it was iterated."""
+
+    def __init__(self, events, subscription):
+        self._events = events
+        self._subscription = subscription
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __iter__(self):
+        return self._generate()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._subscription.close()
+        self._events._stream_closed()
+
+    def _generate(self):
+        heartbeat_interval = self._events.heartbeat_interval
+        try:
+            # Tells EventSource how long to wait before reconnecting
+            yield f'retry: {int(heartbeat_interval * 1000)}\n\n'
+            while True:
+                items = self._subscription.get(timeout=heartbeat_interval)
+                if not items:
+                    yield ': heartbeat\n\n'
+                    continue
+                yield ''.join(format_event(*item) for item in items)
+        finally:
+            self.close()
+
+
+symptom_events = SymptomEvents()
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
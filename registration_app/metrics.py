@@ -0,0 +1,282 @@
+"""Per-request performance metrics in the Prometheus text format.
+
+init_app(app) hooks every request and records, per route:
+
+    http_requests_total                 by method, route and status
+    http_request_duration_seconds       histogram, until the response is complete
+    http_response_size_bytes            histogram, for responses with a known length
+    db_queries_per_request              histogram of SQL statements executed
+    db_query_seconds_per_request        histogram of time spent in SQL
+    db_repeated_queries_total           requests that ran one statement METRICS_N_PLUS_ONE_THRESHOLD
+                                        times or more, the usual sign of an N+1 query
+
+The SQL figures come from engine events on every engine, including the
+read replica. Queries on other threads, such as the activity log writer,
+are not counted toward a request. /metrics serves all of this, together
+with whatever stats the app passes to render() (the cache, the activity
+log writer, ...).
+
+An admin (a user id in ADMIN_USER_IDS) can add ?profile=1 to any request.
+A sampling profiler then looks at the request thread every
+METRICS_PROFILE_INTERVAL seconds, and the stacks it saw are written in the
+folded format, one "frame;frame;frame count" line per stack, to
+METRICS_PROFILE_DIR. The X-Profile response header names the file. Feed it
+to flamegraph.pl or speedscope.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from auth import token_auth
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+QUERY_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_labels(labels, le=_number(bound))} {cumulative}'
+        yield f'{name}_bucket{_labels(labels, le="+Inf")} {self.count}'
+        yield f'{name}_sum{_labels(labels)} {_number(self.sum)}'
+        yield f'{name}_count{_labels(labels)} {self.count}'
+
+
+class SamplingProfiler:
+    """Samples one thread's stack from a background thread and counts the folded stacks."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(frames))] += 1
+
+
+class RequestMetrics:
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._requests = Counter()  # (method, route, status) -> count
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._repeated_queries = Counter()  # route -> count
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_N_PLUS_ONE_THRESHOLD', 10)
+        app.config.setdefault('ADMIN_USER_IDS', [])
+        app.config.setdefault('METRICS_PROFILE_INTERVAL', 0.005)  # Seconds
+        app.config.setdefault('METRICS_PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+
+        self.app = app
+        app.extensions['request_metrics'] = self
+        if not app.config['METRICS_ENABLED']:
+            return
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        # Teardown runs once a streamed body is complete, so streamed responses are timed in full
+        app.teardown_request(self._teardown_request)
+
+    def attach(self, db):
+        """Counts SQL statements on the app's engines. Runs after db.init_app(app)."""
+        if not self.app.config['METRICS_ENABLED']:
+            return
+        with self.app.app_context():
+            engines = db.engines
+        for engine in engines.values():
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+    def render(self, stats=None):
+        """The metrics in the Prometheus text format, followed by stats, a dict of name -> dict of numbers."""
+        with self._lock:
+            requests = dict(self._requests)
+            histograms = {key: _copy(histogram) for key, histogram in self._histograms.items()}
+            repeated = dict(self._repeated_queries)
+
+        lines = ['# TYPE http_requests_total counter']
+        for (method, route, status), count in sorted(requests.items()):
+            lines.append(f'http_requests_total{_labels((("method", method), ("route", route), ("status", status)))} {count}')
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for (histogram_name, labels), histogram in sorted(histograms.items()):
+                if histogram_name == name:
+                    lines.extend(histogram.lines(name, labels))
+        lines.append('# TYPE db_repeated_queries_total counter')
+        for route, count in sorted(repeated.items()):
+            lines.append(f'db_repeated_queries_total{_labels((("route", route),))} {count}')
+
+        for prefix, values in (stats or {}).items():
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    name = _metric_name(f'{prefix}_{key}')
+                    lines.append(f'# TYPE {name} gauge')
+                    lines.append(f'{name} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def _before_request(self):
+        g.metrics_started_at = time.perf_counter()
+        g.metrics_queries = Counter()  # statement -> executions
+        g.metrics_query_seconds = 0.0
+        if request.args.get('profile') == '1' and self._is_admin():
+            g.metrics_profiler = SamplingProfiler(threading.get_ident(), self.app.config['METRICS_PROFILE_INTERVAL'])
+            g.metrics_profile_path = os.path.join(
+                self.app.config['METRICS_PROFILE_DIR'],
+                f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{threading.get_ident()}-{request.endpoint}.folded')
+            g.metrics_profiler.start()
+
+    def _after_request(self, response):
+        g.metrics_status = response.status_code
+        g.metrics_size = response.content_length if not response.is_streamed else None
+        if 'metrics_profile_path' in g:
+            response.headers['X-Profile'] = os.path.basename(g.metrics_profile_path)
+        return response
+
+    def _teardown_request(self, exception):
+        started_at = g.pop('metrics_started_at', None)
+        if started_at is None:
+            return
+        duration = time.perf_counter() - started_at
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        method = request.method
+        status = g.pop('metrics_status', 500)
+        size = g.pop('metrics_size', None)
+        queries = g.pop('metrics_queries')
+        query_seconds = g.pop('metrics_query_seconds')
+
+        statement, repeats = queries.most_common(1)[0] if queries else (None, 0)
+        repeated = repeats >= self.app.config['METRICS_N_PLUS_ONE_THRESHOLD']
+        if repeated:
+            self.app.logger.warning(
+                f"Possible N+1 query on {method} {route}: ran {repeats} times: {' '.join(statement.split())[:200]}")
+
+        labels = (('method', method), ('route', route))
+        with self._lock:
+            self._requests[(method, route, str(status))] += 1
+            self._observe('http_request_duration_seconds', labels, DURATION_BUCKETS, duration)
+            if size is not None:
+                self._observe('http_response_size_bytes', labels, SIZE_BUCKETS, size)
+            self._observe('db_queries_per_request', labels, QUERY_COUNT_BUCKETS, sum(queries.values()))
+            self._observe('db_query_seconds_per_request', labels, QUERY_TIME_BUCKETS, query_seconds)
+            if repeated:
+                self._repeated_queries[route] += 1
+
+        profiler = g.pop('metrics_profiler', None)
+        if profiler is not None:
+            profiler.stop()
+            self._write_profile(g.pop('metrics_profile_path'), profiler)
+
+    def _observe(self, name, labels, buckets, value):
+        histogram = self._histograms.get((name, labels))
+        if histogram is None:
+            histogram = self._histograms[(name, labels)] = Histogram(buckets)
+        histogram.observe(value)
+
+    def _is_admin(self):
+        try:
+            principal = token_auth.authenticate(optional=True)
+            return principal is not None and principal.user_id in self.app.config['ADMIN_USER_IDS']
+        except Exception:
+            return False  # The route reports a bad token itself
+
+    def _write_profile(self, path, profiler):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(profiler.folded())
+        except OSError as e:
+            self.app.logger.error(f"Failed to write profile {path}: {str(e)}")
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'metrics_queries' in g:
+        conn.info.setdefault('metrics_query_started_at', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('metrics_query_started_at')
+    if not started or not has_request_context() or 'metrics_queries' not in g:
+        return
+    g.metrics_query_seconds += time.perf_counter() - started.pop()
+    g.metrics_queries[statement] += 1
+
+
+def _copy(histogram):
+    copy = Histogram(histogram.buckets)
+    copy.counts = list(histogram.counts)
+    copy.count = histogram.count
+    copy.sum = histogram.sum
+    return copy
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_:]', '_', name)
+
+
+request_metrics = RequestMetrics()
@@ -0,0 +1,78 @@
+"""Schema migrations.
+
+db.create_all() creates missing tables together with their indexes, but it
+never changes a table that already exists. Changes to existing tables are
+therefore listed here as numbered steps. upgrade() runs create_all() and
+then every step the schema_migrations table has not recorded yet, each in
+its own transaction. It runs at startup and as "flask db-upgrade".
+
+A new database runs every step right after create_all() has built it from
+the current models, so steps must be idempotent.
+"""
+from sqlalchemy import insert, text
+
+from models import db, ActivityLog, Symptom, SymptomPatternCount, SchemaMigration
+import analytics
+import patterns
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(step):
+        MIGRATIONS.append((version, description, step))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return step
+    return register
+
+
+def _create_index(connection, table, name):
+    index = next(index for index in table.__table__.indexes if index.name == name)
+    index.create(connection, checkfirst=True)
+
+
+@migration(1, 'Add indexes for the activity log, symptom and pattern queries')
+def add_query_indexes(connection):
+    _create_index(connection, ActivityLog, 'ix_activity_logs_user_id_timestamp')
+    _create_index(connection, Symptom, 'ix_symptoms_userid_id')
+    _create_index(connection, Symptom, 'ix_symptoms_userid_label')
+    # Replaced by an index that also covers the tie-break on signature
+    connection.execute(text('DROP INDEX IF EXISTS ix_symptom_pattern_counts_count'))
+    _create_index(connection, SymptomPatternCount, 'ix_symptom_pattern_counts_count_signature')
+
+
+@migration(2, 'Backfill the daily symptom rollups for /analytics')
+def backfill_symptom_rollups(connection):
+    # create_all() has made the empty tables; rebuild() clears them first, so this can run again
+    analytics.rebuild(connection)
+
+
+@migration(3, 'Count every symptom combination for the pattern miner')
+def backfill_signature_counts(connection):
+    patterns.backfill_signature_counts(connection)
+
+
+def applied_versions():
+    return {version for (version,) in db.session.query(SchemaMigration.version)}
+
+
+def pending():
+    applied = applied_versions()
+    return [(version, description) for version, description, _ in MIGRATIONS if version not in applied]
+
+
+def upgrade():
+    """Brings the database up to date. Returns the versions that were applied."""
+    db.create_all()
+    applied = applied_versions()
+    db.session.remove()
+
+    newly_applied = []
+    for version, description, step in MIGRATIONS:
+        if version in applied:
+            continue
+        with db.engine.begin() as connection:
+            step(connection)
+            connection.execute(insert(SchemaMigration).values(version=version, description=description))
+        newly_applied.append(version)
+    return newly_applied
@@ -1,7 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from db_profile import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -40,4 +41,98 @@ class ActivityLog(db.Model):
 
 
     def __repr__(self):
-        return f"<ActivityLog user_id={self.user_id} action='{self.action}' endpoint='{self.endpoint}'>"
\ No newline at end of file
+        return f"<ActivityLog user_id={self.user_id} action='{self.action}' endpoint='{self.endpoint}'>"
+
+# Secondary indexes for the queries the routes run; existing databases get them from migrations.py
+db.Index('ix_activity_logs_user_id_timestamp', ActivityLog.user_id, ActivityLog.timestamp.desc(), ActivityLog.id.desc())
+db.Index('ix_symptoms_userid_id', Symptom.userid, Symptom.id)
+db.Index('ix_symptoms_userid_label', Symptom.userid, Symptom.label)
+
+# Tokens revoked before their expiry, e.g. on logout; see auth.py
+class RevokedToken(db.Model):
+    __tablename__ = 'revoked_tokens'
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), unique=True, nullable=False)
+    expires_at = db.Column(db.DateTime)  # When the token would have expired anyway; rows past it are deleted
+    revoked_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Activity logs moved out of activity_logs by activity_archive.py. Each archive is one file
+# per month and compaction run, holding one gzip member of NDJSON per user.
+class ActivityLogArchive(db.Model):
+    __tablename__ = 'activity_log_archives'
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), nullable=False)  # e.g. "2024-01"
+    path = db.Column(db.String(255), nullable=False)  # Relative to ACTIVITY_LOG_ARCHIVE_DIR
+    row_count = db.Column(db.Integer, nullable=False)
+    min_timestamp = db.Column(db.DateTime, nullable=False)
+    max_timestamp = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ActivityLogArchiveMember(db.Model):
+    __tablename__ = 'activity_log_archive_members'
+    archive_id = db.Column(db.Integer, db.ForeignKey('activity_log_archives.id'), primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True)
+    offset = db.Column(db.BigInteger, nullable=False)  # Byte range of the user's gzip member in the file
+    length = db.Column(db.Integer, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    min_timestamp = db.Column(db.DateTime, nullable=False)
+    max_timestamp = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_activity_log_archive_members_user_id_max_timestamp', user_id, max_timestamp.desc()),)
+
+class UserSymptomSignature(db.Model):
+    __tablename__ = 'user_symptom_signatures'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    signature = db.Column(db.Text, nullable=False)  # JSON list of the user's sorted symptom labels
+    label_count = db.Column(db.Integer, nullable=False)
+
+class SymptomPatternCount(db.Model):
+    __tablename__ = 'symptom_pattern_counts'
+    signature = db.Column(db.Text, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)  # Number of users with this combination
+
+    __table_args__ = (db.Index('ix_symptom_pattern_counts_count_signature', count.desc(), signature),)
+
+class SymptomSignatureCount(db.Model):
+    __tablename__ = 'symptom_signature_counts'
+    signature = db.Column(db.Text, primary_key=True)  # Every combination, single labels included
+    label_count = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)  # Kept at 0 rather than deleted, see pattern_mining.py
+    version = db.Column(db.Integer, nullable=False, default=0)  # "patterns" version of the last change
+
+    __table_args__ = (db.Index('ix_symptom_signature_counts_version', version),)
+
+# Daily symptom counts for the analytics routes, maintained by analytics.py.
+# A user without a location, gender or age is counted under "unknown".
+class SymptomDailyLocationCount(db.Model):
+    __tablename__ = 'symptom_daily_location_counts'
+    day = db.Column(db.Date, primary_key=True)
+    label = db.Column(db.String(100), primary_key=True)
+    location = db.Column(db.String(100), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class SymptomDailyAgeBandCount(db.Model):
+    __tablename__ = 'symptom_daily_age_band_counts'
+    day = db.Column(db.Date, primary_key=True)
+    label = db.Column(db.String(100), primary_key=True)
+    age_band = db.Column(db.String(10), primary_key=True)  # e.g. "30-39" or "90+"
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class SymptomDailyGenderCount(db.Model):
+    __tablename__ = 'symptom_daily_gender_counts'
+    day = db.Column(db.Date, primary_key=True)
+    label = db.Column(db.String(100), primary_key=True)
+    gender = db.Column(db.String(10), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class ResourceVersion(db.Model):
+    __tablename__ = 'resource_versions'
+    scope = db.Column(db.String(100), primary_key=True)  # e.g. "user:5" or "patterns"
+    version = db.Column(db.Integer, nullable=False, default=0)  # Bumped on every change within the scope
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(255), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,98 @@
+"""Keyset pagination and field projection helpers for the list endpoints.
+
+Pages are addressed with an opaque cursor holding the sort key of the last
+row on the previous page, so fetching any page is one indexed range query
+whatever its position in the table. The "fields" parameter limits which
+columns are selected in SQL and returned.
+"""
+import base64
+import json
+from datetime import datetime
+
+from flask import request, url_for
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class PaginationError(ValueError):
+    """Raised for malformed limit, cursor or fields parameters."""
+
+
+def encode_cursor(*values):
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, *types):
+    """Returns the sort key held by a cursor as a tuple, or None without a cursor.
+
+    types gives the type of each value, int or datetime; datetimes travel
+    as ISO 8601 strings. Cursors that do not match raise PaginationError.
+    """
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise PaginationError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(types):
+        raise PaginationError('Invalid cursor')
+    return tuple(_cursor_value(value, kind) for value, kind in zip(values, types))
+
+
+def _cursor_value(value, kind):
+    if kind is int and isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if kind is datetime and isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    raise PaginationError('Invalid cursor')
+
+
+def page_size():
+    raw = request.args.get('limit')
+    if raw is None:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(raw)
+    except ValueError:
+        raise PaginationError('limit must be an integer')
+    if limit < 1:
+        raise PaginationError('limit must be at least 1')
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def requested_fields(allowed, always=()):
+    """Returns the columns to select for the "fields" query parameter.
+
+    Columns in `always` are selected even when not asked for, because the
+    cursor and links are built from them.
+    """
+    raw = request.args.get('fields')
+    if not raw:
+        fields = list(allowed)
+    else:
+        fields = [field.strip() for field in raw.split(',') if field.strip()]
+        unknown = [field for field in fields if field not in allowed]
+        if unknown:
+            raise PaginationError(f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed)}")
+    for field in reversed(always):
+        if field not in fields:
+            fields.insert(0, field)
+    return tuple(fields)
+
+
+def page_links(endpoint, next_cursor, **values):
+    """HATEOAS links for a page, keeping the caller's limit, fields and links mode."""
+    params = {key: request.args[key] for key in ('limit', 'fields', 'links') if key in request.args}
+    self_params = dict(params)
+    if 'cursor' in request.args:
+        self_params['cursor'] = request.args['cursor']
+    return {
+        'self': url_for(endpoint, _external=True, **values, **self_params),
+        'next': url_for(endpoint, _external=True, cursor=next_cursor, **values, **params) if next_cursor else None
+    }
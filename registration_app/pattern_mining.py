@@ -0,0 +1,309 @@
+"""Frequent symptom combinations, for /symptoms/patterns?min_support=&max_size=&top=.
+
+patterns.py counts users by their exact set of labels. Here a combination
+is frequent if enough users have it among their labels, so {fever, cough}
+also counts the users who have fever, cough and headache. For every
+frequent combination of two or more labels the result gives:
+
+    count       users who have all of its labels
+    support     count / users with any symptom
+    lift        support / the product of its labels' supports; above 1 the
+                labels occur together more often than if they were independent
+    confidence  of its strongest rule, see rules
+    rules       for each label: of the users who have the other labels, the
+                share that has this one too, and that share's lift
+
+The miner reads symptom_signature_counts, one row per distinct label set
+with the number of users who have exactly that set. Millions of users
+collapse into at most a few thousand such rows. The rows are kept in
+memory, and when the "patterns" version moves only the rows changed since
+then are read again.
+
+Mining is level-wise (Apriori). A combination of k labels is counted only
+if all of its k-1 label subsets are frequent. The rows that hold a
+combination are a bitset: the bitset of the combination it extends, ANDed
+with the new label's. Counting the users in those rows is a popcount per
+bit of the user counts, see LabelMatrix. With NumPy every combination of a
+level is counted in one vectorized step. Without it the bitsets are
+Python ints, with the same results.
+"""
+import json
+import math
+import threading
+
+from sqlalchemy import select
+
+from models import db, SymptomSignatureCount
+import versioning
+
+try:
+    import numpy
+except ImportError:  # Optional; the pure Python path gives the same results
+    numpy = None
+
+MIN_PATTERN_SIZE = 2
+
+DEFAULT_MIN_SUPPORT = 0.01
+DEFAULT_MAX_SIZE = 3
+DEFAULT_TOP = 10
+MAX_SIZE = 6
+MAX_TOP = 1000
+
+# Candidates one level may have before the query is refused; low supports over many labels explode
+MAX_CANDIDATES = 100000
+
+# Words ANDed per NumPy step, bounding the temporary arrays
+NUMPY_CHUNK_CELLS = 4000000
+
+# Mining results kept per "patterns" version
+RESULTS_CACHED = 64
+
+
+class MiningError(ValueError):
+    """Raised for parameters the miner refuses to run with."""
+
+
+class LabelMatrix:
+    """The distinct label sets, each with the number of users who have it.
+
+    For counting, the sets are laid out by label: per label, a bitset of the
+    rows (distinct sets) that contain it. The user counts are laid out as
+    binary planes, a bitset per bit of the counts. The users covered by a
+    bitset of rows are then the sum over the planes of popcount(rows & plane)
+    shifted by the plane's bit.
+    """
+
+    def __init__(self):
+        self.labels = []  # Label index -> label
+        self._indexes = {}  # Label -> label index
+        self._rows = {}  # Signature -> (label bitset, users)
+        self.total = 0  # Users with any symptom
+        self._layout = None
+
+    def set_count(self, signature, count):
+        previous = self._rows.pop(signature, None)
+        if previous is not None:
+            self.total -= previous[1]
+        if count > 0:
+            self._rows[signature] = (self._label_bitset(json.loads(signature)), count)
+            self.total += count
+        self._layout = None
+
+    def names(self, label_bitset):
+        return sorted(self.labels[index] for index in _bit_indexes(label_bitset))
+
+    def layout(self):
+        """Returns (row bitset per label, row bitset per bit of the user counts), built on first use."""
+        if self._layout is None:
+            columns = [0] * len(self.labels)
+            planes = [0] * max((users.bit_length() for _, users in self._rows.values()), default=0)
+            for position, (label_bitset, users) in enumerate(self._rows.values()):
+                row = 1 << position
+                for index in _bit_indexes(label_bitset):
+                    columns[index] |= row
+                for bit in _bit_indexes(users):
+                    planes[bit] |= row
+            self._layout = (columns, planes, len(self._rows))
+        return self._layout
+
+    def _label_bitset(self, labels):
+        bitset = 0
+        for label in labels:
+            index = self._indexes.get(label)
+            if index is None:
+                index = self._indexes[label] = len(self.labels)
+                self.labels.append(label)
+            bitset |= 1 << index
+        return bitset
+
+
+def _bit_indexes(bitset):
+    index = 0
+    while bitset:
+        if bitset & 1:
+            yield index
+        bitset >>= 1
+        index += 1
+
+
+def _extensions(level, frequent, label_count):
+    """(position in level, label index) for each candidate one label larger whose every subset is frequent."""
+    extensions = []
+    for position, bitset in enumerate(level):
+        # Extend only with labels above the highest one, so each candidate is built once
+        for index in range(bitset.bit_length(), label_count):
+            candidate = bitset | (1 << index)
+            if all(candidate & ~(1 << subset_index) in frequent for subset_index in _bit_indexes(candidate)):
+                extensions.append((position, index))
+                if len(extensions) > MAX_CANDIDATES:
+                    raise MiningError('Too many combinations to count; raise min_support or lower max_size')
+    return extensions
+
+
+class _IntCounter:
+    """Rows as Python int bitsets."""
+
+    def __init__(self, columns, planes, row_count):
+        self.columns = columns
+        self.planes = planes
+
+    def count(self, covers):
+        return [sum((cover & plane).bit_count() << bit for bit, plane in enumerate(self.planes)) for cover in covers]
+
+    def extend(self, covers, extensions):
+        return [covers[position] & self.columns[index] for position, index in extensions]
+
+    def select(self, covers, keep):
+        return [cover for cover, kept in zip(covers, keep) if kept]
+
+
+class _NumpyCounter:
+    """Rows as arrays of 64-bit words, counted with numpy.bitwise_count."""
+
+    def __init__(self, columns, planes, row_count):
+        words = max(1, math.ceil(row_count / 64))
+        self.columns = numpy.array([_to_words(column, words) for column in columns], dtype=numpy.uint64)
+        self.planes = numpy.array([_to_words(plane, words) for plane in planes], dtype=numpy.uint64)
+        self.weights = numpy.array([1 << bit for bit in range(len(planes))], dtype=numpy.int64)
+
+    def count(self, covers):
+        counts = numpy.empty(len(covers), dtype=numpy.int64)
+        step = max(1, NUMPY_CHUNK_CELLS // max(1, self.planes.size))
+        for start in range(0, len(covers), step):
+            chunk = covers[start:start + step]
+            # candidates x planes: popcount of the covered rows in each plane
+            bits = numpy.bitwise_count(chunk[:, None, :] & self.planes[None, :, :]).sum(axis=2, dtype=numpy.int64)
+            counts[start:start + step] = bits @ self.weights
+        return counts.tolist()
+
+    def extend(self, covers, extensions):
+        if not extensions:
+            return numpy.empty((0, self.columns.shape[1]), dtype=numpy.uint64)
+        positions, indexes = zip(*extensions)
+        return covers[list(positions)] & self.columns[list(indexes)]
+
+    def select(self, covers, keep):
+        return covers[numpy.array(keep, dtype=bool)]
+
+
+def _to_words(bitset, words):
+    return numpy.frombuffer(bitset.to_bytes(words * 8, 'little'), dtype='<u8')
+
+
+def _counter(matrix):
+    if numpy is not None and hasattr(numpy, 'bitwise_count'):  # NumPy 2.0 and later
+        return _NumpyCounter(*matrix.layout())
+    return _IntCounter(*matrix.layout())
+
+
+def frequent_itemsets(matrix, min_count, max_size):
+    """Returns {label bitset: users} for every combination of up to max_size labels that min_count users have."""
+    if not matrix.total:
+        return {}
+    counter = _counter(matrix)
+    covers = counter.columns  # Rows covered by each combination of the current level
+    level = [1 << index for index in range(len(matrix.labels))]
+    frequent = {}
+    for size in range(1, max_size + 1):
+        if size > 1:
+            extensions = _extensions(level, frequent, len(matrix.labels))
+            if not extensions:
+                break
+            level = [level[position] | (1 << index) for position, index in extensions]
+            covers = counter.extend(covers, extensions)
+        counts = counter.count(covers)
+        keep = [count >= min_count for count in counts]
+        frequent.update((bitset, count) for bitset, count, kept in zip(level, counts, keep) if kept)
+        level = [bitset for bitset, kept in zip(level, keep) if kept]
+        covers = counter.select(covers, keep)
+    return frequent
+
+
+def _describe(matrix, frequent, bitset, count):
+    total = matrix.total
+    support = count / total
+    label_supports = {index: frequent[1 << index] / total for index in _bit_indexes(bitset)}
+    rules = []
+    for index, label_support in label_supports.items():
+        confidence = count / frequent[bitset & ~(1 << index)]
+        rules.append({
+            'if': matrix.names(bitset & ~(1 << index)),
+            'then': matrix.labels[index],
+            'confidence': round(confidence, 6),
+            'lift': round(confidence / label_support, 6)
+        })
+    rules.sort(key=lambda rule: (-rule['confidence'], rule['then']))
+    return {
+        'symptoms': matrix.names(bitset),
+        'count': count,
+        'support': round(support, 6),
+        'confidence': rules[0]['confidence'],
+        'lift': round(support / math.prod(label_supports.values()), 6),
+        'rules': rules
+    }
+
+
+class PatternMiner:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._matrix = LabelMatrix()
+        self._version = None
+        self._results = {}
+
+    def refresh(self):
+        """Brings the matrix up to date with symptom_signature_counts. Returns the version it reflects."""
+        # Read before the rows, so rows changed in between are read again next time rather than missed
+        version = versioning.current(versioning.PATTERNS_SCOPE)
+        with self._lock:
+            if version == self._version:
+                return version
+            query = select(SymptomSignatureCount.signature, SymptomSignatureCount.count)
+            if self._version is not None:
+                query = query.where(SymptomSignatureCount.version > self._version)
+            for signature, count in db.session.execute(query):
+                self._matrix.set_count(signature, count)
+            self._version = version
+            self._results.clear()
+            return version
+
+    def mine(self, min_support=DEFAULT_MIN_SUPPORT, max_size=DEFAULT_MAX_SIZE, top=DEFAULT_TOP):
+        """Returns (users with any symptom, the top frequent combinations by count)."""
+        self.refresh()
+        key = (min_support, max_size, top)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None:
+                return cached
+            matrix = self._matrix
+            total = matrix.total
+            found = []
+            if total:
+                frequent = frequent_itemsets(matrix, max(1, math.ceil(min_support * total)), max_size)
+                combinations = [(bitset, count) for bitset, count in frequent.items()
+                                if bin(bitset).count('1') >= MIN_PATTERN_SIZE]
+                combinations.sort(key=lambda item: (-item[1], -bin(item[0]).count('1'), matrix.names(item[0])))
+                found = [_describe(matrix, frequent, bitset, count) for bitset, count in combinations[:top]]
+            if len(self._results) >= RESULTS_CACHED:
+                self._results.clear()
+            self._results[key] = (total, found)
+            return total, found
+
+
+def parse_params(args):
+    """Reads min_support, max_size and top from the query string, with defaults."""
+    try:
+        min_support = float(args.get('min_support', DEFAULT_MIN_SUPPORT))
+        max_size = int(args.get('max_size', DEFAULT_MAX_SIZE))
+        top = int(args.get('top', DEFAULT_TOP))
+    except ValueError:
+        raise MiningError('min_support must be a number, max_size and top whole numbers')
+    if not 0 < min_support <= 1:
+        raise MiningError('min_support must be above 0 and at most 1')
+    if not MIN_PATTERN_SIZE <= max_size <= MAX_SIZE:
+        raise MiningError(f'max_size must be between {MIN_PATTERN_SIZE} and {MAX_SIZE}')
+    if not 1 <= top <= MAX_TOP:
+        raise MiningError(f'top must be between 1 and {MAX_TOP}')
+    return {'min_support': min_support, 'max_size': max_size, 'top': top}
+
+
+miner = PatternMiner()
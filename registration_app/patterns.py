@@ -0,0 +1,202 @@
+"""Maintained index of the symptom combinations users have.
+
+Each user with symptoms has a row in user_symptom_signatures holding their
+sorted label combination, and symptom_pattern_counts keeps how many users
+share each combination. The write handlers call refresh_user() before they
+commit, so the index changes in the same transaction as the symptoms, and
+/symptoms/patterns only has to read the first k rows of the count table.
+
+symptom_signature_counts counts every combination, single labels
+included, and records the "patterns" version of its last change. It is
+what pattern_mining.py reads, picking up only the rows changed since it
+last looked. Its rows are therefore set to 0 rather than deleted.
+"""
+import json
+
+from sqlalchemy import bindparam, delete, func, insert, select, update
+
+from models import db, Symptom, UserSymptomSignature, SymptomPatternCount, SymptomSignatureCount, ResourceVersion
+import versioning
+
+# A single symptom is not a combination
+MIN_PATTERN_SIZE = 2
+
+# Separator used when the labels are aggregated in SQL during a rebuild
+LABEL_SEPARATOR = '\x1f'
+
+
+def make_signature(labels):
+    return json.dumps(sorted(labels), separators=(',', ':'), ensure_ascii=False)
+
+
+def _adjust_count(signature, delta):
+    result = db.session.execute(
+        update(SymptomPatternCount)
+        .where(SymptomPatternCount.signature == signature)
+        .values(count=SymptomPatternCount.count + delta)
+    )
+    if result.rowcount == 0 and delta > 0:
+        db.session.execute(insert(SymptomPatternCount).values(signature=signature, count=delta))
+    elif delta < 0:
+        db.session.execute(
+            delete(SymptomPatternCount)
+            .where(SymptomPatternCount.signature == signature, SymptomPatternCount.count <= 0)
+        )
+
+
+def _adjust_signature_count(signature, label_count, delta, version):
+    result = db.session.execute(
+        update(SymptomSignatureCount)
+        .where(SymptomSignatureCount.signature == signature)
+        .values(count=SymptomSignatureCount.count + delta, version=version)
+    )
+    if result.rowcount == 0 and delta > 0:
+        db.session.execute(
+            insert(SymptomSignatureCount)
+            .values(signature=signature, label_count=label_count, count=delta, version=version)
+        )
+
+
+def _bump_version():
+    """Bumps the "patterns" version and returns its new value, as this transaction sees it."""
+    versioning.bump(versioning.PATTERNS_SCOPE)
+    return db.session.scalar(
+        select(ResourceVersion.version).where(ResourceVersion.scope == versioning.PATTERNS_SCOPE))
+
+
+def _set_signature(user_id, labels):
+    row = db.session.get(UserSymptomSignature, user_id)
+    signature = make_signature(labels) if labels else None
+
+    if row is not None and row.signature == signature:
+        return False
+
+    counted_before = row is not None and row.label_count >= MIN_PATTERN_SIZE
+    counted_after = signature is not None and len(labels) >= MIN_PATTERN_SIZE
+    if counted_before:
+        _adjust_count(row.signature, -1)
+    if counted_after:
+        _adjust_count(signature, 1)
+
+    version = _bump_version()
+    if row is not None:
+        _adjust_signature_count(row.signature, row.label_count, -1, version)
+    if signature is not None:
+        _adjust_signature_count(signature, len(labels), 1, version)
+
+    if signature is None:
+        if row is not None:
+            db.session.delete(row)
+    elif row is None:
+        db.session.add(UserSymptomSignature(user_id=user_id, signature=signature, label_count=len(labels)))
+    else:
+        row.signature = signature
+        row.label_count = len(labels)
+    return True
+
+
+def refresh_user(user_id):
+    """Recomputes a user's combination from their pending symptoms.
+
+    Must be called inside the transaction that changed the symptoms and
+    before it is committed. Returns True if the combination changed.
+    """
+    labels = [label for (label,) in labels_query(user_id)]
+    return _set_signature(user_id, labels)
+
+
+def forget_user(user_id):
+    """Removes a user from the index, e.g. before the user is deleted."""
+    return _set_signature(user_id, [])
+
+
+def labels_query(user_id):
+    return db.session.query(Symptom.label).filter_by(userid=user_id)
+
+
+def top_patterns_query(k=5):
+    return (
+        SymptomPatternCount.query
+        .order_by(SymptomPatternCount.count.desc(), SymptomPatternCount.signature)
+        .limit(k)
+    )
+
+
+def top_patterns(k=5):
+    rows = top_patterns_query(k)
+    return [{'symptoms': json.loads(row.signature), 'count': row.count} for row in rows]
+
+
+def clear():
+    version = _bump_version()
+    db.session.execute(delete(SymptomPatternCount))
+    db.session.execute(delete(UserSymptomSignature))
+    db.session.execute(update(SymptomSignatureCount).values(count=0, version=version))
+    return version
+
+
+def ensure_built():
+    """Builds the index on first start against a database that predates it."""
+    if db.session.query(UserSymptomSignature.user_id).first() is None \
+            and db.session.query(Symptom.id).first() is not None:
+        rebuild()
+        db.session.commit()
+
+
+def rebuild():
+    """Rebuilds the whole index from the symptoms table with one grouped query.
+
+    The caller is responsible for committing.
+    """
+    version = clear()
+    rows = db.session.execute(
+        db.select(Symptom.userid, func.aggregate_strings(Symptom.label, LABEL_SEPARATOR))
+        .group_by(Symptom.userid)
+    )
+
+    signatures = []
+    counts = {}
+    all_counts = {}
+    for user_id, joined_labels in rows:
+        labels = joined_labels.split(LABEL_SEPARATOR)
+        signature = make_signature(labels)
+        signatures.append({'user_id': user_id, 'signature': signature, 'label_count': len(labels)})
+        all_counts[signature] = all_counts.get(signature, 0) + 1
+        if len(labels) >= MIN_PATTERN_SIZE:
+            counts[signature] = counts.get(signature, 0) + 1
+
+    if signatures:
+        db.session.execute(insert(UserSymptomSignature), signatures)
+    if counts:
+        db.session.execute(
+            insert(SymptomPatternCount),
+            [{'signature': signature, 'count': count} for signature, count in counts.items()]
+        )
+    _store_signature_counts(db.session, all_counts, version)
+    return len(signatures)
+
+
+def _store_signature_counts(executor, counts, version):
+    """Writes absolute counts for the signatures, over the rows clear() set to 0."""
+    existing = set(executor.scalars(select(SymptomSignatureCount.signature)))
+    updates = [{'match': signature, 'new_count': count} for signature, count in counts.items() if signature in existing]
+    inserts = [{'signature': signature, 'label_count': len(json.loads(signature)), 'count': count, 'version': version}
+               for signature, count in counts.items() if signature not in existing]
+    if updates:
+        table = SymptomSignatureCount.__table__
+        executor.execute(
+            update(table).where(table.c.signature == bindparam('match')).values(count=bindparam('new_count'), version=version),
+            updates
+        )
+    if inserts:
+        executor.execute(insert(SymptomSignatureCount), inserts)
+
+
+def backfill_signature_counts(connection):
+    """Fills symptom_signature_counts from user_symptom_signatures on a database that predates it."""
+    version = connection.scalar(
+        select(ResourceVersion.version).where(ResourceVersion.scope == versioning.PATTERNS_SCOPE)) or 0
+    counts = dict(connection.execute(
+        select(UserSymptomSignature.signature, func.count()).group_by(UserSymptomSignature.signature)).all())
+    connection.execute(update(SymptomSignatureCount).values(count=0, version=version))
+    _store_signature_counts(connection, counts, version)
@@ -0,0 +1,55 @@
+"""Main queries of the list routes.
+
+The routes and the query plan check in query_plans.py both build their
+queries here, so the check always tests the SQL the routes really run.
+"""
+from sqlalchemy import and_, or_
+
+from models import db, User, Symptom, ActivityLog, ActivityLogArchive, ActivityLogArchiveMember
+
+
+def users_page(fields, after_id=None):
+    query = db.session.query(*[getattr(User, field) for field in fields]).order_by(User.id)
+    if after_id is not None:
+        query = query.filter(User.id > after_id)
+    return query
+
+
+def user_symptoms_page(user_id, fields, after_id=None):
+    query = (db.session.query(*[getattr(Symptom, field) for field in fields])
+             .filter(Symptom.userid == user_id)
+             .order_by(Symptom.id))
+    if after_id is not None:
+        query = query.filter(Symptom.id > after_id)
+    return query
+
+
+def activity_logs_page(user_id, fields, after=None):
+    """Newest entries first; after is the (timestamp, id) of the last entry already seen."""
+    # The id breaks ties between entries logged in the same instant
+    columns = [ActivityLog.id, ActivityLog.timestamp] + [
+        getattr(ActivityLog, field) for field in fields if field != 'timestamp']
+    query = (db.session.query(*columns)
+             .filter(ActivityLog.user_id == user_id)
+             .order_by(ActivityLog.timestamp.desc(), ActivityLog.id.desc()))
+    if after is not None:
+        after_timestamp, after_id = after
+        query = query.filter(or_(
+            ActivityLog.timestamp < after_timestamp,
+            and_(ActivityLog.timestamp == after_timestamp, ActivityLog.id < after_id)
+        ))
+    return query
+
+
+def activity_log_archive_members(user_id, after=None, since=None):
+    """The user's archived entries by file and byte range, newest first; see activity_archive.py."""
+    member = ActivityLogArchiveMember
+    query = (db.session.query(ActivityLogArchive.path, member.offset, member.length, member.max_timestamp)
+             .join(ActivityLogArchive, ActivityLogArchive.id == member.archive_id)
+             .filter(member.user_id == user_id)
+             .order_by(member.max_timestamp.desc()))
+    if after is not None:
+        query = query.filter(member.min_timestamp <= after[0])
+    if since is not None:
+        query = query.filter(member.max_timestamp >= since)
+    return query
@@ -0,0 +1,77 @@
+"""Query plan regression check.
+
+Runs EXPLAIN QUERY PLAN on the main query of every route and reports each
+one that scans a whole table or sorts rows in a temporary b-tree instead of
+reading them in order from an index. Used by "flask check-query-plans";
+only SQLite plans are checked.
+"""
+from datetime import datetime
+
+from sqlalchemy import event
+
+import patterns
+import queries
+from models import db, User, Symptom
+from serializers import USER_FIELDS, SYMPTOM_FIELDS, ACTIVITY_LOG_FIELDS
+
+# Bound values for the sample queries; the plans do not depend on them
+SAMPLE_ID = 1
+SAMPLE_TIMESTAMP = datetime(2024, 1, 1)
+SAMPLE_PAGE_SIZE = 101
+
+
+def route_queries():
+    """The main query of each route, as the route builds it."""
+    return {
+        'get_users': queries.users_page(USER_FIELDS, SAMPLE_ID).limit(SAMPLE_PAGE_SIZE),
+        'get_user': User.query.filter_by(id=SAMPLE_ID),
+        'get_user_symptoms': queries.user_symptoms_page(SAMPLE_ID, SYMPTOM_FIELDS).limit(SAMPLE_PAGE_SIZE),
+        'get_user_symptoms (next page)':
+            queries.user_symptoms_page(SAMPLE_ID, SYMPTOM_FIELDS, SAMPLE_ID).limit(SAMPLE_PAGE_SIZE),
+        'get_symptom': Symptom.query.filter_by(userid=SAMPLE_ID, id=SAMPLE_ID),
+        'get_activity_logs': queries.activity_logs_page(SAMPLE_ID, ACTIVITY_LOG_FIELDS).limit(SAMPLE_PAGE_SIZE),
+        'get_activity_logs (next page)': queries.activity_logs_page(
+            SAMPLE_ID, ACTIVITY_LOG_FIELDS, (SAMPLE_TIMESTAMP, SAMPLE_ID)).limit(SAMPLE_PAGE_SIZE),
+        'get_activity_logs (archived)': queries.activity_log_archive_members(
+            SAMPLE_ID, (SAMPLE_TIMESTAMP, SAMPLE_ID), SAMPLE_TIMESTAMP),
+        'login': User.query.filter_by(username='sample'),
+        'identify_common_symptom_patterns': patterns.top_patterns_query(5),
+        'symptom writes (pattern index refresh)': patterns.labels_query(SAMPLE_ID),
+    }
+
+
+def explain(query):
+    """Returns the detail lines of SQLite's plan for a query."""
+    connection = db.session.connection()
+
+    # Prefix the statement as it is sent, so parameters are bound exactly as the route binds them
+    def add_explain(conn, cursor, statement, parameters, context, executemany):
+        return 'EXPLAIN QUERY PLAN ' + statement, parameters
+
+    event.listen(connection, 'before_cursor_execute', add_explain, retval=True)
+    try:
+        rows = connection.execute(query.statement).cursor.fetchall()
+    finally:
+        event.remove(connection, 'before_cursor_execute', add_explain)
+    return [row[-1] for row in rows]
+
+
+def problems_in(plan):
+    problems = []
+    for detail in plan:
+        if detail.startswith('SCAN') and 'USING' not in detail:
+            problems.append(f'full table scan: {detail}')
+        elif detail.startswith('USE TEMP B-TREE'):
+            problems.append(f'sort without an index: {detail}')
+    return problems
+
+
+def check():
+    """Returns a list of problems, empty when every route query uses an index."""
+    if db.engine.dialect.name != 'sqlite':
+        return []
+    problems = []
+    for name, query in route_queries().items():
+        for problem in problems_in(explain(query)):
+            problems.append(f'{name}: {problem}')
+    return problems
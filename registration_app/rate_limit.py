@@ -0,0 +1,74 @@
+"""Token bucket rate limiting for the login route.
+
+Every key (an IP address, a username) has a bucket holding up to `capacity`
+tokens, refilled at capacity/period tokens per second. An attempt takes a
+token, and is turned away while the bucket is empty. This costs a dict
+lookup, so floods are rejected before any password hashing happens.
+
+Buckets live in process memory, so each worker process limits on its own.
+Only the max_keys most recently used buckets are kept; a dropped bucket
+comes back full.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    def __init__(self, capacity, period, max_keys=100000):
+        self.capacity = capacity
+        self.rate = capacity / period  # Tokens per second
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+
+    def take(self, key):
+        """Takes a token for key. Returns 0 if one was available, otherwise the seconds until one is."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated_at) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0
+            else:
+                retry_after = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class LoginRateLimits:
+    """Per-IP and per-username limits on login attempts, set with LOGIN_RATE_LIMIT_* as [attempts, seconds]."""
+
+    def __init__(self, app=None):
+        self.per_ip = None
+        self.per_user = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LOGIN_RATE_LIMIT_PER_IP', [20, 60])
+        app.config.setdefault('LOGIN_RATE_LIMIT_PER_USER', [10, 60])
+        app.config.setdefault('LOGIN_RATE_LIMIT_MAX_KEYS', 100000)
+
+        max_keys = app.config['LOGIN_RATE_LIMIT_MAX_KEYS']
+        per_ip = app.config['LOGIN_RATE_LIMIT_PER_IP']
+        per_user = app.config['LOGIN_RATE_LIMIT_PER_USER']
+        self.per_ip = TokenBucketLimiter(*per_ip, max_keys=max_keys) if per_ip else None
+        self.per_user = TokenBucketLimiter(*per_user, max_keys=max_keys) if per_user else None
+        app.extensions['login_rate_limits'] = self
+
+    def check(self, ip_address, username):
+        """Counts a login attempt. Returns 0 if it may go ahead, otherwise the seconds to wait."""
+        retry_after = 0
+        if self.per_ip is not None:
+            retry_after = self.per_ip.take(ip_address)
+        # Malformed bodies may carry any JSON as the username; the login handler rejects those
+        if self.per_user is not None and isinstance(username, str):
+            retry_after = max(retry_after, self.per_user.take(username.lower()))
+        return retry_after
+
+
+login_rate_limits = LoginRateLimits()
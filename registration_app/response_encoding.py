@@ -0,0 +1,174 @@
+"""Response encoding: a faster JSON encoder, binary formats and compression.
+
+JSON is encoded with orjson when it is installed (pip install orjson).
+Otherwise Flask's own encoder is used. The output keeps Flask's behaviour:
+sorted keys, indentation in debug mode, and Flask's conversions for types
+orjson leaves to it, such as dates and Decimals. Non-ASCII text is sent as
+UTF-8 rather than escaped.
+
+jsonify() also looks at the Accept header. A client that prefers
+application/msgpack or application/cbor gets the same data in that format,
+if msgpack or cbor2 is installed. ETags include the negotiated format, see
+versioning.py.
+
+Responses of COMPRESSION_MIN_SIZE bytes or more are compressed for clients
+that accept it: with brotli when the brotli package is installed and the
+client accepts br, otherwise with gzip. They get "Vary: Accept-Encoding",
+and their ETag has the encoding appended ("-gzip", "-br") because the
+bytes differ. versioning.py accepts both forms in If-None-Match and
+If-Match. Streamed responses are sent as they are.
+"""
+import gzip
+
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Optional; Flask's encoder gives the same JSON
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+CBOR_MIMETYPE = 'application/cbor'
+
+# Mimetypes worth compressing; binary formats still repeat every key
+COMPRESSIBLE_MIMETYPES = {JSON_MIMETYPE, MSGPACK_MIMETYPE, CBOR_MIMETYPE, 'text/plain', 'text/html'}
+
+
+def _binary_encoders():
+    encoders = {}
+    if msgpack is not None:
+        encoders[MSGPACK_MIMETYPE] = lambda obj, default: msgpack.packb(obj, default=default, use_bin_type=True)
+    if cbor2 is not None:
+        encoders[CBOR_MIMETYPE] = lambda obj, default: cbor2.dumps(
+            obj, default=lambda encoder, value: encoder.encode(default(value)))
+    return encoders
+
+
+BINARY_ENCODERS = _binary_encoders()
+
+
+def negotiated_mimetype():
+    """The format jsonify() answers the current request in."""
+    if not BINARY_ENCODERS or not has_request_context():
+        return JSON_MIMETYPE
+    return request.accept_mimetypes.best_match([JSON_MIMETYPE, *BINARY_ENCODERS]) or JSON_MIMETYPE
+
+
+def content_codings():
+    """The Content-Encodings this process can produce, preferred first."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def etag_variants(etag):
+    """The ETag as sent with each content coding, and as sent uncompressed."""
+    return (etag,) + tuple(f'{etag}-{coding}' for coding in content_codings())
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, encoding with orjson and answering in a binary format when one is preferred."""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self._orjson_dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        mimetype = negotiated_mimetype()
+        if mimetype != JSON_MIMETYPE:
+            obj = self._prepare_response_obj(args, kwargs)
+            response = self._app.response_class(BINARY_ENCODERS[mimetype](obj, self.default), mimetype=mimetype)
+        elif orjson is None:
+            response = super().response(*args, **kwargs)
+        else:
+            obj = self._prepare_response_obj(args, kwargs)
+            indent = (self.compact is None and self._app.debug) or self.compact is False
+            response = self._app.response_class(self._orjson_dumps(obj, indent) + b'\n', mimetype=self.mimetype)
+        if BINARY_ENCODERS:
+            response.vary.add('Accept')
+        return response
+
+    def _orjson_dumps(self, obj, indent=False):
+        # Dates go to Flask's default, which sends them as HTTP dates like the standard encoder
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option)
+
+
+class ResponseEncoding:
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESSION_MIN_SIZE', 1024)  # Bytes; null disables compression
+        app.config.setdefault('COMPRESSION_GZIP_LEVEL', 6)
+        app.config.setdefault('COMPRESSION_BROTLI_QUALITY', 4)
+
+        self.app = app
+        app.json = FastJSONProvider(app)
+        app.extensions['response_encoding'] = self
+        if app.config['COMPRESSION_MIN_SIZE'] is not None:
+            app.after_request(self._compress)
+
+    def _compress(self, response):
+        if response.status_code == 304:
+            return self._echo_etag(response)
+        if (response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES or not 200 <= response.status_code < 300):
+            return response
+        data = response.get_data()
+        if len(data) < self.app.config['COMPRESSION_MIN_SIZE']:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        coding = request.accept_encodings.best_match(content_codings())
+        if coding is None:
+            return response
+        if coding == 'br':
+            response.set_data(brotli.compress(data, quality=self.app.config['COMPRESSION_BROTLI_QUALITY']))
+        else:
+            response.set_data(gzip.compress(data, self.app.config['COMPRESSION_GZIP_LEVEL'], mtime=0))
+        response.headers['Content-Encoding'] = coding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{coding}', weak)
+        return response
+
+    def _echo_etag(self, response):
+        # A 304 carries the ETag the client holds, which names its content coding
+        etag, weak = response.get_etag()
+        if etag:
+            for variant in etag_variants(etag)[1:]:
+                if request.if_none_match.contains(variant):
+                    response.set_etag(variant, weak)
+                    break
+        return response
+
+
+response_encoding = ResponseEncoding()
@@ -0,0 +1,268 @@
+"""Bulk generation of synthetic users, symptoms and activity logs.
+
+Used by /fill_database, "flask seed" and benchmark.py. Everything runs in
+one transaction:
+
+- Every generated user shares one password, so it is hashed only once.
+- Rows are generated in chunks and written with Core executemany inserts
+  rather than through the ORM. Users get explicit ids, so their usernames
+  can include them; on PostgreSQL the id sequence is moved past them.
+- On SQLite the connection runs with relaxed pragmas during the load (no
+  fsync, a larger page cache). SQLite only lets synchronous change outside
+  a transaction, so they are set back when the connection returns to the
+  pool after the commit.
+
+What gets generated is described by a distribution config, see
+DEFAULT_DISTRIBUTION. A config passed to seed() only needs the keys it
+changes.
+"""
+import functools
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, event, func, insert, select, text
+from sqlalchemy.pool import Pool
+
+from models import db, User, Symptom, ActivityLog, UserSymptomSignature
+from cache import resource_cache
+from credentials import credentials
+import analytics
+import patterns
+import versioning
+
+DEFAULT_PASSWORD = 'password123'
+CHUNK_SIZE = 5000
+
+MALE_NAMES = ['Bob', 'Charlie', 'David', 'Frank', 'Hank', 'Jack', 'Leo', 'Oscar', 'Paul', 'Quinn', 'Steve', 'Victor', 'Xander', 'Zack', 'Oliver', 'Liam', 'Noah', 'Lucas', 'Ethan', 'James', 'Benjamin', 'Alexander', 'William', 'Henry', 'Sebastian']
+FEMALE_NAMES = ['Alice', 'Eva', 'Grace', 'Ivy', 'Karen', 'Mona', 'Nina', 'Rachel', 'Tina', 'Uma', 'Wendy', 'Yara', 'Sophia', 'Emma', 'Ava', 'Mia', 'Amelia', 'Isabella', 'Harper', 'Evelyn', 'Abigail', 'Emily', 'Ella', 'Chloe']
+ACTIONS = [('Get User Symptoms', 'GET', 200), ('Add Symptom', 'POST', 201), ('Update Symptom', 'PUT', 200),
+           ('Delete Symptom', 'DELETE', 200)]
+
+# Order of the values in the generated rows
+USER_COLUMNS = ['id', 'username', 'password', 'age', 'gender', 'location']
+SYMPTOM_COLUMNS = ['userid', 'label', 'description', 'timestamp']
+ACTIVITY_LOG_COLUMNS = ['user_id', 'action', 'endpoint', 'method', 'ip_address', 'timestamp', 'status_code']
+
+# Weights are relative; equal weights give the same data /fill_database always generated
+DEFAULT_DISTRIBUTION = {
+    'symptoms_per_user': [1, 3],
+    'activity_logs_per_user': 0,
+    # Symptoms are dated today, yesterday, ... unless this spreads them at random over the last N days
+    'history_days': 0,
+    'age': [18, 65],
+    'genders': {'M': 1, 'F': 1},
+    'locations': {location: 1 for location in [
+        'Oslo', 'Bergen', 'Trondheim', 'Stavanger', 'Kristiansand', 'Drammen', 'Tromsø', 'Bodø']},
+    'labels': {label: 1 for label in [
+        'fever', 'cough', 'headache', 'fatigue', 'sore throat', 'muscle pain', 'nausea', 'shortness of breath',
+        'runny nose', 'loss of taste', 'loss of smell', 'diarrhea']},
+}
+
+# Applied to the loading connection on SQLite, and set back when it is checked in
+RELAXED_SQLITE_PRAGMAS = {
+    'synchronous': 'OFF',
+    'cache_size': -262144,  # 256 MiB, so the load rarely spills pages before the commit
+    'temp_store': 'MEMORY',
+}
+
+
+class DistributionError(ValueError):
+    pass
+
+
+def _range(config, key, minimum):
+    value = config[key]
+    if (not isinstance(value, (list, tuple)) or len(value) != 2
+            or not all(isinstance(bound, int) for bound in value) or not minimum <= value[0] <= value[1]):
+        raise DistributionError(f'{key} must be [min, max] with {minimum} <= min <= max')
+    return tuple(value)
+
+
+def _weights(config, key):
+    value = config[key]
+    if (not isinstance(value, dict) or not value
+            or not all(isinstance(weight, (int, float)) and weight >= 0 for weight in value.values())
+            or not any(value.values())):
+        raise DistributionError(f'{key} must map each value to a non-negative weight')
+    return list(value), list(value.values())
+
+
+def distribution(overrides=None):
+    """Merges overrides into DEFAULT_DISTRIBUTION and validates the result."""
+    overrides = overrides or {}
+    if not isinstance(overrides, dict):
+        raise DistributionError('The distribution config must be an object')
+    unknown = set(overrides) - set(DEFAULT_DISTRIBUTION)
+    if unknown:
+        raise DistributionError(f"Unknown distribution keys: {', '.join(sorted(unknown))}")
+    config = {**DEFAULT_DISTRIBUTION, **overrides}
+
+    activity_logs = config['activity_logs_per_user']
+    if not isinstance(activity_logs, int) or activity_logs < 0:
+        raise DistributionError('activity_logs_per_user must be a non-negative integer')
+    history_days = config['history_days']
+    if not isinstance(history_days, int) or history_days < 0:
+        raise DistributionError('history_days must be a non-negative integer')
+    labels, label_weights = _weights(config, 'labels')
+    symptoms_per_user = _range(config, 'symptoms_per_user', 0)
+    if symptoms_per_user[1] > sum(1 for weight in label_weights if weight):
+        raise DistributionError('symptoms_per_user can not exceed the number of labels with a weight')
+    return {
+        'symptoms_per_user': symptoms_per_user,
+        'activity_logs_per_user': activity_logs,
+        'history_days': history_days,
+        'age': _range(config, 'age', 0),
+        'genders': _weights(config, 'genders'),
+        'locations': _weights(config, 'locations'),
+        'labels': (labels, label_weights),
+    }
+
+
+def with_symptom_range(config, minimum=None, maximum=None):
+    """Returns a copy of config with either end of symptoms_per_user replaced where given."""
+    config = dict(config or {})
+    if minimum is not None or maximum is not None:
+        low, high = config.get('symptoms_per_user', DEFAULT_DISTRIBUTION['symptoms_per_user'])
+        config['symptoms_per_user'] = [low if minimum is None else minimum, high if maximum is None else maximum]
+    return config
+
+
+def _pick_labels(rng, labels, weights, count):
+    if count == 0:
+        return []
+    if len(set(weights)) == 1:
+        return rng.sample(labels, count)
+    # Weighted sampling without replacement; draws repeat until enough distinct labels came up
+    picked = {}
+    while len(picked) < count:
+        for label in rng.choices(labels, weights, k=count - len(picked)):
+            picked.setdefault(label, None)
+    return list(picked)
+
+
+def _insert_chunks(connection, table, columns, rows, chunk_size):
+    """Inserts rows given as tuples in the order of columns, with the driver's executemany.
+
+    The statement is compiled once and the rows skip SQLAlchemy's per-row
+    parameter handling, which otherwise costs more than the inserts.
+    """
+    dialect = connection.dialect
+    compiled = insert(table).compile(dialect=dialect, column_keys=columns)
+    processors = [table.c[column].type.dialect_impl(dialect).bind_processor(dialect) for column in columns]
+    # The generated values repeat a lot, the timestamps especially, so conversions are cached
+    processors = [functools.lru_cache(maxsize=1024)(process) if process else None for process in processors]
+    if compiled.positional:
+        order = [columns.index(name) for name in compiled.positiontup]
+
+    def parameters(row):
+        values = [process(value) if process else value for process, value in zip(processors, row)]
+        if compiled.positional:
+            return tuple(values[index] for index in order)
+        return dict(zip(columns, values))
+
+    chunk = []
+    for row in rows:
+        chunk.append(parameters(row))
+        if len(chunk) >= chunk_size:
+            connection.exec_driver_sql(compiled.string, chunk)
+            chunk = []
+    if chunk:
+        connection.exec_driver_sql(compiled.string, chunk)
+
+
+def _set_pragmas(dbapi_connection, pragmas):
+    """Sets the pragmas on the driver connection and returns their previous values."""
+    cursor = dbapi_connection.cursor()
+    try:
+        previous = {}
+        for name, value in pragmas.items():
+            previous[name] = cursor.execute(f'PRAGMA {name}').fetchone()[0]
+            cursor.execute(f'PRAGMA {name}={value}')
+        return previous
+    finally:
+        cursor.close()
+
+
+@event.listens_for(Pool, 'checkin')
+def _restore_pragmas(dbapi_connection, connection_record):
+    previous = connection_record.info.pop('seeding_pragmas', None) if connection_record is not None else None
+    if previous:
+        _set_pragmas(dbapi_connection, previous)
+
+
+def _advance_user_id_sequence(connection):
+    # The users are inserted with explicit ids, which do not move a PostgreSQL SERIAL sequence;
+    # without this the next registration would be given an id the seed already used
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("SELECT setval(pg_get_serial_sequence('users', 'id'), max(id)) FROM users"))
+
+
+def seed(users, config=None, rng_seed=None, replace=False, chunk_size=CHUNK_SIZE):
+    """Adds `users` users with their symptoms and activity logs in one transaction, and commits.
+
+    With replace=True the existing users, their symptoms and their activity logs are
+    deleted first, in the same transaction. Returns the number of rows written per table.
+    """
+    config = distribution(config)
+    rng = random.Random(rng_seed)
+    password_hash = credentials.hash_password(DEFAULT_PASSWORD)
+    connection = db.session.connection()
+    counts = {'users': users, 'symptoms': 0, 'activity_logs': 0}
+
+    dbapi_connection = connection.connection.driver_connection
+    if connection.dialect.name == 'sqlite' and not dbapi_connection.in_transaction:
+        connection.info['seeding_pragmas'] = _set_pragmas(dbapi_connection, RELAXED_SQLITE_PRAGMAS)
+    try:
+        if replace:
+            # Everything that references the users goes first, or enforced foreign keys refuse the delete
+            connection.execute(delete(UserSymptomSignature.__table__))
+            connection.execute(delete(ActivityLog.__table__))
+            connection.execute(delete(Symptom.__table__))
+            connection.execute(delete(User.__table__))
+
+        first_id = (connection.scalar(select(func.max(User.id))) or 0) + 1
+        user_ids = range(first_id, first_id + users)
+        now = datetime.utcnow()
+        genders, gender_weights = config['genders']
+        locations, location_weights = config['locations']
+        labels, label_weights = config['labels']
+        history_days = config['history_days']
+
+        def user_rows():
+            for user_id in user_ids:
+                gender = rng.choices(genders, gender_weights)[0]
+                names = MALE_NAMES if gender == 'M' else FEMALE_NAMES if gender == 'F' else MALE_NAMES + FEMALE_NAMES
+                yield (user_id, f'{rng.choice(names)}_{user_id}', password_hash, rng.randint(*config['age']),
+                       gender, rng.choices(locations, location_weights)[0])
+
+        def symptom_rows():
+            for user_id in user_ids:
+                count = rng.randint(*config['symptoms_per_user'])
+                for index, label in enumerate(_pick_labels(rng, labels, label_weights, count)):
+                    counts['symptoms'] += 1
+                    days_ago = rng.randrange(history_days) if history_days else index
+                    yield (user_id, label, f'{label} experienced by user {user_id} on day {index + 1}',
+                           now - timedelta(days=days_ago))
+
+        def activity_log_rows():
+            for user_id in user_ids:
+                for index in range(config['activity_logs_per_user']):
+                    action, method, status_code = rng.choice(ACTIONS)
+                    counts['activity_logs'] += 1
+                    yield (user_id, action, f'/users/{user_id}/symptoms', method, '127.0.0.1',
+                           now - timedelta(minutes=index), status_code)
+
+        _insert_chunks(connection, User.__table__, USER_COLUMNS, user_rows(), chunk_size)
+        _insert_chunks(connection, Symptom.__table__, SYMPTOM_COLUMNS, symptom_rows(), chunk_size)
+        _insert_chunks(connection, ActivityLog.__table__, ACTIVITY_LOG_COLUMNS, activity_log_rows(), chunk_size)
+        _advance_user_id_sequence(connection)
+        patterns.rebuild()
+        analytics.rebuild()
+        versioning.bump(versioning.GLOBAL_SCOPE)
+    except Exception:
+        db.session.rollback()
+        raise
+    db.session.commit()
+    resource_cache.clear()
+    credentials.clear()
+    return counts
@@ -0,0 +1,141 @@
+"""JSON representations of users, symptoms and activity logs.
+
+HATEOAS links are not built with url_for for every object. The first
+request for a host compiles one URL template per linked endpoint, and the
+ids are filled in with string formatting after that, so serializing a
+long list costs a format call per link instead of a full URL build.
+
+With "?links=minimal" the per-item links are left out altogether; ids are
+enough for clients that build URLs themselves. Page links stay.
+"""
+import threading
+from datetime import datetime
+
+from flask import request, url_for
+
+# Columns that can be requested with the "fields" parameter on list endpoints
+USER_FIELDS = ('id', 'username', 'age', 'gender', 'location')
+SYMPTOM_FIELDS = ('id', 'label', 'description', 'timestamp')
+ACTIVITY_LOG_FIELDS = ('action', 'endpoint', 'method', 'ip_address', 'timestamp', 'status_code')
+
+# URL arguments of every endpoint that appears in links
+LINKED_ENDPOINTS = {
+    'get_user': ('user_id',),
+    'get_user_symptoms': ('user_id',),
+    'update_user': ('user_id',),
+    'delete_user': ('user_id',),
+    'get_symptom': ('user_id', 'symptom_id'),
+    'update_symptom': ('user_id', 'symptom_id'),
+    'delete_symptom': ('user_id', 'symptom_id'),
+}
+
+# Stand-in ids that url_for fills in and are then swapped for format fields
+_PLACEHOLDER_IDS = {'user_id': 987650001, 'symptom_id': 987650002}
+
+# The Host header comes from the client, so only this many hosts are remembered
+MAX_CACHED_HOSTS = 32
+
+
+class LinkTemplates:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_host = {}
+
+    def get(self):
+        """Returns the templates for the current request's scheme, host and script root."""
+        host_url = request.host_url
+        templates = self._by_host.get(host_url)
+        if templates is None:
+            templates = self._compile()
+            with self._lock:
+                if len(self._by_host) >= MAX_CACHED_HOSTS:
+                    self._by_host.clear()
+                self._by_host[host_url] = templates
+        return templates
+
+    def _compile(self):
+        templates = {}
+        for endpoint, args in LINKED_ENDPOINTS.items():
+            url = url_for(endpoint, _external=True, **{arg: _PLACEHOLDER_IDS[arg] for arg in args})
+            url = url.replace('{', '{{').replace('}', '}}')
+            for arg in args:
+                url = url.replace(str(_PLACEHOLDER_IDS[arg]), '{' + arg + '}')
+            templates[endpoint] = url
+        return templates
+
+
+link_templates = LinkTemplates()
+
+
+def minimal_links():
+    """True if the client asked for links=minimal, which leaves out the links of each item."""
+    return request.args.get('links') == 'minimal'
+
+
+def record(row, fields):
+    """Plain dict of the given columns of an ORM object or a selected row."""
+    item = {}
+    for field in fields:
+        value = getattr(row, field)
+        item[field] = value.isoformat() if isinstance(value, datetime) else value
+    return item
+
+
+def user_links(user_id, templates, detail=False):
+    links = {
+        'self': templates['get_user'].format(user_id=user_id),
+        'symptoms': templates['get_user_symptoms'].format(user_id=user_id)
+    }
+    if detail:
+        links['update'] = templates['update_user'].format(user_id=user_id)
+        links['delete'] = templates['delete_user'].format(user_id=user_id)
+    return links
+
+
+def symptom_links(user_id, symptom_id, templates):
+    return {
+        'self': templates['get_symptom'].format(user_id=user_id, symptom_id=symptom_id),
+        'user': templates['get_user'].format(user_id=user_id),
+        'update': templates['update_symptom'].format(user_id=user_id, symptom_id=symptom_id),
+        'delete': templates['delete_symptom'].format(user_id=user_id, symptom_id=symptom_id)
+    }
+
+
+def with_user_links(user_dict, detail=False, templates=None):
+    """Copy of a user record with its links added; cached records are never modified."""
+    if templates is None:
+        if minimal_links():
+            return dict(user_dict)
+        templates = link_templates.get()
+    return {**user_dict, 'links': user_links(user_dict['id'], templates, detail)}
+
+
+def with_symptom_links(symptom_dict, user_id, templates=None):
+    if templates is None:
+        if minimal_links():
+            return dict(symptom_dict)
+        templates = link_templates.get()
+    return {**symptom_dict, 'links': symptom_links(user_id, symptom_dict['id'], templates)}
+
+
+def serialize_user(user, fields=USER_FIELDS, detail=False, templates=None):
+    return with_user_links(record(user, fields), detail, templates)
+
+
+def serialize_users(users, fields=USER_FIELDS):
+    if minimal_links():
+        return [record(user, fields) for user in users]
+    templates = link_templates.get()
+    return [serialize_user(user, fields, templates=templates) for user in users]
+
+
+def serialize_symptom(symptom, user_id, fields=SYMPTOM_FIELDS, templates=None):
+    return with_symptom_links(record(symptom, fields), user_id, templates)
+
+
+def link_symptoms(symptom_dicts, user_id):
+    """Adds links to a list of symptom records."""
+    if minimal_links():
+        return list(symptom_dicts)
+    templates = link_templates.get()
+    return [with_symptom_links(symptom_dict, user_id, templates) for symptom_dict in symptom_dicts]
@@ -0,0 +1,36 @@
+"""Streaming NDJSON export for the bulk read endpoints.
+
+A client asks for a stream with "Accept: application/x-ndjson" or
+"?stream=1". The query is then walked with yield_per (any other iterable
+of rows as it comes) and every row is written out as one JSON line as
+soon as it is serialized, so memory use stays flat and the first bytes go
+out before the query is exhausted.
+"""
+from flask import Response, json, request, stream_with_context
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Rows fetched from the database cursor at a time, and sent per chunk
+STREAM_BATCH_SIZE = 1000
+
+
+def wants_stream():
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def ndjson_response(query, serialize, batch_size=STREAM_BATCH_SIZE):
+    """Streams every row of `query`, or of an iterable of rows, as a line of JSON built by `serialize`."""
+    def generate():
+        lines = []
+        rows = query.yield_per(batch_size) if hasattr(query, 'yield_per') else query
+        for row in rows:
+            lines.append(json.dumps(serialize(row)))
+            if len(lines) >= batch_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
@@ -0,0 +1,140 @@
+"""Parsing, validation and upsert of symptom batches.
+
+Used by POST /users/<id>/symptoms:batch. Every valid item of a batch is
+written with a single executemany INSERT ... ON CONFLICT statement against
+the unique_user_symptom constraint (userid, description), so a symptom
+that already exists has its label updated instead of failing the batch.
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import select
+
+from models import db, Symptom
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Descriptions looked up per query when classifying items as created or updated,
+# kept below SQLite's limit on bound parameters
+LOOKUP_CHUNK_SIZE = 500
+
+LABEL_MAX_LENGTH = Symptom.__table__.c.label.type.length
+DESCRIPTION_MAX_LENGTH = Symptom.__table__.c.description.type.length
+
+
+class BatchError(ValueError):
+    """Raised when the request body as a whole cannot be read as a batch."""
+
+
+def parse_items(request):
+    """Returns the batch as a list where unparsable NDJSON lines are kept as errors."""
+    if request.mimetype == NDJSON_MIMETYPE:
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(BatchError(f'Invalid JSON: {str(e)}'))
+        return items
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise BatchError('Body must be a JSON array of symptoms or NDJSON with one symptom per line')
+    return data
+
+
+def validate(item):
+    """Returns (row, errors) for one item of the batch."""
+    if isinstance(item, BatchError):
+        return None, [str(item)]
+    if not isinstance(item, dict):
+        return None, ['Item must be a JSON object']
+
+    errors = []
+    label = item.get('label')
+    description = item.get('description')
+    if not isinstance(label, str) or not label.strip():
+        errors.append('label is required')
+    elif len(label) > LABEL_MAX_LENGTH:
+        errors.append(f'label must be at most {LABEL_MAX_LENGTH} characters')
+    if not isinstance(description, str) or not description.strip():
+        errors.append('description is required')
+    elif len(description) > DESCRIPTION_MAX_LENGTH:
+        errors.append(f'description must be at most {DESCRIPTION_MAX_LENGTH} characters')
+
+    row = {'label': label, 'description': description}
+    if item.get('timestamp') is not None:
+        try:
+            row['timestamp'] = datetime.fromisoformat(item['timestamp'])
+        except (TypeError, ValueError):
+            errors.append('timestamp must be an ISO 8601 date and time')
+    return (None, errors) if errors else (row, [])
+
+
+def _upsert_statement():
+    dialect = db.session.get_bind(mapper=Symptom.__mapper__).dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise RuntimeError(f'Batch upsert is not supported on {dialect}')
+
+    statement = insert(Symptom.__table__)
+    return statement.on_conflict_do_update(
+        index_elements=['userid', 'description'],
+        set_={'label': statement.excluded.label}
+    ).returning(Symptom.__table__.c.id, Symptom.__table__.c.description)
+
+
+def _existing_descriptions(user_id, descriptions):
+    existing = set()
+    descriptions = list(descriptions)
+    for start in range(0, len(descriptions), LOOKUP_CHUNK_SIZE):
+        chunk = descriptions[start:start + LOOKUP_CHUNK_SIZE]
+        existing.update(db.session.scalars(
+            select(Symptom.description).where(Symptom.userid == user_id, Symptom.description.in_(chunk))
+        ))
+    return existing
+
+
+def upsert(user_id, items):
+    """Validates and writes the items in the current transaction.
+
+    Returns one result per item, in order. Within the batch the last item
+    for a description wins and earlier ones are reported as superseded.
+    The caller commits.
+    """
+    results = [None] * len(items)
+    rows_by_description = {}
+    for index, item in enumerate(items):
+        row, errors = validate(item)
+        if errors:
+            results[index] = {'index': index, 'status': 'invalid', 'errors': errors}
+            continue
+        previous = rows_by_description.get(row['description'])
+        if previous is not None:
+            results[previous[0]] = {'index': previous[0], 'status': 'superseded', 'superseded_by': index}
+        rows_by_description[row['description']] = (index, dict(row, userid=user_id))
+
+    if rows_by_description:
+        existing = _existing_descriptions(user_id, rows_by_description)
+        # Items without a timestamp get the column default; keep both kinds in
+        # separate statements so every row of an executemany has the same keys
+        with_timestamp = [row for _, row in rows_by_description.values() if 'timestamp' in row]
+        without_timestamp = [row for _, row in rows_by_description.values() if 'timestamp' not in row]
+        ids = {}
+        for rows in (with_timestamp, without_timestamp):
+            if rows:
+                for symptom_id, description in db.session.execute(_upsert_statement(), rows):
+                    ids[description] = symptom_id
+
+        for description, (index, _) in rows_by_description.items():
+            results[index] = {
+                'index': index,
+                'status': 'updated' if description in existing else 'created',
+                'id': ids.get(description)
+            }
+    return results
@@ -0,0 +1,43 @@
+"""Test setup: the app against a throwaway SQLite database.
+
+The modules import each other by their bare names and app.py reads its
+configuration when imported, so the path and the FLASK_ environment
+variables are set here, before any test module imports them.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+_TEST_DIR = tempfile.mkdtemp(prefix='registration_app_tests_')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(_TEST_DIR, 'test.db')
+os.environ['FLASK_PASSWORD_VERIFY_WORKERS'] = '0'
+os.environ['FLASK_ACTIVITY_LOG_COMPACTION_INTERVAL'] = 'null'
+os.environ['FLASK_ACTIVITY_LOG_ARCHIVE_DIR'] = os.path.join(_TEST_DIR, 'activity_archive')
+os.environ['FLASK_ACTIVITY_LOG_SPILL_PATH'] = os.path.join(_TEST_DIR, 'activity_log_spill.ndjson')
+
+
+@pytest.fixture
+def app():
+    from app import app
+    from cache import resource_cache
+    from credentials import credentials
+    from models import db
+    from rate_limit import login_rate_limits
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        resource_cache.clear()
+        credentials.clear()
+        login_rate_limits.init_app(app)  # Fresh buckets; every test client logs in from 127.0.0.1
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,82 @@
+import random
+from datetime import datetime, timedelta
+
+from activity_archive import activity_archiver, newest_first
+from models import db, ActivityLog
+
+NOW = datetime(2026, 6, 1)
+
+
+def add_logs(rnd, user_ids, count, start, end):
+    span = int((end - start).total_seconds())
+    logs = [ActivityLog(user_id=rnd.choice(user_ids), action='Get User Symptoms', endpoint='/users/1/symptoms',
+                        method='GET', ip_address='127.0.0.1', status_code=200,
+                        timestamp=start + timedelta(seconds=rnd.randrange(span)))
+            for _ in range(count)]
+    db.session.add_all(logs)
+    db.session.commit()
+
+
+def table_order(user_id):
+    rows = db.session.execute(
+        db.select(ActivityLog.timestamp, ActivityLog.id)
+        .where(ActivityLog.user_id == user_id)
+        .order_by(ActivityLog.timestamp.desc(), ActivityLog.id.desc())).all()
+    return [tuple(row) for row in rows]
+
+
+def archived_order(user_id, after=None, since=None):
+    return [(entry.timestamp, entry.id) for entry in activity_archiver.user_logs(user_id, after, since)]
+
+
+def test_user_logs_are_newest_first_across_archives(app):
+    rnd = random.Random(1)
+    add_logs(rnd, [1, 2, 3], 300, datetime(2025, 9, 1), datetime(2026, 5, 1))
+    before = {user_id: table_order(user_id) for user_id in (1, 2, 3)}
+
+    result = activity_archiver.compact(NOW)
+    assert result['archived'] > 0 and result['archives_written'] > 1
+
+    for user_id, expected in before.items():
+        hot = table_order(user_id)
+        archived = archived_order(user_id)
+        assert archived == sorted(archived, reverse=True)
+        assert sorted(hot + archived, reverse=True) == expected
+        if hot:
+            assert all(entry < hot[-1] for entry in archived)
+
+
+def test_user_logs_merge_entries_archived_late(app):
+    rnd = random.Random(2)
+    add_logs(rnd, [1], 50, datetime(2025, 10, 1), datetime(2026, 1, 1))
+    activity_archiver.compact(NOW)
+    # Entries that reach the table after their month was archived, e.g. replayed from the spill file
+    add_logs(rnd, [1], 20, datetime(2025, 10, 1), datetime(2026, 1, 1))
+    activity_archiver.compact(NOW)
+
+    archived = archived_order(1)
+    assert len(archived) == 70
+    assert archived == sorted(archived, reverse=True)
+
+
+def test_user_logs_resume_after_a_cursor(app):
+    rnd = random.Random(3)
+    add_logs(rnd, [1, 2], 120, datetime(2025, 11, 1), datetime(2026, 2, 1))
+    activity_archiver.compact(NOW)
+
+    archived = archived_order(1)
+    after = archived[len(archived) // 2]
+    assert archived_order(1, after=after) == archived[len(archived) // 2 + 1:]
+
+
+def test_newest_first_merges_table_rows_and_archived_entries(app):
+    rnd = random.Random(4)
+    add_logs(rnd, [1], 80, datetime(2025, 12, 1), datetime(2026, 5, 30))
+    expected = table_order(1)
+    activity_archiver.compact(NOW)
+
+    hot = db.session.execute(
+        db.select(ActivityLog).where(ActivityLog.user_id == 1)
+        .order_by(ActivityLog.timestamp.desc(), ActivityLog.id.desc())).scalars().all()
+    merged = [(entry.timestamp, entry.id) for entry in newest_first(hot, activity_archiver.user_logs(1))]
+    assert merged == expected
@@ -0,0 +1,62 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import analytics
+from models import db, Symptom, User
+
+
+def rollups():
+    return {table.__tablename__: sorted(tuple(row) for row in db.session.execute(db.select(table.__table__)))
+            for table, _ in analytics.ROLLUPS}
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_apply_difference_matches_rebuild(app, seed):
+    rnd = random.Random(seed)
+    users = [User(username=f'user_{i}', password='x', age=rnd.choice([None, 5, 34, 67, 95]),
+                  gender=rnd.choice([None, 'female', 'male']), location=rnd.choice([None, 'Oslo', 'Lima']))
+             for i in range(15)]
+    db.session.add_all(users)
+    db.session.commit()
+
+    for step in range(80):
+        user = rnd.choice(users)
+        before = analytics.snapshot(user.id)
+        action = rnd.random()
+        if action < 0.55:
+            db.session.add(Symptom(userid=user.id, label=rnd.choice(['fever', 'cough', 'rash']),
+                                   description=f'symptom {step}',
+                                   timestamp=datetime(2024, 1, 1) + timedelta(days=rnd.randint(0, 9))))
+        elif action < 0.8:
+            symptom = Symptom.query.filter_by(userid=user.id).first()
+            if symptom is not None:
+                db.session.delete(symptom)
+        else:
+            user.age = rnd.randint(0, 99)
+            user.location = rnd.choice(['Oslo', 'Lima', 'Pune'])
+        db.session.flush()
+        analytics.apply_difference(before, analytics.snapshot(user.id))
+        db.session.commit()
+
+    incremental = rollups()
+    analytics.rebuild()
+    db.session.commit()
+    assert incremental == rollups()
+    assert all(row[-1] > 0 for rows in incremental.values() for row in rows)
+
+
+def test_forget_user_removes_their_counts(app):
+    user = User(username='someone', password='x', age=30, gender='female', location='Oslo')
+    db.session.add(user)
+    db.session.flush()
+    db.session.add(Symptom(userid=user.id, label='fever', description='hot', timestamp=datetime(2024, 3, 1)))
+    db.session.flush()
+    analytics.apply_difference({}, analytics.snapshot(user.id))
+    db.session.commit()
+    assert all(rollups().values())
+
+    analytics.forget_user(user.id)
+    db.session.commit()
+    assert not any(rollups().values())
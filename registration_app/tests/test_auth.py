@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+import pytest
+from flask_jwt_extended import create_access_token
+from flask_jwt_extended.exceptions import RevokedTokenError
+
+from auth import TokenAuth, token_auth
+
+
+def login(client, username='frank'):
+    client.post('/auth/register', json={'username': username, 'password': 'secret'})
+    response = client.post('/auth/login', json={'username': username, 'password': 'secret'})
+    assert response.status_code == 200
+    body = response.get_json()
+    return body['user']['id'], {'Authorization': f"Bearer {body['token']}"}
+
+
+def test_token_is_rejected_after_logout(app, client):
+    user_id, headers = login(client)
+    assert client.get(f'/users/{user_id}/symptoms', headers=headers).status_code == 200
+    assert client.get(f'/users/{user_id}/symptoms', headers=headers).status_code == 200  # From the claims cache
+
+    assert client.post('/auth/logout', headers=headers).status_code == 200
+    assert client.get(f'/users/{user_id}/symptoms', headers=headers).status_code == 401
+    assert client.post('/auth/logout', headers=headers).status_code == 401
+
+    _, new_headers = login(client)
+    assert client.get(f'/users/{user_id}/symptoms', headers=new_headers).status_code == 200
+
+
+def test_logout_reaches_other_processes_through_the_table(app, client, monkeypatch):
+    user_id, headers = login(client)
+    monkeypatch.setitem(app.extensions, 'token_auth', token_auth)  # Restored after the second instance registers
+    other_process = TokenAuth(app)
+    with app.test_request_context(headers=headers):
+        assert other_process.authenticate().user_id == user_id
+
+    assert client.post('/auth/logout', headers=headers).status_code == 200
+    other_process._next_refresh = 0  # The refresh interval has passed
+    with app.test_request_context(headers=headers), pytest.raises(RevokedTokenError):
+        other_process.authenticate()
+
+
+def test_expired_and_missing_tokens_are_refused(app, client):
+    user_id, headers = login(client)
+    expired = create_access_token(identity=user_id, expires_delta=timedelta(seconds=-1))
+    assert client.get(f'/users/{user_id}/symptoms',
+                      headers={'Authorization': f'Bearer {expired}'}).status_code == 401
+    assert client.get(f'/users/{user_id}/symptoms').status_code == 401
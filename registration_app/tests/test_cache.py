@@ -0,0 +1,77 @@
+from flask_jwt_extended import create_access_token
+
+from cache import LRUCache, ResourceCache
+from models import db, Symptom, User
+
+
+def auth_headers(user_id):
+    return {'Authorization': f'Bearer {create_access_token(identity=user_id)}'}
+
+
+def add_user_with_symptom():
+    user = User(username='cached', password='x', age=30)
+    db.session.add(user)
+    db.session.flush()
+    symptom = Symptom(userid=user.id, label='fever', description='hot')
+    db.session.add(symptom)
+    db.session.commit()
+    return user.id, symptom.id
+
+
+def symptom_labels(client, user_id):
+    response = client.get(f'/users/{user_id}/symptoms', headers=auth_headers(user_id))
+    assert response.status_code == 200
+    return sorted(symptom['label'] for symptom in response.get_json()['symptoms'])
+
+
+def test_load_racing_an_invalidation_is_not_cached():
+    resource_cache = ResourceCache()
+    resource_cache.backend = LRUCache()
+
+    def load_then_write():
+        resource_cache.invalidate('user:1')  # A write commits while the old row is being read
+        return {'age': 30}
+
+    assert resource_cache.get_or_load('user:1', load_then_write) == {'age': 30}
+    assert resource_cache.backend.get('user:1') is None
+    assert resource_cache.stats()['stale_loads'] == 1
+    assert resource_cache.get_or_load('user:1', lambda: {'age': 31}) == {'age': 31}
+    assert resource_cache.backend.get('user:1') == {'age': 31}
+
+
+def test_update_and_delete_user_invalidate_the_user(app, client):
+    user = User(username='cached', password='x', age=30)
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    assert client.get(f'/users/{user_id}').get_json()['age'] == 30
+
+    assert client.put(f'/users/{user_id}', json={'age': 31}).status_code == 200
+    assert client.get(f'/users/{user_id}').get_json()['age'] == 31
+
+    assert client.delete(f'/users/{user_id}').status_code == 200
+    assert client.get(f'/users/{user_id}').status_code == 404
+
+
+def test_symptom_writes_invalidate_records_and_pages(app, client):
+    user_id, symptom_id = add_user_with_symptom()
+    headers = auth_headers(user_id)
+    assert symptom_labels(client, user_id) == ['fever']
+    assert client.get(f'/users/{user_id}/symptoms/{symptom_id}').get_json()['label'] == 'fever'
+
+    assert client.put(f'/users/{user_id}/symptoms/{symptom_id}', json={'label': 'chills'},
+                      headers=headers).status_code == 200
+    assert client.get(f'/users/{user_id}/symptoms/{symptom_id}').get_json()['label'] == 'chills'
+    assert symptom_labels(client, user_id) == ['chills']
+
+    assert client.post(f'/users/{user_id}/symptoms', json={'label': 'cough', 'description': 'dry'}).status_code == 201
+    assert symptom_labels(client, user_id) == ['chills', 'cough']
+
+    assert client.post(f'/users/{user_id}/symptoms:batch',
+                       json=[{'label': 'rash', 'description': 'hot'}]).status_code == 200
+    assert client.get(f'/users/{user_id}/symptoms/{symptom_id}').get_json()['label'] == 'rash'
+    assert symptom_labels(client, user_id) == ['cough', 'rash']
+
+    assert client.delete(f'/users/{user_id}/symptoms/{symptom_id}', headers=headers).status_code == 200
+    assert client.get(f'/users/{user_id}/symptoms/{symptom_id}').status_code == 404
+    assert symptom_labels(client, user_id) == ['cough']
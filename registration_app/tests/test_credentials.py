@@ -0,0 +1,70 @@
+import json
+
+from werkzeug.security import generate_password_hash
+
+from cache import LRUCache, resource_cache
+from credentials import credentials
+from models import db, User
+
+
+def register(client, username, password='secret'):
+    response = client.post('/auth/register', json={'username': username, 'password': password})
+    assert response.status_code == 201
+    return response.get_json()['user']['id']
+
+
+def test_login_records_stay_out_of_the_shared_cache(app, client, monkeypatch):
+    backend = LRUCache()
+    monkeypatch.setattr(resource_cache, 'backend', backend)
+    register(client, 'alice')
+
+    assert client.post('/auth/login', json={'username': 'alice', 'password': 'secret'}).status_code == 200
+    password_hash = db.session.scalar(db.select(User.password).where(User.username == 'alice'))
+    assert all(password_hash not in json.dumps(value) for value, _ in backend._entries.values())
+    assert credentials.lookup('alice')['password'] == password_hash
+
+
+def test_changed_password_is_used_after_forget(app, client):
+    user_id = register(client, 'bob')
+    assert client.post('/auth/login', json={'username': 'bob', 'password': 'secret'}).status_code == 200
+
+    assert client.put(f'/users/{user_id}', json={'password': credentials.hash_password('changed')}).status_code == 200
+    assert client.post('/auth/login', json={'username': 'bob', 'password': 'secret'}).status_code == 401
+    assert client.post('/auth/login', json={'username': 'bob', 'password': 'changed'}).status_code == 200
+
+
+def test_login_upgrades_a_hash_made_with_old_parameters(app, client):
+    user_id = register(client, 'carol')
+    db.session.get(User, user_id).password = generate_password_hash('secret', 'pbkdf2:sha256:1000', 8)
+    db.session.commit()
+    assert credentials.needs_rehash(db.session.get(User, user_id).password)
+
+    assert client.post('/auth/login', json={'username': 'carol', 'password': 'secret'}).status_code == 200
+    db.session.expire_all()
+    upgraded = db.session.get(User, user_id).password
+    assert upgraded.startswith('scrypt:') and not credentials.needs_rehash(upgraded)
+    assert client.post('/auth/login', json={'username': 'carol', 'password': 'secret'}).status_code == 200
+
+
+def test_login_attempts_are_limited_per_username(app, client):
+    register(client, 'dave')
+    attempts, _ = app.config['LOGIN_RATE_LIMIT_PER_USER']
+    for _ in range(attempts):
+        assert client.post('/auth/login', json={'username': 'dave', 'password': 'wrong'}).status_code == 401
+
+    refused = client.post('/auth/login', json={'username': 'DAVE', 'password': 'secret'})
+    assert refused.status_code == 429
+    assert int(refused.headers['Retry-After']) >= 1
+    register(client, 'erin')
+    assert client.post('/auth/login', json={'username': 'erin', 'password': 'secret'}).status_code == 200
+
+
+def test_login_attempts_are_limited_per_ip_address(app, client):
+    attempts, _ = app.config['LOGIN_RATE_LIMIT_PER_IP']
+    for number in range(attempts):
+        assert client.post('/auth/login', json={'username': f'user{number}', 'password': 'x'}).status_code == 401
+    refused = client.post('/auth/login', json={'username': 'someone', 'password': 'x'})
+    assert refused.status_code == 429 and 'Retry-After' in refused.headers
+    other_ip = client.post('/auth/login', json={'username': 'someone', 'password': 'x'},
+                           environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert other_ip.status_code == 401
@@ -0,0 +1,34 @@
+from flask_jwt_extended import create_access_token
+
+from events import symptom_events
+from models import db, User
+
+
+def auth_headers(user_id):
+    return {'Authorization': f'Bearer {create_access_token(identity=user_id)}'}
+
+
+def test_streams_are_released_when_the_body_is_never_read(app, client):
+    user = User(username='watcher', password='x')
+    db.session.add(user)
+    db.session.commit()
+    headers = auth_headers(user.id)
+
+    for _ in range(symptom_events.max_streams + 5):
+        assert client.head(f'/users/{user.id}/symptoms/events', headers=headers).status_code == 200
+        response = client.get(f'/users/{user.id}/symptoms/events', headers=headers)
+        assert response.status_code == 200
+        response.close()
+    assert symptom_events.open_streams() == 0
+
+
+def test_stream_counts_as_open_until_closed(app, client):
+    user = User(username='watcher', password='x')
+    db.session.add(user)
+    db.session.commit()
+
+    response = client.get(f'/users/{user.id}/symptoms/events', headers=auth_headers(user.id))
+    assert next(iter(response.response)).startswith(b'retry:')
+    assert symptom_events.open_streams() == 1
+    response.close()
+    assert symptom_events.open_streams() == 0
@@ -0,0 +1,79 @@
+import base64
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import db, ActivityLog, User
+from pagination import PaginationError, decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(42), int) == (42,)
+    assert decode_cursor(encode_cursor('2024-05-01T10:30:00', 7), datetime, int) == (datetime(2024, 5, 1, 10, 30), 7)
+    assert decode_cursor(None, int) is None
+    assert decode_cursor('', int) is None
+
+
+@pytest.mark.parametrize('token', [
+    'not base64!',
+    encode_cursor({}),
+    encode_cursor('1'),
+    encode_cursor(1.5),
+    encode_cursor(True),
+    encode_cursor(None),
+    encode_cursor(1, 2),
+    base64.urlsafe_b64encode(b'{"id": 1}').decode(),
+    base64.urlsafe_b64encode(b'[]').decode(),
+])
+def test_forged_id_cursors_are_rejected(token):
+    with pytest.raises(PaginationError):
+        decode_cursor(token, int)
+
+
+@pytest.mark.parametrize('values', [
+    ({},),
+    ('2024-05-01T10:30:00',),
+    ('yesterday', 1),
+    (1714559400, 1),
+    ('2024-05-01T10:30:00', '1'),
+    ('2024-05-01T10:30:00', 1, 2),
+])
+def test_forged_activity_log_cursors_are_rejected(values):
+    with pytest.raises(PaginationError):
+        decode_cursor(encode_cursor(*values), datetime, int)
+
+
+def test_endpoints_answer_forged_cursors_with_400(client):
+    forged = encode_cursor({})
+    assert client.get(f'/get_users?cursor={forged}').status_code == 400
+    assert client.get(f'/activity_logs/1?cursor={forged}').status_code == 400
+
+
+def test_user_pages_follow_next_links(app, client):
+    db.session.add_all([User(username=f'user_{i}', password='x') for i in range(7)])
+    db.session.commit()
+
+    seen = []
+    url = '/get_users?limit=3'
+    while url:
+        body = client.get(url).get_json()
+        seen.extend(user['id'] for user in body['users'])
+        url = body['links']['next']
+    assert seen == sorted(seen) and len(seen) == 7
+
+
+def test_activity_log_pages_follow_next_links(app, client):
+    start = datetime(2026, 1, 1)
+    # Two entries share each timestamp, so the id breaks the tie
+    db.session.add_all([ActivityLog(user_id=1, action='Get User Symptoms', endpoint=f'/entries/{i}',
+                                    method='GET', ip_address='127.0.0.1', status_code=200,
+                                    timestamp=start + timedelta(minutes=i // 2)) for i in range(9)])
+    db.session.commit()
+
+    seen = []
+    url = '/activity_logs/1?limit=4&fields=endpoint'
+    while url:
+        body = client.get(url).get_json()
+        seen.extend(log['endpoint'] for log in body['activity_logs'])
+        url = body['links']['next']
+    assert seen == [f'/entries/{i}' for i in reversed(range(9))]
@@ -0,0 +1,77 @@
+import itertools
+import json
+import random
+
+import pytest
+
+import pattern_mining
+from pattern_mining import LabelMatrix, frequent_itemsets
+
+LABELS = ['fever', 'cough', 'headache', 'nausea', 'fatigue', 'rash', 'chills']
+
+
+def random_signatures(seed, count=40):
+    rnd = random.Random(seed)
+    signatures = {}
+    for _ in range(count):
+        labels = sorted(rnd.sample(LABELS, rnd.randint(1, 5)))
+        signatures[json.dumps(labels)] = rnd.randint(1, 300)
+    return signatures
+
+
+def brute_force(signatures, min_count, max_size):
+    frequent = {}
+    for size in range(1, max_size + 1):
+        for combination in itertools.combinations(LABELS, size):
+            users = sum(count for signature, count in signatures.items()
+                        if set(combination) <= set(json.loads(signature)))
+            if users and users >= min_count:
+                frequent[frozenset(combination)] = users
+    return frequent
+
+
+def mined(signatures, min_count, max_size):
+    matrix = LabelMatrix()
+    for signature, count in signatures.items():
+        matrix.set_count(signature, count)
+    return {frozenset(matrix.names(bitset)): count
+            for bitset, count in frequent_itemsets(matrix, min_count, max_size).items()}
+
+
+@pytest.fixture(params=['numpy', 'int'])
+def counter(request, monkeypatch):
+    if request.param == 'numpy':
+        if pattern_mining.numpy is None or not hasattr(pattern_mining.numpy, 'bitwise_count'):
+            pytest.skip('NumPy 2.0 or later is not installed')
+    else:
+        monkeypatch.setattr(pattern_mining, 'numpy', None)
+    return request.param
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('min_count,max_size', [(1, 3), (150, 4), (600, 2), (2000, 3)])
+def test_frequent_itemsets_match_brute_force(counter, seed, min_count, max_size):
+    signatures = random_signatures(seed)
+    assert mined(signatures, min_count, max_size) == brute_force(signatures, min_count, max_size)
+
+
+def test_set_count_replaces_and_removes_rows(counter):
+    signatures = random_signatures(7)
+    matrix = LabelMatrix()
+    for signature, count in signatures.items():
+        matrix.set_count(signature, count)
+    changed = dict(signatures)
+    for signature in list(changed)[:10]:
+        del changed[signature]
+        matrix.set_count(signature, 0)
+    for signature in list(changed)[:5]:
+        changed[signature] += 1000
+        matrix.set_count(signature, changed[signature])
+
+    assert matrix.total == sum(changed.values())
+    found = {frozenset(matrix.names(bitset)): count for bitset, count in frequent_itemsets(matrix, 1, 3).items()}
+    assert found == brute_force(changed, 1, 3)
+
+
+def test_empty_matrix_has_no_itemsets():
+    assert frequent_itemsets(LabelMatrix(), 1, 3) == {}
@@ -0,0 +1,65 @@
+import json
+from datetime import datetime
+
+from models import db, Symptom, User
+
+
+def add_user_with_symptom():
+    user = User(username='batcher', password='x')
+    db.session.add(user)
+    db.session.flush()
+    symptom = Symptom(userid=user.id, label='fever', description='hot')
+    db.session.add(symptom)
+    db.session.commit()
+    return user.id, symptom.id
+
+
+def stored_symptoms(user_id):
+    return {symptom.description: symptom.label for symptom in Symptom.query.filter_by(userid=user_id)}
+
+
+def test_batch_reports_each_item_and_upserts_the_valid_ones(app, client):
+    user_id, symptom_id = add_user_with_symptom()
+    response = client.post(f'/users/{user_id}/symptoms:batch', json=[
+        {'label': 'rash', 'description': 'hot'},
+        {'label': 'cough', 'description': 'dry'},
+        {'label': 'cough', 'description': 'wet'},
+        {'label': 'wheeze', 'description': 'dry', 'timestamp': '2026-05-01T08:00:00'},
+        {'label': '', 'description': 'empty'},
+        'not an object',
+    ])
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['summary'] == {'created': 2, 'updated': 1, 'superseded': 1, 'invalid': 2}
+
+    results = body['results']
+    assert [result['index'] for result in results] == list(range(6))
+    assert results[0] == {'index': 0, 'status': 'updated', 'id': symptom_id}
+    assert results[1] == {'index': 1, 'status': 'superseded', 'superseded_by': 3}
+    assert results[2]['status'] == 'created'
+    assert results[3]['status'] == 'created'
+    assert results[4] == {'index': 4, 'status': 'invalid', 'errors': ['label is required']}
+    assert results[5] == {'index': 5, 'status': 'invalid', 'errors': ['Item must be a JSON object']}
+
+    assert stored_symptoms(user_id) == {'hot': 'rash', 'dry': 'wheeze', 'wet': 'cough'}
+    wheeze = db.session.get(Symptom, results[3]['id'])
+    assert wheeze.description == 'dry' and wheeze.timestamp == datetime(2026, 5, 1, 8)
+
+
+def test_ndjson_batch_keeps_unparsable_lines_as_invalid(app, client):
+    user_id, _ = add_user_with_symptom()
+    body = '\n'.join([json.dumps({'label': 'cough', 'description': 'dry'}), '{not json', '',
+                      json.dumps({'label': 'chills', 'description': 'hot', 'timestamp': 'yesterday'})])
+    response = client.post(f'/users/{user_id}/symptoms:batch', data=body, content_type='application/x-ndjson')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['summary'] == {'created': 1, 'updated': 0, 'superseded': 0, 'invalid': 2}
+    assert body['results'][1]['errors'][0].startswith('Invalid JSON')
+    assert body['results'][2]['errors'] == ['timestamp must be an ISO 8601 date and time']
+    assert stored_symptoms(user_id) == {'hot': 'fever', 'dry': 'cough'}
+
+
+def test_batch_body_must_be_a_list(app, client):
+    user_id, _ = add_user_with_symptom()
+    assert client.post(f'/users/{user_id}/symptoms:batch', json={'label': 'cough'}).status_code == 400
+    assert client.post('/users/999/symptoms:batch', json=[]).status_code == 404
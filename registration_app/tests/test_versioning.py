@@ -0,0 +1,59 @@
+from sqlalchemy import update
+
+import versioning
+from models import db, ResourceVersion, User
+
+
+def add_user():
+    user = User(username='versioned', password='x', age=30)
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+
+def test_unchanged_user_gets_304_and_changed_user_a_new_etag(app, client):
+    user_id = add_user()
+    first = client.get(f'/users/{user_id}')
+    etag = first.headers['ETag']
+    assert client.get(f'/users/{user_id}', headers={'If-None-Match': etag}).status_code == 304
+
+    assert client.put(f'/users/{user_id}', json={'age': 31}).status_code == 200
+    second = client.get(f'/users/{user_id}', headers={'If-None-Match': etag})
+    assert second.status_code == 200
+    assert second.get_json()['age'] == 31
+    assert second.headers['ETag'] != etag
+
+
+def test_second_write_with_the_same_etag_gets_412(app, client):
+    user_id = add_user()
+    etag = client.get(f'/users/{user_id}').headers['ETag']
+
+    assert client.put(f'/users/{user_id}', json={'age': 40}, headers={'If-Match': etag}).status_code == 200
+    refused = client.put(f'/users/{user_id}', json={'age': 50}, headers={'If-Match': etag})
+    assert refused.status_code == 412
+    assert refused.headers['ETag'] == client.get(f'/users/{user_id}').headers['ETag']
+    assert db.session.get(User, user_id).age == 40
+
+
+def test_if_match_is_checked_against_the_database_not_the_cache(app, client):
+    user_id = add_user()
+    assert client.put(f'/users/{user_id}', json={'age': 30}).status_code == 200
+    etag = client.get(f'/users/{user_id}').headers['ETag']
+    # A write by another process: the counter moves, this process's cached copy does not
+    moved = db.session.execute(update(ResourceVersion)
+                               .where(ResourceVersion.scope == versioning.user_scope(user_id))
+                               .values(version=ResourceVersion.version + 1))
+    db.session.commit()
+    assert moved.rowcount == 1
+    assert client.get(f'/users/{user_id}', headers={'If-None-Match': etag}).status_code == 304  # Cached counter
+
+    assert client.put(f'/users/{user_id}', json={'age': 50}, headers={'If-Match': etag}).status_code == 412
+    assert client.delete(f'/users/{user_id}', headers={'If-Match': etag}).status_code == 412
+    assert db.session.get(User, user_id).age == 30
+
+
+def test_write_without_if_match_still_moves_the_etag(app, client):
+    user_id = add_user()
+    etag = client.get(f'/users/{user_id}').headers['ETag']
+    assert client.delete(f'/users/{user_id}').status_code == 200
+    assert client.get(f'/users/{user_id}', headers={'If-None-Match': etag}).status_code == 404
@@ -0,0 +1,186 @@
+"""Version counters and ETags for conditional requests.
+
+Every change to a user or their symptoms bumps the counter of the scope
+"user:<id>" in the same transaction, and changes to the pattern index bump
+"patterns". A resource's strong ETag is a hash of the counters it depends
+on and the URL it was served from. The counters are read through the
+resource cache, so answering an unchanged poll with 304 Not Modified needs
+no database query. Records served under an ETag are cached together with
+the versions they were read at, see load(), so the ETag always describes
+the record sent with it. fill_database bumps the "global" scope, which every
+ETag includes, because it replaces all rows at once. The ETag also covers
+the negotiated format (JSON, MessagePack, CBOR), and a compressed response
+carries it with the content coding appended, see response_encoding.py.
+
+Each process caches the counters for up to CACHE_DEFAULT_TTL seconds. With
+the memory cache backend, a process that did not handle a write may answer
+304 for the old version until then; 304s that are right across processes
+need CACHE_BACKEND = "redis". If-Match on writes never relies on the cache:
+bump_if_match() checks it against the counters in the database and bumps
+them with a conditional UPDATE in the write's own transaction.
+"""
+import hashlib
+
+from flask import jsonify, make_response, request
+from sqlalchemy import event, insert, select, update
+
+from cache import resource_cache
+from models import db, ResourceVersion
+import response_encoding
+
+GLOBAL_SCOPE = 'global'
+PATTERNS_SCOPE = 'patterns'
+
+
+def user_scope(user_id):
+    return f'user:{user_id}'
+
+
+def _version_key(scope):
+    return f'version:{scope}'
+
+
+def bump_if_match(scope):
+    """Bumps scope like bump(), provided the request's If-Match names its current version.
+
+    Call it in the write's transaction, before committing. The versions are
+    read from the database and the bump only applies if the counter has not
+    moved since, so of two writes sent with the same ETag one gets the 412.
+    Returns None once bumped, or a 412 response after rolling the
+    transaction back.
+    """
+    if not request.if_match:
+        bump(scope)
+        return None
+    versions = _stored_versions((GLOBAL_SCOPE, scope))
+    response = precondition_failed(_etag(versions))
+    if response is not None:
+        db.session.rollback()
+        return response
+    if versions[scope] == 0:
+        bump(scope)  # No counter yet; a concurrent first write fails on its primary key
+        return None
+    result = db.session.execute(
+        update(ResourceVersion)
+        .where(ResourceVersion.scope == scope, ResourceVersion.version == versions[scope])
+        .values(version=ResourceVersion.version + 1)
+    )
+    if result.rowcount == 1:
+        db.session.info.setdefault('bumped_scopes', set()).add(scope)
+        return None
+    # Another write committed after the versions were read
+    etag = _etag(_stored_versions((GLOBAL_SCOPE, scope)))
+    db.session.rollback()
+    return _precondition_failed_response(etag)
+
+
+def bump(*scopes):
+    """Increments the given counters in the current transaction.
+
+    The cached counters are dropped once the transaction commits.
+    """
+    for scope in scopes:
+        result = db.session.execute(
+            update(ResourceVersion)
+            .where(ResourceVersion.scope == scope)
+            .values(version=ResourceVersion.version + 1)
+        )
+        if result.rowcount == 0:
+            db.session.execute(insert(ResourceVersion).values(scope=scope, version=1))
+    db.session.info.setdefault('bumped_scopes', set()).update(scopes)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _drop_cached_versions(session):
+    scopes = session.info.pop('bumped_scopes', None)
+    if scopes:
+        resource_cache.invalidate(*[_version_key(scope) for scope in scopes])
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_bumped_scopes(session):
+    session.info.pop('bumped_scopes', None)
+
+
+def current(scope):
+    def load():
+        row = db.session.get(ResourceVersion, scope)
+        return row.version if row else 0
+    return resource_cache.get_or_load(_version_key(scope), load)
+
+
+def load(key, loader, scopes, tags=()):
+    """Loads a value through the resource cache along with the versions of the scopes it depends on.
+
+    Returns (value, etag), or (None, None) if loader() found nothing. The
+    ETag is built from the versions read with the value, not from the
+    cached counters, which are invalidated separately. A cached value
+    older than the counters is loaded again.
+    """
+    scopes = (GLOBAL_SCOPE,) + scopes
+
+    def load_entry():
+        # Versions first: a write committing in between makes the value newer than
+        # its ETag says, which only costs the client a refetch
+        versions = _stored_versions(scopes)
+        value = loader()
+        return {'versions': versions, 'value': value} if value is not None else None
+
+    entry = resource_cache.get_or_load(key, load_entry, tags=tags)
+    if entry is not None and any(entry['versions'][scope] < current(scope) for scope in scopes):
+        resource_cache.invalidate(key)
+        entry = resource_cache.get_or_load(key, load_entry, tags=tags)
+    if entry is None:
+        return None, None
+    return entry['value'], _etag(entry['versions'])
+
+
+def _stored_versions(scopes):
+    """The scopes' counters as stored in the database, not the cache."""
+    rows = db.session.execute(
+        select(ResourceVersion.scope, ResourceVersion.version).where(ResourceVersion.scope.in_(scopes)))
+    versions = dict.fromkeys(scopes, 0)
+    versions.update(rows.all())
+    return versions
+
+
+def etag_for(*scopes):
+    """Strong ETag for the current URL as of the given scopes' versions."""
+    return _etag({scope: current(scope) for scope in (GLOBAL_SCOPE,) + scopes})
+
+
+def _etag(versions):
+    parts = [f'{scope}={version}' for scope, version in versions.items()]
+    parts.append(request.host)
+    parts.append(request.full_path)
+    parts.append(response_encoding.negotiated_mimetype())
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+
+def not_modified(etag):
+    """Returns a 304 response if the client's If-None-Match already matches etag."""
+    if any(request.if_none_match.contains(variant) for variant in response_encoding.etag_variants(etag)):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def precondition_failed(etag):
+    """Returns a 412 response if If-Match was sent and does not match etag."""
+    if request.if_match and not any(
+            request.if_match.contains(variant) for variant in response_encoding.etag_variants(etag)):
+        return _precondition_failed_response(etag)
+    return None
+
+
+def _precondition_failed_response(etag):
+    response = jsonify({'message': 'Resource has changed, fetch it again before modifying it'})
+    response.status_code = 412
+    response.set_etag(etag)
+    return response
+
+
+def tagged(response, etag):
+    response.set_etag(etag)
+    return response